@@ -0,0 +1,303 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from ps_formats import file_extension, read_frame, write_frame
+from ps_partitions import local_partition_files, parse_date, prune_keys
+from ps_summary import hourly_daily_summary_query
+
+# Output columns of Hourly_Daily_Summary, in table order
+summary_columns = [
+    'app_date',
+    'user_Id',
+    'country',
+    'user_total_lp_earned',
+    'user_total_revenue',
+    'user_total_purchases',
+    'user_avg_revenue_per_purchase',
+    'total_daily_revenue',
+]
+
+
+def round_half_up(values, decimals):
+    # Snowflake rounds halves away from zero, numpy rounds them to even
+    scale = 10 ** decimals
+    return np.sign(values) * np.floor(np.abs(values) * scale + 0.5 + 1e-9) / scale
+
+
+def processed_files_in_range(paths, start_date=None, end_date=None):
+    """
+    Expands processed files and partitioned directories into the processed files of an event date range, only the
+    date= directories in range are read.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(file for file in local_partition_files(path, start_date, end_date)
+                         if os.path.basename(file).startswith('processed_'))
+        else:
+            files.append(path)
+    return prune_keys(files, start_date, end_date)
+
+
+def read_processed_files(files):
+    """
+    Reads and concatenates processed files (CSV or Parquet), as they are uploaded to the processed bucket.
+    """
+    frames = [read_frame(file) for file in files]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def staging_loyalty(loyalty):
+    """
+    Casts processed loyalty rows the way COPY INTO casts them into LOYALTY_EARNED_HOURLY: DATE TIMESTAMP,
+    TOTAL_LP_EARNED INT and text ids.
+    """
+    return pd.DataFrame({
+        'date': pd.to_datetime(loyalty.get('date', pd.Series(dtype='datetime64[ns]'))),
+        'userId': loyalty.get('userId', pd.Series(dtype=object)).astype(object),
+        'country': loyalty.get('country', pd.Series(dtype=object)).astype(object),
+        'total_lp_earned': round_half_up(pd.to_numeric(loyalty.get('total_lp_earned', pd.Series(dtype=float))), 0),
+    })
+
+
+def staging_purchases(purchases):
+    """
+    Casts processed purchases rows the way COPY INTO casts them into PURCHASES: DATE TIMESTAMP,
+    REVENUE DECIMAL(10, 2) and text ids.
+    """
+    return pd.DataFrame({
+        'date': pd.to_datetime(purchases.get('date', pd.Series(dtype='datetime64[ns]'))),
+        'userId': purchases.get('userId', pd.Series(dtype=object)).astype(object),
+        'revenue': round_half_up(pd.to_numeric(purchases.get('revenue', pd.Series(dtype=float))), 2),
+        'transaction_id': purchases.get('transaction_id', pd.Series(dtype=object)).astype(object),
+    })
+
+
+def staging_frames(loyalty, purchases):
+    return staging_loyalty(loyalty), staging_purchases(purchases)
+
+
+def pandas_hourly_daily_summary(loyalty, purchases):
+    """
+    Computes Hourly_Daily_Summary with vectorized pandas merges and groupbys, following ps_summary's SQL step by step.
+    """
+    loyalty, purchases = staging_frames(loyalty, purchases)
+
+    # PurchasesHourly, NULL keys never match in the SQL join
+    purchases_hourly = pd.DataFrame({
+        'date_hourly': purchases['date'].dt.floor('h'),
+        'userId': purchases['userId'],
+        'revenue': purchases['revenue'],
+        'transaction_id': purchases['transaction_id'],
+    })
+    purchases_hourly = purchases_hourly[purchases_hourly['userId'].notna() & purchases_hourly['date_hourly'].notna()]
+
+    # MergedData: every loyalty hour, repeated once per purchase of that user and hour
+    merged = loyalty.merge(purchases_hourly, how='left', left_on=['userId', 'date'],
+                           right_on=['userId', 'date_hourly'], sort=False)
+    merged['revenue_or_zero'] = merged['revenue'].fillna(0)
+
+    # HourlySummary
+    hourly_groups = merged.groupby(['date', 'userId', 'country'], dropna=False, sort=False)
+    hourly = pd.DataFrame({
+        'user_total_lp_earned': hourly_groups['total_lp_earned'].sum(min_count=1),
+        'user_total_revenue': round_half_up(hourly_groups['revenue_or_zero'].sum(), 2),
+        'user_total_purchases': hourly_groups['transaction_id'].count(),
+    }).reset_index()
+    purchases_count = hourly['user_total_purchases']
+    average = round_half_up(hourly['user_total_revenue'] / purchases_count.clip(lower=1), 2)
+    hourly['user_avg_revenue_per_purchase'] = np.where(purchases_count > 0, average, 0)
+
+    # DailyRevenue
+    merged['date_daily'] = merged['date'].dt.normalize()
+    daily = merged.groupby(['userId', 'date_daily'], sort=False)['revenue_or_zero'].sum()
+    daily = round_half_up(daily, 2).rename('total_daily_revenue').reset_index()
+
+    hourly['date_daily'] = hourly['date'].dt.normalize()
+    summary = hourly.merge(daily, how='left', on=['userId', 'date_daily'], sort=False)
+    summary = summary.rename(columns={'date': 'app_date', 'userId': 'user_Id'})
+    return summary[summary_columns].sort_values(['app_date', 'user_Id'], kind='stable').reset_index(drop=True)
+
+
+def duckdb_hourly_daily_summary(loyalty, purchases):
+    """
+    Runs ps_summary's SQL unchanged on an in-memory DuckDB database shaped like PS_STAGING_DB.STAGING.
+
+    DuckDB divides decimals in floating point, so an average that falls exactly on half a cent (25.59 / 6) can round
+    down where Snowflake rounds up. The pandas backend rounds like Snowflake.
+    """
+    import duckdb
+
+    loyalty, purchases = staging_frames(loyalty, purchases)
+    con = duckdb.connect()
+    try:
+        con.execute("ATTACH ':memory:' AS PS_STAGING_DB")
+        con.execute("CREATE SCHEMA PS_STAGING_DB.STAGING")
+        con.register('loyalty_frame', loyalty)
+        con.register('purchases_frame', purchases)
+        con.execute("""
+            CREATE TABLE PS_STAGING_DB.STAGING.LOYALTY_EARNED_HOURLY AS
+            SELECT CAST(date AS TIMESTAMP) AS DATE, CAST(userId AS VARCHAR) AS USER_ID,
+                   CAST(country AS VARCHAR) AS COUNTRY, CAST(total_lp_earned AS INT) AS TOTAL_LP_EARNED
+            FROM loyalty_frame
+        """)
+        con.execute("""
+            CREATE TABLE PS_STAGING_DB.STAGING.PURCHASES AS
+            SELECT CAST(date AS TIMESTAMP) AS DATE, CAST(userId AS VARCHAR) AS USER_ID,
+                   CAST(revenue AS DECIMAL(10, 2)) AS REVENUE, CAST(transaction_id AS VARCHAR) AS TRANSACTION_ID
+            FROM purchases_frame
+        """)
+        summary = con.execute(hourly_daily_summary_query()).df()
+    finally:
+        con.close()
+
+    summary.columns = summary_columns
+    return summary.sort_values(['app_date', 'user_Id'], kind='stable').reset_index(drop=True)
+
+
+# Engines that can compute Hourly_Daily_Summary without a warehouse
+summary_backends = {
+    'pandas': pandas_hourly_daily_summary,
+    'duckdb': duckdb_hourly_daily_summary,
+}
+
+
+def hourly_daily_summary(loyalty, purchases, backend='pandas'):
+    """
+    Computes the Hourly_Daily_Summary table from processed loyalty and purchases rows, with the same result as the
+    Snowflake SQL in ps_summary.
+
+    Parameters:
+    loyalty (DataFrame): Processed Loyalty Earned Hourly rows.
+    purchases (DataFrame): Processed Purchases rows.
+    backend (str): One of summary_backends, 'duckdb' needs the duckdb package.
+
+    Returns:
+    DataFrame: The summary rows, ordered by app_date and user_Id.
+    """
+    if backend not in summary_backends:
+        raise ValueError(f"Unknown summary backend '{backend}', expected one of {sorted(summary_backends)}.")
+    return summary_backends[backend](loyalty, purchases)
+
+
+# Partial aggregates emitted by the transform step, so the load can build the summary without the raw rows. Loyalty
+# rows are grouped on their exact timestamp, which is what the summary joins on, purchases on their hour
+rollup_keys = {
+    'leh': ['date', 'userId', 'country'],
+    'purchases': ['date', 'userId'],
+}
+rollup_values = {
+    'leh': ['total_lp_earned', 'loyalty_rows'],
+    'purchases': ['revenue', 'purchases'],
+}
+
+
+def loyalty_hourly_rollup(df):
+    """
+    Sums the LP earned per (hour, user, country) and counts the loyalty rows, which the summary needs because every
+    loyalty row is joined with the purchases of its hour.
+    """
+    loyalty = staging_loyalty(df)
+    groups = loyalty.groupby(rollup_keys['leh'], dropna=False, sort=False)
+    return pd.DataFrame({
+        'total_lp_earned': groups['total_lp_earned'].sum(min_count=1),
+        'loyalty_rows': groups.size(),
+    }).reset_index()
+
+
+def purchases_hourly_rollup(df):
+    """
+    Sums the revenue and counts the purchases per (hour, user).
+    """
+    purchases = staging_purchases(df)
+    purchases = purchases.assign(date=purchases['date'].dt.floor('h'))
+    # NULL keys never match in the summary join
+    purchases = purchases[purchases['userId'].notna() & purchases['date'].notna()]
+    groups = purchases.groupby(rollup_keys['purchases'], sort=False)
+    return pd.DataFrame({
+        'revenue': groups['revenue'].sum(),
+        'purchases': groups['transaction_id'].count(),
+    }).reset_index()
+
+
+hourly_rollups = {
+    'leh': loyalty_hourly_rollup,
+    'purchases': purchases_hourly_rollup,
+}
+
+
+def combine_rollups(partials, dataset):
+    """
+    Merges partial rollups of the same dataset, e.g. of several files or chunks, into one row per key.
+    """
+    columns = rollup_keys[dataset] + rollup_values[dataset]
+    if not partials:
+        return pd.DataFrame(columns=columns)
+    combined = pd.concat(partials, ignore_index=True)
+    combined = combined.groupby(rollup_keys[dataset], dropna=False, sort=False).sum(min_count=1).reset_index()
+    if dataset == 'leh':
+        # Written as integers so CSV rows load into an INT column
+        combined['total_lp_earned'] = combined['total_lp_earned'].astype('Int64')
+    else:
+        combined['revenue'] = round_half_up(combined['revenue'], 2)
+    return combined[columns]
+
+
+class HourlyRollup:
+    """
+    Accumulates the hourly rollup of one dataset over the frames or chunks processed in a run.
+
+    Partials are compacted every COMPACT_EVERY frames, memory stays bounded by the number of distinct keys.
+    """
+    COMPACT_EVERY = 32
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.partials = []
+
+    def add(self, df):
+        self.partials.append(hourly_rollups[self.dataset](df))
+        if len(self.partials) >= self.COMPACT_EVERY:
+            self.partials = [self.result()]
+
+    def result(self):
+        return combine_rollups(self.partials, self.dataset)
+
+    def write(self, job_timestamp, file_format='csv'):
+        """
+        Writes the rollup next to the processed files.
+
+        Returns:
+        str: The path of the rollup file.
+        """
+        path = f'rollup_{self.dataset}_{job_timestamp}.{file_extension(file_format)}'
+        df = self.result()
+        if file_format == 'csv':
+            df = df.assign(date=pd.to_datetime(df['date']).dt.strftime('%Y-%m-%d %H:%M:%S'))
+        write_frame(df, path)
+        return path
+
+
+# Local run, e.g. python ps_aggregate.py --loyalty processed_leh_*.csv --purchases processed_purchases_*.csv
+# or, on partitioned synced prefixes, --loyalty Loyalty_Earned_Hourly_Data_Set --start-date 2023-01-02
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Computes Hourly_Daily_Summary from processed files, locally.')
+    parser.add_argument('--loyalty', nargs='+', required=True,
+                        help='Processed Loyalty Earned Hourly files or partitioned directories')
+    parser.add_argument('--purchases', nargs='*', default=[],
+                        help='Processed Purchases files or partitioned directories')
+    parser.add_argument('--start-date', type=parse_date, help='First event date of the partitions to read')
+    parser.add_argument('--end-date', type=parse_date, help='Last event date of the partitions to read')
+    parser.add_argument('--backend', choices=sorted(summary_backends), default='pandas')
+    parser.add_argument('--output', default='hourly_daily_summary.csv', help='Output CSV or Parquet file')
+    args = parser.parse_args()
+
+    loyalty_files = processed_files_in_range(args.loyalty, args.start_date, args.end_date)
+    purchases_files = processed_files_in_range(args.purchases, args.start_date, args.end_date)
+    result = hourly_daily_summary(read_processed_files(loyalty_files), read_processed_files(purchases_files),
+                                  args.backend)
+    write_frame(result, args.output)
+    print(f"{len(result)} summary rows written to {args.output}")
@@ -0,0 +1,556 @@
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from ps_extract import dataset_prefixes
+from ps_formats import chunk_writer, file_extension
+from ps_metrics import cpu_seconds, maxrss_bytes, proc_status_bytes, reset_peak_rss
+
+# Error kinds the generator can inject, with the share of rows they hit by default. Each kind is injected
+# independently, so a row can carry several
+DEFAULT_ERROR_RATES = {
+    'bad_user_id': 0.01,
+    'bad_country': 0.01,
+    'bad_revenue': 0.01,
+    'duplicates': 0.01,
+    'nulls': 0.01,
+}
+BAD_USER_IDS = np.array(['12AB345', 'AB1CDEF', 'ab12cd', 'AB12CDEF', 'AB12CD3'], dtype=object)
+BAD_COUNTRIES = np.array(['MX', 'GB', 'FR', 'us'], dtype=object)
+BAD_REVENUES = np.array(['PriceInUSD=', 'PriceInUSD=n/a', 'PriceInUSD=-4.99', 'PriceInUSD=0'], dtype=object)
+PRICES = np.array(['PriceInUSD=0.99', 'PriceInUSD=1.99', 'PriceInUSD=4.99', 'PriceInUSD=9.99'], dtype=object)
+
+# Rows generated at a time, the raw files are written chunk by chunk whatever the scale
+GENERATE_CHUNK_ROWS = 1000000
+# An Excel sheet holds at most 1,048,576 rows, header included
+SHEET_MAX_ROWS = 1048575
+# Sheet names, as in data/Homework_Assignment_Data.xlsx
+sheet_names = {
+    'leh': 'Loyalty Earned Hourly',
+    'purchases': 'Purchases',
+}
+START_DATE = np.datetime64('2022-04-01T00:00:00', 's')
+DAYS = 30
+
+STAGES = ('parse', 'extract', 'validate', 'process', 'summary')
+# Modules the scheduler shouldn't load when it parses the DAG file, and the task modules that load them
+PARSE_HEAVY_MODULES = ('numpy', 'pandas', 'pyarrow', 'openpyxl', 'airflow.providers.amazon.aws.hooks.s3',
+                       'airflow.providers.snowflake.hooks.snowflake')
+TASK_MODULES = ('ps_extract', 'ps_load', 'ps_mapped', 'ps_sv', 'ps_sv_transform', 'ps_transform_dq')
+
+
+def user_ids(count, rng):
+    """
+    Returns `count` distinct valid userIds, two letters, two digits and three letters, e.g. "AB12CDE".
+    """
+    ids = set()
+    while len(ids) < count:
+        chars = np.empty((count, 7), dtype=np.uint8)
+        chars[:, [0, 1, 4, 5, 6]] = rng.integers(ord('A'), ord('Z') + 1, (count, 5))
+        chars[:, [2, 3]] = rng.integers(ord('0'), ord('9') + 1, (count, 2))
+        ids.update(chars.view('S7').ravel().astype(str).tolist())
+    return np.array(sorted(ids)[:count], dtype=object)
+
+
+def transaction_ids(count, rng):
+    # UUID shaped hex strings, built as one byte array
+    chars = np.frombuffer(rng.bytes(16 * count).hex().encode(), dtype=np.uint8).reshape(count, 32)
+    dash = np.full((count, 1), ord('-'), dtype=np.uint8)
+    chars = np.hstack([chars[:, :8], dash, chars[:, 8:12], dash, chars[:, 12:16], dash, chars[:, 16:20], dash,
+                       chars[:, 20:]])
+    return np.ascontiguousarray(chars).view('S36').ravel().astype(str).astype(object)
+
+
+def inject_errors(df, rng, error_rates, dataset):
+    """
+    Corrupts a share of the rows of a generated frame for each error kind of `error_rates`, the ones that don't
+    apply to the dataset are ignored.
+    """
+    def rows(kind):
+        return np.flatnonzero(rng.random(len(df)) < error_rates.get(kind, 0))
+
+    bad = rows('bad_user_id')
+    df.iloc[bad, df.columns.get_loc('userId')] = rng.choice(BAD_USER_IDS, len(bad))
+    if dataset == 'leh':
+        bad = rows('bad_country')
+        df.iloc[bad, df.columns.get_loc('country')] = rng.choice(BAD_COUNTRIES, len(bad))
+    else:
+        bad = rows('bad_revenue')
+        df.iloc[bad, df.columns.get_loc('revenue')] = rng.choice(BAD_REVENUES, len(bad))
+    bad = rows('nulls')
+    columns = rng.integers(0, len(df.columns), len(bad))
+    for column in range(len(df.columns)):
+        df.iloc[bad[columns == column], column] = None
+    # Last, so the copies are exact
+    bad = rows('duplicates')
+    bad = bad[bad > 0]
+    if len(bad):
+        df.iloc[bad] = df.iloc[rng.integers(0, bad)].to_numpy()
+    return df
+
+
+def generate_frame(dataset, rows, rng, users, countries, error_rates):
+    """
+    Generates `rows` rows of a dataset with the columns ps_extract classifies sheets by.
+    """
+    user = rng.integers(0, len(users), rows)
+    if dataset == 'leh':
+        df = pd.DataFrame({
+            'date': START_DATE + rng.integers(0, DAYS * 24, rows).astype('timedelta64[h]'),
+            'userId': users[user],
+            'country': countries[user],
+            'total_lp_earned': rng.gamma(2.0, 20.0, rows),
+        })
+    else:
+        df = pd.DataFrame({
+            'date': START_DATE + rng.integers(0, DAYS * 86400, rows).astype('timedelta64[s]'),
+            'userId': users[user],
+            'revenue': PRICES[rng.integers(0, len(PRICES), rows)],
+            'transaction_id': transaction_ids(rows, rng),
+        })
+    df = df.astype({column: object for column in df.columns if column != 'date'})
+    return inject_errors(df, rng, error_rates, dataset)
+
+
+def generate_data(data_dir, rows, file_format='csv', error_rates=None, seed=0, workbook_max_rows=SHEET_MAX_ROWS):
+    """
+    Writes `rows` synthetic rows of each dataset to `data_dir`: a raw file per dataset, as ps_extract outputs it
+    (raw/), and a workbook to extract (workbooks/bench.xlsx, datasets over SHEET_MAX_ROWS rows spread over several
+    sheets) unless `rows` is above `workbook_max_rows`. Data generated with the same parameters is reused.
+
+    Returns:
+    dict: The generation parameters, the seconds it took and the paths of the files.
+    """
+    error_rates = DEFAULT_ERROR_RATES if error_rates is None else error_rates
+    parameters = {'rows': rows, 'file_format': file_format, 'error_rates': error_rates, 'seed': seed,
+                  'workbook': rows <= workbook_max_rows}
+    params_path = os.path.join(data_dir, 'params.json')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            data = json.load(f)
+        if data['parameters'] == parameters:
+            print(f"Reusing the data in {data_dir}")
+            return data
+
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    users = user_ids(max(rows // 100, 10), rng)
+    countries = rng.choice(np.array(['US', 'CA'], dtype=object), len(users), p=[0.7, 0.3])
+    os.makedirs(os.path.join(data_dir, 'raw'), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, 'workbooks'), exist_ok=True)
+
+    workbook = None
+    if parameters['workbook']:
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+
+    files = {}
+    for dataset in ('leh', 'purchases'):
+        path = os.path.join(data_dir, 'raw', f'{dataset_prefixes[dataset]}_bench_0000.{file_extension(file_format)}')
+        writer = chunk_writer(path)
+        sheet, sheet_rows = None, 0
+        for start_row in range(0, rows, GENERATE_CHUNK_ROWS):
+            df = generate_frame(dataset, min(GENERATE_CHUNK_ROWS, rows - start_row), rng, users, countries,
+                                error_rates)
+            writer.write(df)
+            cells = df.astype(object).where(df.notna(), None) if workbook is not None else df.iloc[:0]
+            for row in zip(*[cells[column].tolist() for column in cells.columns]):
+                if sheet is None or sheet_rows == SHEET_MAX_ROWS:
+                    sheet = workbook.create_sheet(f'{sheet_names[dataset]} {len(workbook.worksheets)}')
+                    sheet.append(list(df.columns))
+                    sheet_rows = 0
+                sheet.append(row)
+                sheet_rows += 1
+        writer.close()
+        files[dataset] = path
+
+    if workbook is not None:
+        files['workbook'] = os.path.join(data_dir, 'workbooks', 'bench.xlsx')
+        workbook.save(files['workbook'])
+
+    data = {'parameters': parameters, 'seconds': round(time.perf_counter() - start, 3), 'files': files}
+    with open(params_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    return data
+
+
+class StageRecorder:
+    """
+    Measures the functions of a stage: wall and CPU seconds (child processes included), the peak RSS reached
+    while each one runs and, with `trace_allocations`, the peak of the Python allocations (tracemalloc, which
+    numpy and pandas report to, not Arrow).
+    """
+
+    def __init__(self, stage, trace_allocations=False):
+        self.stage = stage
+        self.trace_allocations = trace_allocations
+        self.results = []
+
+    def measure(self, name, rows, fn, *args, **kwargs):
+        peak_reset = reset_peak_rss()
+        rss_before = proc_status_bytes('VmRSS')
+        if self.trace_allocations:
+            tracemalloc.start()
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            result = {
+                'stage': self.stage,
+                'name': name,
+                'rows': rows,
+                'seconds': round(seconds, 4),
+                'cpu_seconds': round(cpu_seconds() - cpu_start, 4),
+                'rows_per_second': round(rows / seconds) if rows and seconds else None,
+                'rss_before_bytes': rss_before,
+                # Without the reset the process peak is the best bound available
+                'peak_rss_bytes': proc_status_bytes('VmHWM') if peak_reset else maxrss_bytes(resource.RUSAGE_SELF),
+                'children_peak_rss_bytes': maxrss_bytes(resource.RUSAGE_CHILDREN) or None,
+            }
+            if self.trace_allocations:
+                result['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.results.append(result)
+
+
+def stage_extract(recorder, data, options):
+    from ps_extract import extract
+    from ps_local import task_kwargs, use_local_s3
+
+    use_local_s3(os.path.join(options['workdir'], 's3'))
+    conf = {
+        'directory_path': os.path.dirname(data['files']['workbook']),
+        'intermediate_format': data['parameters']['file_format'],
+        'extract_max_workers': options['extract_workers'],
+    }
+    recorder.measure('extract', 2 * data['parameters']['rows'], extract, **task_kwargs('ps_extract', conf))
+
+
+def read_raw_frames(recorder, data):
+    from ps_formats import read_frame
+
+    return {dataset: recorder.measure(f'read_frame_{dataset}', data['parameters']['rows'], read_frame,
+                                      data['files'][dataset])
+            for dataset in ('leh', 'purchases')}
+
+
+def stage_validate(recorder, data, options):
+    from ps_sv import leh_schema, purchases_schema, validate_dataset_leh, validate_dataset_purchases, validate_file
+
+    rows = data['parameters']['rows']
+    frames = read_raw_frames(recorder, data)
+    recorder.measure('validate_dataset_leh', rows, validate_dataset_leh, frames['leh'], leh_schema, 'bench')
+    recorder.measure('validate_dataset_purchases', rows, validate_dataset_purchases, frames['purchases'],
+                     purchases_schema, 'bench')
+    del frames
+    # What ps_schema_validation runs, from the raw files
+    for dataset in ('leh', 'purchases'):
+        recorder.measure(f'validate_file_scan_{dataset}', rows, validate_file, data['files'][dataset], dataset,
+                         'bench')
+        recorder.measure(f'validate_file_sampled_{dataset}', rows, validate_file, data['files'][dataset], dataset,
+                         'bench', sampling=True)
+
+
+def process_pipelined(path, dataset, output_path):
+    from ps_pipeline import PIPELINE_CHUNK_ROWS
+    from ps_transform_dq import process_file_pipelined
+
+    with open(output_path, 'wb') as target:
+        return process_file_pipelined(path, dataset, 'bench_pipelined', PIPELINE_CHUNK_ROWS, target)
+
+
+def stage_process(recorder, data, options):
+    from ps_transform_dq import process_loyalty_earned_hourly, process_purchases
+
+    rows = data['parameters']['rows']
+    file_format = data['parameters']['file_format']
+    frames = read_raw_frames(recorder, data)
+    # The summary stage reads the processed files from here. DQ error files are appended to, start from scratch
+    shutil.rmtree(options['processed_dir'], ignore_errors=True)
+    os.makedirs(options['processed_dir'])
+    os.chdir(options['processed_dir'])
+    recorder.measure('process_loyalty_earned_hourly', rows, process_loyalty_earned_hourly, frames.pop('leh'),
+                     'bench', file_format)
+    recorder.measure('process_purchases', rows, process_purchases, frames.pop('purchases'), 'bench', file_format)
+    # The pipelined transform reads the raw files itself, chunk by chunk
+    for dataset in ('leh', 'purchases'):
+        recorder.measure(f'process_pipelined_{dataset}', rows, process_pipelined, data['files'][dataset], dataset,
+                         f'processed_{dataset}_bench_pipelined.{file_extension(file_format)}')
+
+
+def stage_summary(recorder, data, options):
+    from ps_aggregate import hourly_daily_summary, read_processed_files
+
+    extension = file_extension(data['parameters']['file_format'])
+    paths = {dataset: os.path.join(options['processed_dir'], f'processed_{dataset}_bench.{extension}')
+             for dataset in ('leh', 'purchases')}
+    if not all(os.path.exists(path) for path in paths.values()):
+        stage_process(StageRecorder('process'), data, options)
+    loyalty = recorder.measure('read_processed_leh', None, read_processed_files, [paths['leh']])
+    purchases = recorder.measure('read_processed_purchases', None, read_processed_files, [paths['purchases']])
+    for backend in options['backends']:
+        recorder.measure(f'hourly_daily_summary_{backend}', len(loyalty) + len(purchases), hourly_daily_summary,
+                         loyalty, purchases, backend)
+
+
+def parse_dag_file(eager=False):
+    """
+    Imports ps_etl in a fresh interpreter, as the scheduler's DAG file processor does, and with `eager` the task
+    modules as well, which is what a parse cost when ps_etl imported its callables directly.
+
+    Returns:
+    List[str]: The PARSE_HEAVY_MODULES the parse loaded.
+    """
+    modules = ['ps_etl', *(TASK_MODULES if eager else ())]
+    script = (f"import sys; import {', '.join(modules)}; "
+              f"print(' '.join(name for name in {PARSE_HEAVY_MODULES!r} if name in sys.modules))")
+    output = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            check=True, capture_output=True, text=True).stdout
+    return output.split()
+
+
+def stage_parse(recorder, data, options):
+    for eager in (False, True):
+        name = 'parse_dag_eager_imports' if eager else 'parse_dag'
+        loaded = recorder.measure(name, None, parse_dag_file, eager)
+        print(f"{name} loaded {', '.join(loaded) or 'no heavy module'}")
+
+
+stage_functions = {
+    'parse': stage_parse,
+    'extract': stage_extract,
+    'validate': stage_validate,
+    'process': stage_process,
+    'summary': stage_summary,
+}
+
+
+def run_stage(stage, data, options):
+    """
+    Runs one stage in the current process, from a scratch directory of the work directory.
+
+    Returns:
+    List[dict]: The measurements of the stage.
+    """
+    stage_dir = os.path.join(options['workdir'], 'stages', stage)
+    os.makedirs(stage_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(stage_dir)
+    try:
+        recorder = StageRecorder(stage, options['tracemalloc'])
+        stage_functions[stage](recorder, data, options)
+        return recorder.results
+    finally:
+        os.chdir(cwd)
+
+
+def run_stage_isolated(stage, data, options):
+    """
+    Runs a stage in a fresh process, so its memory peak doesn't include the earlier stages and a crash (e.g. out of
+    memory at large scales) only fails that stage.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_stage, stage, data, options).result()
+
+
+def summarize_runs(runs):
+    """
+    Merges the measurements of repeated runs per (stage, name): the best and median seconds, and the largest
+    memory peaks.
+    """
+    merged = {}
+    for run in runs:
+        for result in run:
+            merged.setdefault((result['stage'], result['name']), []).append(result)
+
+    summary = []
+    for (stage, name), results in merged.items():
+        seconds = [result['seconds'] for result in results]
+        best = min(results, key=lambda result: result['seconds'])
+        entry = dict(best)
+        entry.update({
+            'runs': len(results),
+            'seconds_median': round(statistics.median(seconds), 4),
+            'seconds_runs': seconds,
+        })
+        for field in ('peak_rss_bytes', 'children_peak_rss_bytes', 'tracemalloc_peak_bytes'):
+            values = [result[field] for result in results if result.get(field) is not None]
+            if values:
+                entry[field] = max(values)
+        summary.append(entry)
+    return summary
+
+
+def git_revision():
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=cwd, capture_output=True, text=True, check=True)
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd,
+                                capture_output=True, text=True, check=True)
+        return {'commit': commit.stdout.strip(), 'dirty': bool(status.stdout.strip())}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+def environment():
+    versions = {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__}
+    for module in ('pyarrow', 'duckdb', 'openpyxl'):
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return {'platform': platform.platform(), 'cpus': os.cpu_count(), 'versions': versions}
+
+
+def run_benchmark(rows, stages=STAGES, file_format='csv', error_rates=None, seed=0, repeat=1,
+                  workdir='ps_benchmark', backends=('pandas',), extract_workers=1, trace_allocations=False,
+                  workbook_max_rows=SHEET_MAX_ROWS, isolate=True):
+    """
+    Generates the data and runs each stage `repeat` times.
+
+    Returns:
+    dict: The report: revision, environment, parameters, data generation, the measurements of every stage and the
+    stages that failed or were skipped.
+    """
+    workdir = os.path.abspath(workdir)
+    data = generate_data(os.path.join(workdir, 'data'), rows, file_format, error_rates, seed, workbook_max_rows)
+    options = {
+        'workdir': workdir,
+        'processed_dir': os.path.join(workdir, 'processed'),
+        'backends': list(backends),
+        'extract_workers': extract_workers,
+        'tracemalloc': trace_allocations,
+        'workbook_max_rows': workbook_max_rows,
+    }
+
+    runs, failures, skipped = [], [], []
+    for stage in stages:
+        if stage == 'extract' and 'workbook' not in data['files']:
+            skipped.append({'stage': stage, 'reason': f'no workbook above {workbook_max_rows} rows'})
+            continue
+        if stage == 'parse' and importlib.util.find_spec('airflow') is None:
+            skipped.append({'stage': stage, 'reason': 'Airflow is not installed'})
+            continue
+        for _ in range(repeat):
+            try:
+                runs.append(run_stage_isolated(stage, data, options) if isolate else run_stage(stage, data, options))
+            except Exception as e:
+                failures.append({'stage': stage, 'error': f'{type(e).__name__}: {e}'})
+                print(f"Stage {stage} failed: {e}")
+                break
+
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'environment': environment(),
+        'parameters': dict(data['parameters'], stages=list(stages), repeat=repeat, backends=list(backends),
+                           extract_workers=extract_workers),
+        'generate_seconds': data['seconds'],
+        'results': summarize_runs(runs),
+        'failures': failures,
+        'skipped': skipped,
+    }
+
+
+def compare_reports(baseline, report, tolerance=0.1):
+    """
+    Compares the seconds and memory peaks of two reports, measurement by measurement.
+
+    Returns:
+    Tuple[List[dict], List[dict]]: The comparison of every measurement in both reports and the regressions, the
+    ones more than `tolerance` slower or bigger than the baseline.
+    """
+    baseline_results = {(result['stage'], result['name']): result for result in baseline['results']}
+    rows, regressions = [], []
+    for result in report['results']:
+        previous = baseline_results.get((result['stage'], result['name']))
+        if previous is None:
+            continue
+        row = {'stage': result['stage'], 'name': result['name']}
+        for field in ('seconds', 'peak_rss_bytes'):
+            if previous.get(field) and result.get(field) is not None:
+                row[f'{field}_ratio'] = round(result[field] / previous[field], 3)
+        rows.append(row)
+        if any(ratio > 1 + tolerance for key, ratio in row.items() if key.endswith('_ratio')):
+            regressions.append(row)
+    return rows, regressions
+
+
+def parse_error_rates(value):
+    """
+    Parses 'kind=rate,...' into error rates, on top of DEFAULT_ERROR_RATES. 'none' disables every kind.
+    """
+    if value == 'none':
+        return {kind: 0.0 for kind in DEFAULT_ERROR_RATES}
+    rates = dict(DEFAULT_ERROR_RATES)
+    for item in filter(None, value.split(',')):
+        kind, rate = item.split('=')
+        if kind not in DEFAULT_ERROR_RATES:
+            raise argparse.ArgumentTypeError(f"Unknown error kind '{kind}', expected one of {sorted(rates)}.")
+        rates[kind] = float(rate)
+    return rates
+
+
+# Local run, e.g. python ps_benchmark.py --rows 1e6 --repeat 3 --output bench_report.json
+# then, on another commit, python ps_benchmark.py --rows 1e6 --repeat 3 --compare bench_report.json
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline stages on synthetic data, locally.')
+    parser.add_argument('--rows', type=lambda value: int(float(value)), default=100000,
+                        help='Rows of each dataset, 1e4 to 1e8')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='Intermediate file format')
+    parser.add_argument('--errors', type=parse_error_rates, default=DEFAULT_ERROR_RATES,
+                        help=f"Share of rows per error kind, e.g. bad_user_id=0.05,nulls=0 or none "
+                             f"(kinds: {', '.join(DEFAULT_ERROR_RATES)})")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='Runs of each stage, the best one is reported')
+    parser.add_argument('--backend', nargs='+', default=['pandas'], help='Summary backends to benchmark')
+    parser.add_argument('--extract-workers', type=int, default=1)
+    parser.add_argument('--workbook-max-rows', type=int, default=SHEET_MAX_ROWS,
+                        help='Largest scale a workbook is generated for, extract is skipped above it')
+    parser.add_argument('--tracemalloc', action='store_true', help='Also trace Python allocations, slower')
+    parser.add_argument('--no-isolate', action='store_true', help='Run the stages in this process')
+    parser.add_argument('--workdir', default='ps_benchmark', help='Generated data and stage outputs')
+    parser.add_argument('--output', default='bench_report.json', help='JSON report')
+    parser.add_argument('--compare', help='Baseline JSON report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed slowdown over the baseline')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.rows, args.stages, args.format, args.errors, args.seed, args.repeat, args.workdir,
+                           args.backend, args.extract_workers, args.tracemalloc, args.workbook_max_rows,
+                           not args.no_isolate)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+    for result in report['results']:
+        peak = result['peak_rss_bytes'] / 2 ** 20 if result['peak_rss_bytes'] else float('nan')
+        print(f"{result['stage']:<9} {result['name']:<34} {result['seconds']:>9.3f}s {peak:>9.1f} MiB")
+    print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            comparison, regressions = compare_reports(json.load(f), report, args.tolerance)
+        for row in comparison:
+            print(f"{row['stage']:<9} {row['name']:<34} x{row.get('seconds_ratio', float('nan')):.3f} time "
+                  f"x{row.get('peak_rss_bytes_ratio', float('nan')):.3f} memory")
+        if regressions:
+            print(f"{len(regressions)} measurements regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
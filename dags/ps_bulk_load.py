@@ -0,0 +1,165 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from ps_formats import file_format_of
+
+# Named stage over the processed bucket. It authenticates through a storage integration, so no AWS keys end up in
+# the SQL text or the query history
+PROCESSED_DATA_STAGE = 'PS_STAGING_DB.STAGING.PROCESSED_DATA_STAGE'
+PROCESSED_DATA_URL = 's3://playstudios-processed-data/'
+
+# Named file formats, one per intermediate format
+file_format_names = {
+    'csv': 'PS_STAGING_DB.STAGING.PS_CSV_FORMAT',
+    'parquet': 'PS_STAGING_DB.STAGING.PS_PARQUET_FORMAT',
+}
+
+# COPY INTO accepts at most 1000 file names in FILES
+COPY_FILES_LIMIT = 1000
+
+# Columns loaded into each staging table. They are listed in every COPY, so tables with extra bookkeeping columns
+# (LOADED_AT in the merge load) still load positionally from CSV
+table_columns = {
+    'LOYALTY_EARNED_HOURLY': 'DATE, USER_ID, COUNTRY, TOTAL_LP_EARNED',
+    'PURCHASES': 'DATE, USER_ID, REVENUE, TRANSACTION_ID',
+    'LOYALTY_HOURLY_ROLLUP': 'DATE, USER_ID, COUNTRY, TOTAL_LP_EARNED, LOYALTY_ROWS',
+    'PURCHASES_HOURLY_ROLLUP': 'DATE, USER_ID, REVENUE, PURCHASES',
+}
+
+# Parquet columns selected into each staging table, in table column order
+parquet_columns = {
+    'LOYALTY_EARNED_HOURLY': "$1:date::TIMESTAMP, $1:userId::VARCHAR, $1:country::VARCHAR, $1:total_lp_earned::INT",
+    'PURCHASES': "$1:date::TIMESTAMP, $1:userId::VARCHAR, $1:revenue::DECIMAL(10, 2), $1:transaction_id::VARCHAR",
+    'LOYALTY_HOURLY_ROLLUP': ("$1:date::TIMESTAMP, $1:userId::VARCHAR, $1:country::VARCHAR, "
+                              "$1:total_lp_earned::NUMBER(38, 0), $1:loyalty_rows::INT"),
+    'PURCHASES_HOURLY_ROLLUP': "$1:date::TIMESTAMP, $1:userId::VARCHAR, $1:revenue::DECIMAL(18, 2), $1:purchases::INT",
+}
+
+
+def bulk_load_objects_command(storage_integration):
+    """
+    Creates the named file formats and the external stage used by the bulk load, if they don't exist yet.
+
+    `storage_integration` has to be created by an account admin beforehand (CREATE STORAGE INTEGRATION).
+    """
+    return f"""
+        CREATE SCHEMA IF NOT EXISTS PS_STAGING_DB.STAGING;
+
+        CREATE FILE FORMAT IF NOT EXISTS {file_format_names['csv']}
+        TYPE = CSV SKIP_HEADER = 1;
+
+        CREATE FILE FORMAT IF NOT EXISTS {file_format_names['parquet']}
+        TYPE = PARQUET;
+
+        CREATE STAGE IF NOT EXISTS {PROCESSED_DATA_STAGE}
+        URL = '{PROCESSED_DATA_URL}'
+        STORAGE_INTEGRATION = {storage_integration};
+    """
+
+
+def bulk_copy_into_command(table, files, table_suffix='', stage=PROCESSED_DATA_STAGE):
+    """
+    Builds one COPY INTO loading a list of processed files of the same format from the stage into a table.
+
+    `files` are keys relative to the processed bucket, i.e. to the stage URL. The rows go to `table` + `table_suffix`,
+    e.g. the LOYALTY_EARNED_HOURLY_BATCH table of the merge load.
+    """
+    file_format = file_format_of(files[0])
+    file_list = ', '.join(f"'{file}'" for file in files)
+    if file_format == 'parquet':
+        source = f"(SELECT {parquet_columns[table]} FROM @{stage})"
+    else:
+        source = f"@{stage}"
+
+    return f"""
+        COPY INTO PS_STAGING_DB.STAGING.{table}{table_suffix} ({table_columns[table]})
+        FROM {source}
+        FILES = ({file_list})
+        FILE_FORMAT = (FORMAT_NAME = {file_format_names[file_format]})
+    """
+
+
+class SnowflakeConnectionPool:
+    """
+    Hands out Snowflake connections opened from a hook, each connection is used by one thread at a time and
+    reused by the next one instead of paying for a new login.
+    """
+
+    def __init__(self, snowflake_hook):
+        self.snowflake_hook = snowflake_hook
+        self.idle = queue.Queue()
+        self.opened = []
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.snowflake_hook.get_conn()
+            self.opened.append(conn)
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        for conn in self.opened:
+            conn.close()
+        self.opened = []
+
+
+def run_copy(pool, command):
+    """
+    Runs a COPY INTO (or a PUT) on a pooled connection.
+
+    Returns:
+    List[dict]: One result per file, keyed by the lower case result columns (file, status, rows_parsed,
+    rows_loaded, errors_seen, first_error, ... for a COPY).
+    """
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(command)
+            columns = [column[0].lower() for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+
+def bulk_load_tables(snowflake_hook, files_by_table, max_workers=2, table_suffix='',
+                     stage=PROCESSED_DATA_STAGE):
+    """
+    Loads every table with one COPY INTO per file format (and per COPY_FILES_LIMIT files), the tables are loaded
+    concurrently on pooled connections.
+
+    Parameters:
+    files_by_table (Dict[str, List[str]]): Processed S3 keys to load, per staging table.
+    table_suffix (str): Appended to the table names to load into, see bulk_copy_into_command.
+    stage (str): Stage the keys are relative to, the processed bucket's by default.
+
+    Returns:
+    Dict[str, List[dict]]: The per-file COPY results, per table.
+    """
+    copies = []
+    for table, files in files_by_table.items():
+        for file_format in sorted({file_format_of(file) for file in files}):
+            format_files = [file for file in files if file_format_of(file) == file_format]
+            for start in range(0, len(format_files), COPY_FILES_LIMIT):
+                copies.append((table, bulk_copy_into_command(table, format_files[start:start + COPY_FILES_LIMIT],
+                                                              table_suffix, stage)))
+
+    results = {table: [] for table in files_by_table}
+    pool = SnowflakeConnectionPool(snowflake_hook)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(table, executor.submit(run_copy, pool, command)) for table, command in copies]
+            for table, future in futures:
+                results[table].extend(future.result())
+    finally:
+        pool.close()
+
+    for table, table_results in results.items():
+        rows_loaded = sum(result.get('rows_loaded') or 0 for result in table_results)
+        print(f"{table}: {len(table_results)} files, {rows_loaded} rows loaded")
+    return results
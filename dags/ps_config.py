@@ -0,0 +1,25 @@
+import os
+
+
+def get_setting(kwargs, name, default=None):
+    """
+    Looks up a pipeline setting for the current run.
+
+    The DAG run conf (Trigger DAG w/ config) wins over the environment variable of the same name,
+    which wins over `default`.
+    """
+    dag_run = kwargs.get('dag_run')
+    conf = getattr(dag_run, 'conf', None) or {}
+    if name in conf:
+        return conf[name]
+    return os.environ.get(name, default)
+
+
+def get_flag(kwargs, name, default=False):
+    """
+    Same as get_setting, but parses the value as a boolean ("true", "1", "yes", "on").
+    """
+    value = get_setting(kwargs, name, default)
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
@@ -1,14 +1,34 @@
+import importlib
 from datetime import datetime
 
 from airflow import DAG
 from airflow.operators.python import PythonOperator
 
-from ps_extract import extract
-from ps_load import run_snowflake_load_sql
-from ps_sv import data_schema_validation
-from ps_transform_dq import transform_data
 
-# Now you can import openpyxl and use it in your script
+def task_callable(path):
+    """
+    Returns a callable running 'module:function', imported on the first call.
+
+    The scheduler parses this file on every loop, the task modules (pandas, pyarrow, the S3 and Snowflake
+    providers) are only imported by the workers running their tasks.
+    """
+    module_name, function_name = path.split(':')
+
+    def call(**kwargs):
+        return getattr(importlib.import_module(module_name), function_name)(**kwargs)
+
+    call.__name__ = call.__qualname__ = function_name
+    return call
+
+
+extract = task_callable('ps_extract:extract')
+data_schema_validation = task_callable('ps_sv:data_schema_validation')
+transform_data = task_callable('ps_transform_dq:transform_data')
+validate_and_transform_data = task_callable('ps_sv_transform:validate_and_transform_data')
+list_transform_units = task_callable('ps_mapped:list_transform_units')
+transform_file = task_callable('ps_mapped:transform_file')
+gather_transform_outputs = task_callable('ps_mapped:gather_transform_outputs')
+run_snowflake_load_sql = task_callable('ps_load:run_snowflake_load_sql')
 
 dag = DAG(
     'ps_etl',
@@ -51,6 +71,86 @@ ps_load = PythonOperator(
 
 ps_extract >> ps_sv >> ps_transform_dq >> ps_load
 
-# Local Testing
+# Same pipeline with schema validation and transform fused into one task, so each raw file is parsed once
+fused_dag = DAG(
+    'ps_etl_fused',
+    default_args=dag.default_args,
+    description='Extract, validate and transform in one pass, and load data from a file to Snowflake.',
+    schedule_interval=None,
+)
+
+fused_extract = PythonOperator(
+    task_id='ps_extract',
+    python_callable=extract,
+    provide_context=True,
+    dag=fused_dag,
+)
+
+# Keeps the 'ps_transform' task id, the load step pulls the processed files from it
+fused_validate_transform = PythonOperator(
+    task_id='ps_transform',
+    python_callable=validate_and_transform_data,
+    provide_context=True,
+    dag=fused_dag,
+)
+
+fused_load = PythonOperator(
+    task_id='load_to_snowflake_table',
+    python_callable=run_snowflake_load_sql,
+    dag=fused_dag,
+)
+
+fused_extract >> fused_validate_transform >> fused_load
+
+# One mapped task instance per landing object (sheet, or partition object with partitioned_layout), validated and
+# transformed on whichever worker picks it up and retried on its own. Mapping is capped by Airflow's
+# max_map_length (1024 by default)
+mapped_dag = DAG(
+    'ps_etl_mapped',
+    default_args=dag.default_args,
+    description='Extract, validate and transform each file in its own task, and load data to Snowflake.',
+    schedule_interval=None,
+)
+
+mapped_extract = PythonOperator(
+    task_id='ps_extract',
+    python_callable=extract,
+    dag=mapped_dag,
+)
+
+mapped_list_files = PythonOperator(
+    task_id='ps_list_files',
+    python_callable=list_transform_units,
+    dag=mapped_dag,
+)
+
+mapped_transform = PythonOperator.partial(
+    task_id='ps_transform_file',
+    python_callable=transform_file,
+    retries=2,
+    dag=mapped_dag,
+).expand(op_kwargs=mapped_list_files.output)
+
+# Still runs when there is nothing to map, the mapped task is then skipped
+mapped_gather = PythonOperator(
+    task_id='ps_transform',
+    python_callable=gather_transform_outputs,
+    trigger_rule='none_failed',
+    dag=mapped_dag,
+)
+
+mapped_load = PythonOperator(
+    task_id='load_to_snowflake_table',
+    python_callable=run_snowflake_load_sql,
+    dag=mapped_dag,
+)
+
+mapped_extract >> mapped_list_files >> mapped_transform >> mapped_gather >> mapped_load
+
+# Local Testing, without Airflow's S3 and Snowflake connections. ps_local_run also has a CLI with more options
 if __name__ == "__main__":
-    ps_extract.execute(context={})
+    import os
+
+    from ps_local_run import run_local
+
+    run_local(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
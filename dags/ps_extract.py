@@ -1,53 +1,311 @@
+import csv
 import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
 from io import StringIO, BytesIO
+from xml.etree import ElementTree
 
 import pandas as pd
-from airflow.providers.amazon.aws.hooks.s3 import S3Hook
+from openpyxl import load_workbook
+
+from ps_config import get_flag, get_setting
+from ps_formats import ParquetChunkWriter, describe_file, file_extension, write_frame
+from ps_incremental import load_extract_manifest, save_pending_manifest, workbook_fingerprint
+from ps_metrics import measure_call
+from ps_partitions import PartitionedUploader
+from ps_run import RunContext, RunManifest
+from ps_upload import S3Uploader, get_s3_hook
+
+# Number of worksheet rows buffered in memory before they are flushed to the output CSV
+EXTRACT_CHUNK_SIZE = int(os.environ.get("extract_chunk_size", 50000))
+
+# Define the column sets for each dataset
+loyalty_columns = {'date', 'userId', 'country', 'total_lp_earned'}
+purchases_columns = {'date', 'userId', 'revenue', 'transaction_id'}
+
+# Local file / S3 key prefix for each dataset
+dataset_prefixes = {
+    'leh': 'Loyalty_Earned_Hourly_Data_Set',
+    'purchases': 'Purchases_Data_Set',
+}
+
+
+def read_sheet_header(worksheet):
+    """
+    Reads only the header row of a worksheet opened in read-only mode.
+
+    Returns:
+    List[str]: The column names, with trailing empty cells dropped.
+    """
+    header = next(worksheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
+    header = list(header)
+    while header and header[-1] is None:
+        header.pop()
+    return [str(column) if column is not None else '' for column in header]
+
+
+def stream_sheet_to_csv(worksheet, header, csv_path, chunk_size=EXTRACT_CHUNK_SIZE):
+    """
+    Streams the data rows of a worksheet into a CSV file in bounded chunks.
+
+    Only `chunk_size` rows are held in memory at any time, so peak memory stays flat as the sheet grows.
+
+    Returns:
+    int: The number of data rows written.
+    """
+    width = len(header)
+    row_count = 0
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file, lineterminator='\n')
+        writer.writerow(header)
+
+        chunk = []
+        for row in worksheet.iter_rows(min_row=2, values_only=True):
+            row = row[:width]
+            # read-only worksheets can report trailing blank rows, pd.read_excel skips them too
+            if all(value is None for value in row):
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                writer.writerows(chunk)
+                row_count += len(chunk)
+                chunk = []
+
+        if chunk:
+            writer.writerows(chunk)
+            row_count += len(chunk)
+
+    return row_count
+
+
+def stream_sheet_to_parquet(worksheet, header, parquet_path, chunk_size=EXTRACT_CHUNK_SIZE):
+    """
+    Streams the data rows of a worksheet into a Parquet file, one row group per chunk of `chunk_size` rows.
+
+    Cell values keep the types openpyxl reads them with, so dates land as timestamps instead of text.
+
+    Returns:
+    int: The number of data rows written.
+    """
+    width = len(header)
+    row_count = 0
+    writer = ParquetChunkWriter(parquet_path)
+    try:
+        chunk = []
+        for row in worksheet.iter_rows(min_row=2, values_only=True):
+            row = row[:width]
+            if all(value is None for value in row):
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                writer.write(pd.DataFrame.from_records(chunk, columns=header))
+                row_count += len(chunk)
+                chunk = []
+
+        # Always write the last chunk, even an empty one, so the file carries the header as its schema
+        if chunk or writer.writer is None:
+            writer.write(pd.DataFrame.from_records(chunk, columns=header))
+            row_count += len(chunk)
+    finally:
+        writer.close()
+
+    return row_count
+
+
+def classify_columns(columns):
+    """
+    Returns the dataset ('leh' or 'purchases') a sheet belongs to, based on its column names.
+    """
+    columns = set(columns)
+    # Check if the sheet has the columns for the loyalty dataset
+    if loyalty_columns.issubset(columns):
+        return 'leh'
+    # Check if the sheet has the columns for the purchases dataset
+    if purchases_columns.issubset(columns):
+        return 'purchases'
+    return None
+
+
+def list_sheet_names(file_path):
+    """
+    Lists the sheet names of a workbook from xl/workbook.xml, without parsing any worksheet or shared strings.
+    """
+    with zipfile.ZipFile(file_path) as archive:
+        root = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    return [element.get('name') for element in root.iter() if element.tag.rsplit('}', 1)[-1] == 'sheet']
+
+
+def extract_sheet(file_path, sheet_name, job_timestamp, part, extract_mode='streaming', file_format='csv'):
+    """
+    Converts a single worksheet to a local CSV or Parquet file.
+
+    Runs inside the extract process pool, so it only touches the local filesystem.
+
+    Returns:
+    Tuple[str, str]: The dataset and the output path, or None if the sheet matches neither dataset.
+    """
+    extension = file_extension(file_format)
+    if extract_mode == 'streaming':
+        # Open the workbook lazily, rows are only parsed while they are streamed out
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            worksheet = workbook[sheet_name]
+            header = read_sheet_header(worksheet)
+
+            # Classify the sheet from its header row only
+            dataset = classify_columns(header)
+            if dataset is None:
+                return None
+            csv_path = f'{dataset_prefixes[dataset]}_{job_timestamp}_{part:04d}.{extension}'
+            if file_format == 'parquet':
+                stream_sheet_to_parquet(worksheet, header, csv_path)
+            else:
+                stream_sheet_to_csv(worksheet, header, csv_path)
+        finally:
+            workbook.close()
+    else:
+        # Load the entire sheet
+        df = pd.read_excel(file_path, sheet_name=sheet_name)
+
+        dataset = classify_columns(df.columns.tolist())
+        if dataset is None:
+            return None
+        csv_path = f'{dataset_prefixes[dataset]}_{job_timestamp}_{part:04d}.{extension}'
+        write_frame(df, csv_path)
+
+    return dataset, csv_path
+
+
+def run_extract_tasks(sheet_tasks, job_timestamp, extract_mode, max_workers, file_format='csv', measurements=None):
+    """
+    Extracts every (file_path, sheet_name) pair, fanning them out over a process pool.
+
+    Results are yielded in the order of `sheet_tasks`, each one as soon as its sheet is done, so the caller can
+    upload a sheet while the next ones are extracted. When a `measurements` list is given, each sheet is measured
+    in its worker (see ps_metrics.measure_call) and its measurement appended to the list before its result.
+    """
+    call = extract_sheet if measurements is None else partial(measure_call, extract_sheet)
+
+    def measured(result):
+        if measurements is None:
+            return result
+        result, measurement = result
+        measurements.append(measurement)
+        return result
+
+    max_workers = min(max_workers, len(sheet_tasks))
+    if max_workers <= 1:
+        for part, (file_path, sheet_name) in enumerate(sheet_tasks):
+            yield measured(call(file_path, sheet_name, job_timestamp, part, extract_mode, file_format))
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(call, file_path, sheet_name, job_timestamp, part, extract_mode, file_format)
+                   for part, (file_path, sheet_name) in enumerate(sheet_tasks)]
+        for future in futures:
+            yield measured(future.result())
 
 
 def extract(**kwargs):
-    directory_path = os.environ.get("directory_path", "/opt/airflow/data/")
-    s3_hook = S3Hook(aws_conn_id='aws_default')
+    directory_path = get_setting(kwargs, "directory_path", "/opt/airflow/data/")
+    # 'streaming' reads worksheets row by row, 'pandas' loads each full sheet with pd.read_excel
+    extract_mode = get_setting(kwargs, "extract_mode", "streaming")
+    # Upper bound on extract worker processes, keep it below the Airflow worker's core count
+    max_workers = int(get_setting(kwargs, "extract_max_workers", min(4, os.cpu_count() or 1)))
+    # Intermediate format handed to every later stage: 'csv', or 'parquet' to keep the dtypes and compress
+    file_format = get_setting(kwargs, "intermediate_format", "csv")
+    file_extension(file_format)
+    # Incremental runs skip workbooks and sheets already recorded in the extract manifest,
+    # full_refresh reprocesses everything and rebuilds the staging tables
+    incremental = get_flag(kwargs, "incremental")
+    full_refresh = get_flag(kwargs, "full_refresh")
+    incremental_run = incremental and not full_refresh
+    # The rebuild load appends an incremental run to staging, which still holds the rows a modified sheet had when
+    # it was loaded, so only new sheets can be loaded that way. The merge load upserts the rows of modified sheets
+    append_only = incremental_run and get_setting(kwargs, "load_strategy", "rebuild") != 'merge'
+    # Write the landing data under date=/hour= partitions of the event date instead of one object per sheet
+    partitioned_layout = get_flag(kwargs, "partitioned_layout")
+    s3_hook = get_s3_hook()
     bucket_name = 'playstudios-landing-data'  # replace with your S3 bucket name
     job_timestamp = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
 
-    # Define the column sets for each dataset
-    loyalty_columns = {'date', 'userId', 'country', 'total_lp_earned'}
-    purchases_columns = {'date', 'userId', 'revenue', 'transaction_id'}
+    previous_manifest = load_extract_manifest(s3_hook, bucket_name) if incremental_run else {'files': {}}
+    manifest = {'files': {}}
 
-    list_raw_leh = []
-    list_raw_purchases = []
-    # Process each Excel file in the directory
-    for file_name in os.listdir(directory_path):
+    # Collect every sheet of every Excel file in the directory, sorted so the output order is deterministic
+    sheet_tasks = []
+    for file_name in sorted(os.listdir(directory_path)):
         if file_name.endswith('.xlsx'):
             file_path = os.path.join(directory_path, file_name)
-            # Load the entire Excel file
-            xls = pd.ExcelFile(file_path)
-
-            # Iterate through each sheet in the Excel file
-            for sheet_name in xls.sheet_names:
-                df = pd.read_excel(xls, sheet_name=sheet_name)
-
-                # Check if the sheet has the columns for the loyalty dataset
-                if loyalty_columns.issubset(set(df.columns.tolist())):
-                    loyalty_csv_path = f'Loyalty_Earned_Hourly_Data_Set_{job_timestamp}.csv'
-                    loyalty_key = f'Loyalty_Earned_Hourly_Data_Set/data_{job_timestamp}.csv'
-                    df.to_csv(loyalty_csv_path, index=False)
-                    s3_hook.load_file(filename=loyalty_csv_path, key=loyalty_key, bucket_name=bucket_name, replace=True)
-
-                    list_raw_leh.append(loyalty_csv_path)
-                # Check if the sheet has the columns for the purchases dataset
-                elif purchases_columns.issubset(df.columns):
-                    purchases_csv_path = f'Purchases_Data_Set_{job_timestamp}.csv'
-                    purchases_key = f'Purchases_Data_Set/data_{job_timestamp}.csv'
-                    df.to_csv(purchases_csv_path, index=False)
-                    s3_hook.load_file(filename=purchases_csv_path, key=purchases_key, bucket_name=bucket_name,
-                                      replace=True)
-
-                    list_raw_purchases.append(purchases_csv_path)
-
-    kwargs['ti'].xcom_push(key='list_raw_purchases', value=list_raw_purchases)
-    kwargs['ti'].xcom_push(key='list_raw_leh', value=list_raw_leh)
-    kwargs['ti'].xcom_push(key='job_timestamp', value=job_timestamp)
 
+            if incremental:
+                previous = previous_manifest['files'].get(file_path)
+                manifest['files'][file_path] = workbook_fingerprint(file_path, previous)
+                if incremental_run and previous and previous['sha256'] == manifest['files'][file_path]['sha256']:
+                    print('skip unchanged workbook', file_path)
+                    manifest['files'][file_path]['sheets'] = previous['sheets']
+                    continue
+
+            for sheet_name in list_sheet_names(file_path):
+                sheet_tasks.append((file_path, sheet_name))
+
+    run = RunContext(kwargs)
+    list_raw = {'leh': [], 'purchases': []}
+    landing_futures = []
+    measurements = [] if run.metrics.enabled else None
+    results = run_extract_tasks(sheet_tasks, job_timestamp, extract_mode, max_workers, file_format, measurements)
+    # Every sheet is uploaded as soon as it is extracted, concurrently with the next sheets. Leaving the block waits
+    # for the uploads and raises the first failed one
+    with run.metrics.step('extract') as step, S3Uploader() as uploader:
+        step.count('sheets', len(sheet_tasks))
+        for part, result in enumerate(results):
+            if result is None:
+                continue
+            dataset, csv_path = result
+            # Size, checksum and row count of the sheet, for the run manifest
+            entry = describe_file(csv_path)
+            if measurements is not None:
+                run.metrics.record('extract_sheet', {'dataset': dataset, 'file': csv_path}, measurements[part],
+                                   {'rows_out': entry['rows'], 'bytes_written': entry['bytes']})
+
+            if incremental:
+                file_path, sheet_name = sheet_tasks[part]
+                sheet_sha256 = entry['sha256']
+                previous_sheets = previous_manifest['files'].get(file_path, {}).get('sheets', {})
+                manifest['files'][file_path]['sheets'][sheet_name] = sheet_sha256
+                if incremental_run and previous_sheets.get(sheet_name) == sheet_sha256:
+                    print('skip unchanged sheet', file_path, sheet_name)
+                    os.remove(csv_path)
+                    continue
+                if append_only and sheet_name in previous_sheets:
+                    raise ValueError(f"Sheet '{sheet_name}' of {file_path} changed since it was loaded, the rebuild "
+                                     f"load would count its rows twice. Run it with load_strategy 'merge' or "
+                                     f"full_refresh.")
+
+            if partitioned_layout:
+                partitioned = PartitionedUploader(uploader, bucket_name, dataset_prefixes[dataset],
+                                                  f'data_{job_timestamp}_{part:04d}', file_format)
+                landing_futures.append((entry, partitioned.upload_file(csv_path, EXTRACT_CHUNK_SIZE)))
+            else:
+                key = f'{dataset_prefixes[dataset]}/data_{job_timestamp}_{part:04d}.{file_extension(file_format)}'
+                landing_futures.append((entry, [uploader.upload_file(csv_path, bucket_name, key)]))
+
+            list_raw[dataset].append(entry)
+            step.count('bytes_written', entry['bytes'])
+
+        # The landing keys of each sheet, the mapped DAG reads its input from them. The step times the uploads
+        # still running once every sheet is extracted
+        with run.metrics.step('upload_wait'):
+            for entry, futures in landing_futures:
+                entry['keys'] = uploader.wait(futures)
+
+    if incremental:
+        save_pending_manifest(s3_hook, bucket_name, manifest, job_timestamp)
+
+    # Later stages find the raw files and the run settings in the run manifest, XCom only carries its key
+    run_manifest = RunManifest(job_timestamp, incremental, incremental_run)
+    for dataset, entries in list_raw.items():
+        run_manifest.set_files('raw', dataset, entries)
+    run.start(run_manifest)
@@ -0,0 +1,203 @@
+import hashlib
+import io
+import os
+from pathlib import Path
+
+import pandas as pd
+
+# Intermediate file formats a run can pass between extract, validation, transform and load
+FORMATS = ('csv', 'parquet')
+
+
+def file_extension(file_format):
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown intermediate format '{file_format}', expected one of {FORMATS}.")
+    return file_format
+
+
+def file_format_of(path):
+    """
+    Returns the intermediate format of a file or S3 key from its extension.
+    """
+    return 'parquet' if Path(path).suffix == '.parquet' else 'csv'
+
+
+def read_frame(path, categorical_columns=()):
+    """
+    Reads an intermediate file into a DataFrame. Parquet keeps the dtypes written by the previous stage,
+    CSV is re-parsed and returns dates as strings.
+
+    `categorical_columns` are read as pandas categoricals, each distinct value is stored once.
+    """
+    categorical_columns = list(categorical_columns)
+    if file_format_of(path) == 'parquet':
+        return pd.read_parquet(path, read_dictionary=categorical_columns)
+    return pd.read_csv(path, dtype={column: 'category' for column in categorical_columns})
+
+
+def read_frame_chunks(path, chunk_size, categorical_columns=()):
+    """
+    Reads an intermediate file as a sequence of DataFrames of at most `chunk_size` rows.
+    """
+    categorical_columns = list(categorical_columns)
+    if file_format_of(path) == 'parquet':
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path, read_dictionary=categorical_columns)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size,
+                               dtype={column: 'category' for column in categorical_columns})
+
+
+def write_frame(df, path):
+    """
+    Writes a DataFrame in the intermediate format matching the extension of `path`.
+    """
+    if file_format_of(path) == 'parquet':
+        # Microsecond timestamps are what Snowflake's PARQUET file format reads as TIMESTAMP
+        df.to_parquet(path, index=False, compression='snappy', coerce_timestamps='us', allow_truncated_timestamps=True)
+    else:
+        df.to_csv(path, index=False)
+
+
+class CsvChunkWriter:
+    """
+    Appends DataFrame chunks to a single CSV file, the header is written with the first chunk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header_written = False
+
+    def write(self, df):
+        df.to_csv(self.path, index=False, mode='a' if self.header_written else 'w', header=not self.header_written)
+        self.header_written = True
+
+    def close(self):
+        pass
+
+
+class ParquetChunkWriter:
+    """
+    Appends DataFrame chunks to a single Parquet file, one row group per chunk.
+
+    The schema is fixed by the first chunk. Columns that are entirely empty in that chunk are typed as strings,
+    and categorical columns get 32-bit dictionary indices, so later chunks can still be cast to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            # Dirty sheets can mix numbers and text in one column, keep those columns as text for the DQ checks
+            df = df.apply(lambda column: column.map(lambda value: value if value is None else str(value))
+                          if column.dtype == object else column)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            schema = pa.schema([self.widen(field) for field in table.schema]).remove_metadata()
+            self.writer = pq.ParquetWriter(self.path, schema, compression='snappy', coerce_timestamps='us',
+                                           allow_truncated_timestamps=True)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    @staticmethod
+    def widen(field):
+        import pyarrow as pa
+
+        if pa.types.is_null(field.type):
+            return field.with_type(pa.string())
+        if pa.types.is_dictionary(field.type):
+            value_type = pa.string() if pa.types.is_null(field.type.value_type) else field.type.value_type
+            return field.with_type(pa.dictionary(pa.int32(), value_type))
+        return field
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ByteSink(io.RawIOBase):
+    """
+    Write-only file object keeping what is written in memory until taken. tell() counts every byte written, so
+    offsets written into a file (the Parquet footer) stay right after take().
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position += len(data)
+        return len(data)
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        return data
+
+
+class ChunkSerializer:
+    """
+    Serializes DataFrame chunks into the bytes of a single intermediate file, like CsvChunkWriter and
+    ParquetChunkWriter but handing the bytes back instead of writing them, e.g. to upload them from another
+    thread. write() returns the bytes of a chunk and close() the trailing ones (the Parquet footer).
+    """
+
+    def __init__(self, file_format):
+        self.sink = ByteSink()
+        self.writer = ParquetChunkWriter(self.sink) if file_format == 'parquet' else CsvChunkWriter(self.sink)
+
+    def write(self, df):
+        self.writer.write(df)
+        return self.sink.take()
+
+    def close(self):
+        self.writer.close()
+        return self.sink.take()
+
+
+def chunk_writer(path):
+    """
+    Returns the chunk writer for the intermediate format matching the extension of `path`.
+    """
+    if file_format_of(path) == 'parquet':
+        return ParquetChunkWriter(path)
+    return CsvChunkWriter(path)
+
+
+def describe_file(path, block_size=1024 * 1024):
+    """
+    Returns the size, sha256 and row count of an intermediate file, read once in fixed size blocks.
+
+    CSV rows are counted as lines after the header, Parquet rows come from the file footer.
+    """
+    digest = hashlib.sha256()
+    lines = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+            lines += block.count(b'\n')
+
+    if file_format_of(path) == 'parquet':
+        import pyarrow.parquet as pq
+
+        rows = pq.ParquetFile(path).metadata.num_rows
+    else:
+        rows = max(lines - 1, 0)
+    return {'path': str(path), 'bytes': os.path.getsize(path), 'sha256': digest.hexdigest(), 'rows': rows}
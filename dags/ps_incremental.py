@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+
+# The committed manifest describes every workbook/sheet that made it all the way to Snowflake
+MANIFEST_KEY = 'manifests/extract_manifest.json'
+
+
+def pending_manifest_key(job_timestamp):
+    return f'manifests/extract_manifest_pending_{job_timestamp}.json'
+
+
+def file_sha256(file_path, block_size=1024 * 1024):
+    """
+    Hashes a file in fixed size blocks so large workbooks are never read into memory at once.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def workbook_fingerprint(file_path, previous=None):
+    """
+    Returns the manifest entry for a workbook: size, mtime and sha256.
+
+    The content hash is only recomputed when size or mtime differ from `previous`.
+    """
+    stat = os.stat(file_path)
+    if previous and previous.get('size') == stat.st_size and previous.get('mtime') == stat.st_mtime:
+        sha256 = previous['sha256']
+    else:
+        sha256 = file_sha256(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256, 'sheets': {}}
+
+
+def load_extract_manifest(s3_hook, bucket_name):
+    """
+    Reads the committed manifest from S3, an empty manifest is returned on the first run.
+    """
+    if not s3_hook.check_for_key(key=MANIFEST_KEY, bucket_name=bucket_name):
+        return {'files': {}}
+    return json.loads(s3_hook.read_key(key=MANIFEST_KEY, bucket_name=bucket_name))
+
+
+def save_pending_manifest(s3_hook, bucket_name, manifest, job_timestamp):
+    """
+    Stores the manifest of this run next to the committed one. It only replaces the committed manifest once
+    the load succeeded, so a failed run is picked up again by the next one.
+    """
+    s3_hook.load_string(string_data=json.dumps(manifest, indent=2, sort_keys=True),
+                        key=pending_manifest_key(job_timestamp), bucket_name=bucket_name, replace=True)
+
+
+def commit_extract_manifest(s3_hook, bucket_name, job_timestamp):
+    pending_key = pending_manifest_key(job_timestamp)
+    if not s3_hook.check_for_key(key=pending_key, bucket_name=bucket_name):
+        print(f"No pending manifest for {job_timestamp}, nothing to commit.")
+        return
+    manifest = s3_hook.read_key(key=pending_key, bucket_name=bucket_name)
+    s3_hook.load_string(string_data=manifest, key=MANIFEST_KEY, bucket_name=bucket_name, replace=True)
+    s3_hook.delete_objects(bucket=bucket_name, keys=[pending_key])
@@ -1,28 +1,84 @@
-from airflow.providers.amazon.aws.hooks.s3 import S3Hook
-from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
+from ps_bulk_load import (PROCESSED_DATA_STAGE, bulk_load_objects_command, bulk_load_tables, parquet_columns,
+                          table_columns)
+from ps_config import get_flag, get_setting
+from ps_formats import file_format_of
+from ps_incremental import commit_extract_manifest
+from ps_merge_load import BATCH_SUFFIX, merge_batches_command, merge_staging_tables_command, refresh_summary_command
+from ps_partitions import parse_date, prune_keys
+from ps_run import RunContext
+from ps_stage_load import INTERNAL_STAGE, internal_stage_command, remove_staged_command
+from ps_summary import (HOURLY_DAILY_SUMMARY_ROLLUP_QUERY, HOURLY_DAILY_SUMMARY_TABLE, HOURLY_ROLLUP_TABLES,
+                        hourly_daily_summary_query)
 
 default_args = {
     'snowflake_conn_id': 'your_snowflake_conn_id'
 }
 
 
+def copy_into_command(table, file, aws_key_id, aws_secret_key, table_suffix=''):
+    """
+    Builds the COPY INTO statements loading one processed file from S3 into a staging table
+    (`table` + `table_suffix`).
+
+    CSV files are copied positionally. Parquet columns are named differently from the table columns (userId vs
+    USER_ID), so they are selected by name through a temporary stage over the processed bucket.
+    """
+    credentials = f"credentials=(AWS_KEY_ID='{aws_key_id}' AWS_SECRET_KEY='{aws_secret_key}')"
+    if file_format_of(file) == 'parquet':
+        return f"""
+            USE SCHEMA STAGING;
+
+            CREATE OR REPLACE TEMPORARY STAGE PROCESSED_DATA_STAGE
+            URL = 's3://playstudios-processed-data/' {credentials}
+            FILE_FORMAT = (TYPE = PARQUET);
+
+            COPY INTO {table}{table_suffix} ({table_columns[table]})
+            FROM (SELECT {parquet_columns[table]} FROM @PROCESSED_DATA_STAGE/{file})
+            FILE_FORMAT = (TYPE = PARQUET)
+        """
+
+    return f"""
+            USE SCHEMA STAGING;
+            
+            COPY INTO {table}{table_suffix} ({table_columns[table]})
+            FROM 's3://playstudios-processed-data/{file}' {credentials}
+            FILE_FORMAT = (TYPE = CSV SKIP_HEADER = 1)
+        """
+
+
 def run_snowflake_load_sql(**kwargs):
-    # Instantiate a SnowflakeHook object
-    snowflake_hook = SnowflakeHook(snowflake_conn_id='snowflake_default', database='PS_STAGING_DB')
+    # The run manifest and the hooks, shared with the other tasks of this worker process
+    run = RunContext(kwargs)
+    snowflake_hook = run.snowflake_hook('PS_STAGING_DB')
+
+    # Incremental runs only carry new or modified sheets, so they append to staging instead of recreating it.
+    # Extract only lets modified sheets through with the merge load, which upserts them
+    incremental = run.manifest.incremental
+    incremental_run = run.manifest.incremental_run
+    job_timestamp = run.manifest.job_timestamp
+    create_table = 'CREATE TABLE IF NOT EXISTS' if incremental_run else 'CREATE OR REPLACE TABLE'
+    # 'rebuild' recreates Hourly_Daily_Summary from all of staging, 'merge' upserts each run into staging and only
+    # recomputes the summary rows of the users and days it touched
+    merge_load = get_setting(kwargs, "load_strategy", "rebuild") == 'merge'
+    full_refresh = get_flag(kwargs, "full_refresh")
+    # With emit_rollups the transform step also wrote hourly rollups, the rebuild loads them instead of the rows
+    use_rollups = get_flag(kwargs, "emit_rollups") and not merge_load
+    if merge_load and get_flag(kwargs, "emit_rollups"):
+        print("The merge load upserts rows, the hourly rollups are not loaded.")
 
     # Write the SQL commands you want to execute
-    create_table_command = """
+    create_table_command = f"""
          CREATE SCHEMA IF NOT EXISTS STAGING;
          USE SCHEMA STAGING;
          
-         CREATE OR REPLACE TABLE LOYALTY_EARNED_HOURLY (
+         {create_table} LOYALTY_EARNED_HOURLY (
             DATE TIMESTAMP,
             USER_ID VARCHAR(20),
             COUNTRY CHAR(2),
             TOTAL_LP_EARNED INT
          );
 
-         CREATE OR REPLACE TABLE PURCHASES (
+         {create_table} PURCHASES (
             DATE TIMESTAMP,
             USER_ID VARCHAR(20),
             REVENUE DECIMAL(10, 2),
@@ -31,130 +87,114 @@ def run_snowflake_load_sql(**kwargs):
     """
 
     # Use the SnowflakeHook to run the SQL commands
-    snowflake_hook.run(create_table_command)
-
-    processed_files_s3_leh = kwargs['ti'].xcom_pull(task_ids='ps_transform', key='processed_files_s3_leh')
-    processed_files_s3_purchases = kwargs['ti'].xcom_pull(task_ids='ps_transform', key='processed_files_s3_purchases')
-
-    aws_hook = S3Hook(aws_conn_id='aws_default')
-    credentials = aws_hook.get_credentials()
-    aws_key_id = credentials.access_key
-    aws_secret_key = credentials.secret_key
-
-    for file in processed_files_s3_leh:
-        print('copy file', file)
-        copy_into_command = f"""
-            USE SCHEMA STAGING;
-            
-            COPY INTO LOYALTY_EARNED_HOURLY
-            FROM 's3://playstudios-processed-data/{file}' credentials=(AWS_KEY_ID='{aws_key_id}' AWS_SECRET_KEY='{aws_secret_key}')
-            FILE_FORMAT = (TYPE = CSV SKIP_HEADER = 1)
-        """
-
-        snowflake_hook.run(copy_into_command)
-
-    for file in processed_files_s3_purchases:
-        print('copy file', file)
-
-        copy_into_command = f"""
-            USE SCHEMA STAGING;
-            
-            COPY INTO PURCHASES
-            FROM 's3://playstudios-processed-data/{file}' credentials=(AWS_KEY_ID='{aws_key_id}' AWS_SECRET_KEY='{aws_secret_key}')
-            FILE_FORMAT = (TYPE = CSV SKIP_HEADER = 1)
-        """
-
-        snowflake_hook.run(copy_into_command)
-
-
-    snowflake_hook = SnowflakeHook(snowflake_conn_id='snowflake_default', database='PS_PROD_DB')
-    transformation_command = """
+    with run.metrics.step('create_tables'):
+        if merge_load:
+            # The files of this run are copied into the *_BATCH tables first
+            snowflake_hook.run(merge_staging_tables_command(full_refresh))
+            table_suffix = BATCH_SUFFIX
+        elif use_rollups:
+            snowflake_hook.run(f"""
+             CREATE SCHEMA IF NOT EXISTS STAGING;
+             USE SCHEMA STAGING;
+             {HOURLY_ROLLUP_TABLES.format(create_table=create_table)}
+            """)
+            table_suffix = ''
+        else:
+            snowflake_hook.run(create_table_command)
+            table_suffix = ''
+
+    if use_rollups:
+        files_by_table = {
+            'LOYALTY_HOURLY_ROLLUP': run.manifest.keys('rollup', 'leh'),
+            'PURCHASES_HOURLY_ROLLUP': run.manifest.keys('rollup', 'purchases'),
+        }
+    else:
+        files_by_table = {
+            'LOYALTY_EARNED_HOURLY': run.manifest.keys('processed', 'leh'),
+            'PURCHASES': run.manifest.keys('processed', 'purchases'),
+        }
+
+    # Only load the date=/hour= partitions of an event date range, e.g. to reprocess a day with the merge load.
+    # A rebuild from a range replaces the summary with the days of that range
+    start_date = parse_date(get_setting(kwargs, "partition_start_date"))
+    end_date = parse_date(get_setting(kwargs, "partition_end_date"))
+    if start_date or end_date:
+        files_by_table = {table: prune_keys(files, start_date, end_date) for table, files in files_by_table.items()}
+        print(f"Loading the partitions from {start_date or 'the start'} to {end_date or 'the end'}:",
+              {table: len(files) for table, files in files_by_table.items()})
+
+    aws_hook = run.s3_hook
+
+    # 'bulk' issues one COPY per table through the named stage, 'per_file' one COPY per file with inline credentials.
+    # 'stage' copies like 'bulk' from the internal stage the transform PUT the processed data to
+    load_mode = get_setting(kwargs, "load_mode", "per_file")
+    if load_mode in ('bulk', 'stage'):
+        if load_mode == 'stage':
+            snowflake_hook.run(internal_stage_command())
+            stage = INTERNAL_STAGE
+        else:
+            storage_integration = get_setting(kwargs, "snowflake_storage_integration", "PS_S3_INTEGRATION")
+            snowflake_hook.run(bulk_load_objects_command(storage_integration))
+            stage = PROCESSED_DATA_STAGE
+        # The tables are copied concurrently, the step covers all of them
+        with run.metrics.step('copy', mode=load_mode) as step:
+            copy_results = bulk_load_tables(snowflake_hook, files_by_table, table_suffix=table_suffix, stage=stage)
+            for results in copy_results.values():
+                step.count('files', len(results))
+                step.count('rows_loaded', sum(result.get('rows_loaded') or 0 for result in results))
+        for table, results in copy_results.items():
+            run.manifest.set_files('copy', table, results)
+        run.save_manifest()
+    else:
+        credentials = aws_hook.get_credentials()
+        aws_key_id = credentials.access_key
+        aws_secret_key = credentials.secret_key
+
+        for table, files in files_by_table.items():
+            for file in files:
+                print('copy file', file)
+                with run.metrics.step('copy', mode='per_file', table=table, file=file) as step:
+                    snowflake_hook.run(copy_into_command(table, file, aws_key_id, aws_secret_key, table_suffix))
+                    step.count('files')
+
+    if merge_load:
+        with run.metrics.step('merge'):
+            snowflake_hook.run(merge_batches_command())
+        # Also picks up rows merged by an earlier run whose summary refresh failed, they are above the watermark
+        snowflake_hook = run.snowflake_hook('PS_PROD_DB')
+        with run.metrics.step('summary'):
+            snowflake_hook.run(refresh_summary_command(full_refresh))
+        if incremental:
+            commit_extract_manifest(aws_hook, 'playstudios-landing-data', job_timestamp)
+        if load_mode == 'stage':
+            snowflake_hook.run(remove_staged_command(job_timestamp))
+        run.finish(save=False)
+        return
+
+    if incremental_run and not any(files_by_table.values()):
+        print("No new or modified data in this incremental run, Hourly_Daily_Summary is up to date.")
+        commit_extract_manifest(aws_hook, 'playstudios-landing-data', job_timestamp)
+        run.finish(save=False)
+        return
+
+    snowflake_hook = run.snowflake_hook('PS_PROD_DB')
+    summary_query = HOURLY_DAILY_SUMMARY_ROLLUP_QUERY if use_rollups else hourly_daily_summary_query()
+    transformation_command = f"""
             CREATE OR REPLACE SCHEMA PROD;
 
             USE SCHEMA PROD;
 
-            CREATE OR REPLACE TABLE Hourly_Daily_Summary (
-                app_date TIMESTAMP,
-                user_Id VARCHAR(255),
-                country VARCHAR(255),
-                user_total_lp_earned INT,
-                user_total_revenue DECIMAL(10,2),
-                user_total_purchases INT,
-                user_avg_revenue_per_purchase DECIMAL(10,2),
-                total_daily_revenue DECIMAL(10,2)
-            );
-
-            INSERT INTO Hourly_Daily_Summary( WITH PurchasesHourly AS (
-                SELECT
-                    DATE_TRUNC('hour', date) AS date_hourly,
-                    USER_ID,
-                    REVENUE,
-                    transaction_id
-                FROM
-                    PS_STAGING_DB.STAGING.PURCHASES
-
-            ),
-            LoyaltyHourly AS (
-                SELECT
-                    date,
-                    user_Id,
-                    country,
-                    total_lp_earned
-                FROM
-                    PS_STAGING_DB.STAGING.LOYALTY_EARNED_HOURLY
-            ),
-            MergedData AS (
-                SELECT
-                    l.date AS app_date,
-                    l.user_Id,
-                    l.country,
-                    l.total_lp_earned,
-                    p.revenue,
-                    p.transaction_id
-                FROM
-                    LoyaltyHourly l
-                LEFT JOIN
-                    PurchasesHourly p ON l.user_Id = p.user_Id AND l.date = p.date_hourly
-            ),
-            HourlySummary AS (
-                SELECT
-                    app_date,
-                    user_Id,
-                    country,
-                    SUM(total_lp_earned) AS user_total_lp_earned,
-                    SUM(COALESCE(revenue, 0)) AS user_total_revenue,
-                    COUNT(transaction_id) AS user_total_purchases,
-                    CASE WHEN COUNT(transaction_id) > 0
-                         THEN ROUND(SUM(COALESCE(revenue, 0)) / COUNT(transaction_id), 2)
-                         ELSE 0 END AS user_avg_revenue_per_purchase
-                FROM
-                    MergedData
-                GROUP BY
-                    app_date, user_Id, country
-            ),
-            DailyRevenue AS (
-                SELECT
-                    user_Id,
-                    DATE(app_date) AS date_daily,
-                    SUM(COALESCE(revenue, 0)) AS total_daily_revenue
-                FROM
-                    MergedData
-                GROUP BY
-                    user_Id, DATE(app_date)
-            )
-            SELECT
-                h.app_date,
-                h.user_Id,
-                h.country,
-                h.user_total_lp_earned,
-                h.user_total_revenue,
-                h.user_total_purchases,
-                h.user_avg_revenue_per_purchase,
-                d.total_daily_revenue
-            FROM
-                HourlySummary h
-            LEFT JOIN
-                DailyRevenue d ON h.user_Id = d.user_Id AND DATE(h.app_date) = d.date_daily
-             )
+            {HOURLY_DAILY_SUMMARY_TABLE.format(create_table='CREATE OR REPLACE TABLE')}
+
+            INSERT INTO Hourly_Daily_Summary( {summary_query} )
     """
-    snowflake_hook.run(transformation_command)
+    with run.metrics.step('summary'):
+        snowflake_hook.run(transformation_command)
+
+    if incremental:
+        # Everything up to Hourly_Daily_Summary succeeded, the next run can skip this run's workbooks
+        commit_extract_manifest(aws_hook, 'playstudios-landing-data', job_timestamp)
+    if load_mode == 'stage':
+        snowflake_hook.run(remove_staged_command(job_timestamp))
+    # The metrics are only saved in the manifest with the json sink, the load doesn't change it otherwise
+    run.finish(save=False)
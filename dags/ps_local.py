@@ -0,0 +1,129 @@
+import hashlib
+import os
+import shutil
+from types import SimpleNamespace
+
+import ps_upload
+
+
+class LocalS3Client:
+    """
+    Stand-in for the boto3 S3 client on the local filesystem, each bucket is a directory under `root` and each key
+    a file. Covers the calls the pipeline makes, multipart uploads included.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.multipart_uploads = {}
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _write(self, bucket, key, body):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+        return {'ETag': hashlib.md5(body).hexdigest()}
+
+    def upload_file(self, Filename, Bucket, Key):
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
+
+    def download_file(self, Bucket, Key, Filename):
+        shutil.copyfile(self.path(Bucket, Key), Filename)
+
+    def put_object(self, Bucket, Key, Body):
+        return self._write(Bucket, Key, Body.encode() if isinstance(Body, str) else bytes(Body))
+
+    def get_object(self, Bucket, Key):
+        return {'Body': open(self.path(Bucket, Key), 'rb')}
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': os.path.getsize(self.path(Bucket, Key))}
+
+    def delete_object(self, Bucket, Key):
+        os.remove(self.path(Bucket, Key))
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f'{len(self.multipart_uploads) + 1}'
+        self.multipart_uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.multipart_uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': hashlib.md5(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.multipart_uploads.pop(UploadId)
+        return self._write(Bucket, Key, b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts']))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.multipart_uploads.pop(UploadId, None)
+
+
+class LocalS3Hook:
+    """
+    Stand-in for the S3Hook over a LocalS3Client, with the hook methods the pipeline calls.
+    """
+
+    def __init__(self, root):
+        self.client = LocalS3Client(root)
+
+    def get_conn(self):
+        return self.client
+
+    def load_string(self, string_data, key, bucket_name, replace=False):
+        self.client.put_object(Bucket=bucket_name, Key=key, Body=string_data)
+
+    def read_key(self, key, bucket_name):
+        with open(self.client.path(bucket_name, key), encoding='utf-8') as f:
+            return f.read()
+
+    def check_for_key(self, key, bucket_name):
+        return os.path.isfile(self.client.path(bucket_name, key))
+
+    def delete_objects(self, bucket, keys):
+        for key in keys:
+            self.client.delete_object(Bucket=bucket, Key=key)
+
+    def get_credentials(self):
+        return SimpleNamespace(access_key='local', secret_key='local', token=None)
+
+
+def use_local_s3(root, aws_conn_id='aws_default'):
+    """
+    Points get_s3_hook / get_s3_client of this process at a LocalS3Hook rooted at `root`.
+
+    Returns:
+    LocalS3Hook: The hook.
+    """
+    hook = LocalS3Hook(root)
+    ps_upload._s3_hooks[aws_conn_id] = hook
+    ps_upload._s3_clients[aws_conn_id] = hook.get_conn()
+    return hook
+
+
+class LocalTaskInstance:
+    """
+    Stand-in for the task instance passed to the callables, XComs are kept in memory for the whole run.
+    """
+
+    def __init__(self, task_id=None, xcoms=None):
+        self.task_id = task_id
+        self.xcoms = {} if xcoms is None else xcoms
+
+    def xcom_push(self, key, value):
+        self.xcoms[(self.task_id, key)] = value
+
+    def xcom_pull(self, task_ids, key='return_value'):
+        return self.xcoms.get((task_ids, key))
+
+
+def task_kwargs(task_id, conf=None, xcoms=None):
+    """
+    Builds the keyword arguments a task callable gets: `ti`, sharing `xcoms` with the other tasks of the run, and
+    a `dag_run` carrying `conf`.
+    """
+    return {'ti': LocalTaskInstance(task_id, xcoms), 'dag_run': SimpleNamespace(conf=conf or {})}
@@ -0,0 +1,291 @@
+import argparse
+import ast
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from ps_config import get_setting
+from ps_local import task_kwargs, use_local_s3
+
+# Stages of a local run, in order. 'summary' builds Hourly_Daily_Summary from the processed files the way the load
+# does in Snowflake, with one of the ps_aggregate backends
+STAGES = ('extract', 'validate', 'transform', 'summary')
+# Task callable and task id of each stage. The fused transform validates too, 'validate' is then skipped
+stage_tasks = {
+    'extract': ('ps_extract', 'extract', 'ps_extract'),
+    'validate': ('ps_sv', 'data_schema_validation', 'ps_schema_validation'),
+    'transform': ('ps_transform_dq', 'transform_data', 'ps_transform'),
+}
+fused_transform_task = ('ps_sv_transform', 'validate_and_transform_data', 'ps_transform')
+
+PROCESSED_BUCKET = 'playstudios-processed-data'
+DAGS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def module_closure(module_name, directory=DAGS_DIR):
+    """
+    Returns the ps_* modules `module_name` imports, directly or through other ps_* modules, itself included.
+    """
+    seen = set()
+    pending = [module_name]
+    while pending:
+        name = pending.pop()
+        path = os.path.join(directory, f'{name}.py')
+        if name in seen or not os.path.exists(path):
+            continue
+        seen.add(name)
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.module:
+                pending.append(node.module.split('.')[0])
+            elif isinstance(node, ast.Import):
+                pending.extend(alias.name.split('.')[0] for alias in node.names)
+    return sorted(name for name in seen if name.startswith('ps_'))
+
+
+def code_hash(module_name, directory=DAGS_DIR):
+    """
+    Hashes the source of a module and of the ps_* modules it depends on, a change to any of them changes the hash.
+    """
+    digest = hashlib.sha256()
+    for name in module_closure(module_name, directory):
+        digest.update(name.encode())
+        with open(os.path.join(directory, f'{name}.py'), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def input_fingerprints(directory_path, previous=None):
+    """
+    Fingerprints the workbooks extract reads from `directory_path`. Hashes are only recomputed for workbooks whose
+    size or mtime changed since `previous`.
+
+    Returns:
+    Dict[str, dict]: The workbook_fingerprint entry of each workbook, per path.
+    """
+    from ps_incremental import workbook_fingerprint
+
+    previous = previous or {}
+    return {path: workbook_fingerprint(path, previous.get(path))
+            for path in (os.path.join(directory_path, name) for name in sorted(os.listdir(directory_path))
+                         if name.endswith('.xlsx'))}
+
+
+def stage_key(stage, upstream, conf, code):
+    """
+    Cache key of a stage: what it reads (the key of the stage before it, or the workbook hashes), the run conf and
+    the hash of its code.
+    """
+    payload = json.dumps({'stage': stage, 'upstream': upstream, 'conf': conf, 'code': code}, sort_keys=True,
+                         default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def snapshot(root):
+    """
+    Returns the size and mtime of every file under `root`, per relative path.
+    """
+    files = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            files[os.path.relpath(path, root).replace(os.sep, '/')] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+class StageCache:
+    """
+    On-disk cache of the outputs of the local run stages.
+
+    An entry holds what a stage changed in the run directory (local S3 buckets and working directory): the files it
+    wrote, the ones it removed and the XComs it pushed. Restoring it leaves the run directory as running the stage
+    would have, so the next stage runs on it unchanged.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def restore(self, stage, key, root, xcoms):
+        """
+        Replays the entry of a stage on `root` and `xcoms`.
+
+        Returns:
+        bool: False when there is no entry for the key.
+        """
+        entry_dir = self.entry_dir(stage, key)
+        if not os.path.exists(os.path.join(entry_dir, 'entry.json')):
+            return False
+        with open(os.path.join(entry_dir, 'entry.json')) as f:
+            entry = json.load(f)
+        for path in entry['removed']:
+            target = os.path.join(root, *path.split('/'))
+            if os.path.exists(target):
+                os.remove(target)
+        for path in entry['files']:
+            target = os.path.join(root, *path.split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(entry_dir, 'files', *path.split('/')), target)
+        for task_id, xcom_key, value in entry['xcoms']:
+            xcoms[(task_id, xcom_key)] = value
+        return True
+
+    def store(self, stage, key, root, before, xcoms_before, xcoms):
+        """
+        Saves what a stage changed since `before` (a snapshot of `root`) and `xcoms_before`.
+        """
+        after = snapshot(root)
+        entry = {
+            'stage': stage,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'files': sorted(path for path, stat in after.items() if before.get(path) != stat),
+            'removed': sorted(path for path in before if path not in after),
+            'xcoms': [[task_id, xcom_key, value] for (task_id, xcom_key), value in xcoms.items()
+                      if xcoms_before.get((task_id, xcom_key), object()) != value],
+        }
+        os.makedirs(os.path.join(self.cache_dir, stage), exist_ok=True)
+        # Written next to its final place and renamed, an interrupted run leaves no partial entry behind
+        staging_dir = tempfile.mkdtemp(prefix=f'.{key}_', dir=os.path.join(self.cache_dir, stage))
+        for path in entry['files']:
+            target = os.path.join(staging_dir, 'files', *path.split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(root, *path.split('/')), target)
+        with open(os.path.join(staging_dir, 'entry.json'), 'w') as f:
+            json.dump(entry, f, indent=2, default=str)
+        entry_dir = self.entry_dir(stage, key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(staging_dir, entry_dir)
+
+
+def run_task(stage_task, conf, xcoms):
+    module_name, function_name, task_id = stage_task
+    return getattr(importlib.import_module(module_name), function_name)(**task_kwargs(task_id, conf, xcoms))
+
+
+def run_summary(root, xcoms, backend):
+    """
+    Computes Hourly_Daily_Summary from the processed objects of the run, in place of the Snowflake load.
+
+    Returns:
+    str: The path of the summary file, under the run directory's warehouse folder.
+    """
+    from ps_aggregate import hourly_daily_summary, read_processed_files
+    from ps_formats import write_frame
+    from ps_run import RunManifest
+    from ps_upload import get_s3_hook
+
+    s3_hook = get_s3_hook()
+    manifest = RunManifest.load(s3_hook, xcoms[('ps_extract', 'run_manifest')])
+    frames = {dataset: read_processed_files([s3_hook.client.path(PROCESSED_BUCKET, key)
+                                             for key in manifest.keys('processed', dataset)])
+              for dataset in ('leh', 'purchases')}
+    summary = hourly_daily_summary(frames['leh'], frames['purchases'], backend)
+    path = os.path.join(root, 'warehouse', 'hourly_daily_summary.csv')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_frame(summary, path)
+    print(f"{len(summary)} summary rows written to {path}")
+    return path
+
+
+def run_local(directory_path, workdir='ps_local_run', cache_dir='ps_local_cache', conf=None, backend='pandas',
+              fused=False, use_cache=True, refresh=None):
+    """
+    Runs extract, schema validation, transform and the summary in this process, on local S3 buckets under
+    `workdir`. The Snowflake load is replaced by the summary, computed with the `backend` of ps_aggregate
+    ('duckdb' runs ps_summary's SQL unchanged on an embedded database).
+
+    Each stage is cached under `cache_dir`, keyed by its input (the workbook hashes, or the key of the stage before
+    it), the run conf and the source of its modules. A stage whose key is cached is restored instead of run, so
+    changing the transform reuses the extracted and validated files instead of parsing the workbooks again. Once a
+    stage runs, the ones after it run too.
+
+    Parameters:
+    directory_path (str): Directory of the workbooks, as the directory_path setting.
+    conf (dict): The DAG run conf of the tasks.
+    fused (bool): Validate and transform in one task, as ps_etl_fused.
+    use_cache (bool): Restore cached stages, the stages run are cached either way.
+    refresh (str): Run this stage and the ones after it even when cached.
+
+    Returns:
+    List[dict]: Per stage, whether it was cached, its key and its seconds.
+    """
+    conf = dict(conf or {}, directory_path=os.path.abspath(directory_path))
+    # The transform PUTs to Snowflake in that mode and the processed bucket the summary reads stays empty
+    if get_setting(task_kwargs(None, conf), "load_mode", "per_file") == 'stage':
+        raise ValueError("load_mode 'stage' needs Snowflake, the local run only supports the S3 load modes.")
+    workdir = os.path.abspath(workdir)
+    cache = StageCache(os.path.abspath(cache_dir))
+    # Every run starts empty, so a restored entry lands on the directory it was recorded on
+    shutil.rmtree(workdir, ignore_errors=True)
+    work_path = os.path.join(workdir, 'work')
+    os.makedirs(work_path)
+    use_local_s3(os.path.join(workdir, 's3'))
+
+    fingerprints_path = os.path.join(cache.cache_dir, 'inputs.json')
+    previous = None
+    if os.path.exists(fingerprints_path):
+        with open(fingerprints_path) as f:
+            previous = json.load(f)
+    fingerprints = input_fingerprints(conf['directory_path'], previous)
+    os.makedirs(cache.cache_dir, exist_ok=True)
+    with open(fingerprints_path, 'w') as f:
+        json.dump(fingerprints, f, indent=2)
+    upstream = {os.path.basename(path): entry['sha256'] for path, entry in fingerprints.items()}
+
+    xcoms = {}
+    results = []
+    cwd = os.getcwd()
+    # Tasks write their local files to the working directory
+    os.chdir(work_path)
+    try:
+        for stage in STAGES:
+            if stage == refresh:
+                use_cache = False
+            if stage == 'validate' and fused:
+                continue
+            stage_task = fused_transform_task if fused and stage == 'transform' else stage_tasks.get(stage)
+            code = code_hash(stage_task[0] if stage_task else 'ps_aggregate')
+            key = stage_key(stage, upstream, backend if stage == 'summary' else conf, code)
+            upstream = key
+
+            start = time.perf_counter()
+            cached = use_cache and cache.restore(stage, key, workdir, xcoms)
+            if not cached:
+                use_cache = False
+                before, xcoms_before = snapshot(workdir), dict(xcoms)
+                if stage_task:
+                    run_task(stage_task, conf, xcoms)
+                else:
+                    run_summary(workdir, xcoms, backend)
+                cache.store(stage, key, workdir, before, xcoms_before, xcoms)
+            seconds = round(time.perf_counter() - start, 3)
+            print(f"{stage}: {'restored from cache' if cached else 'ran'} in {seconds}s (key {key[:12]})")
+            results.append({'stage': stage, 'cached': cached, 'key': key, 'seconds': seconds})
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+# Local run, e.g. python ps_local_run.py --directory ../data --conf '{"intermediate_format": "parquet"}'
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs the pipeline locally, on local S3 buckets, without Airflow.')
+    parser.add_argument('--directory', required=True, help='Directory of the workbooks to extract')
+    parser.add_argument('--conf', type=json.loads, default={}, help='DAG run conf, as JSON')
+    parser.add_argument('--backend', choices=['pandas', 'duckdb'], default='pandas', help='Summary backend')
+    parser.add_argument('--fused', action='store_true', help='Validate and transform in one task')
+    parser.add_argument('--workdir', default='ps_local_run', help='Local buckets and task files, emptied first')
+    parser.add_argument('--cache-dir', default='ps_local_cache', help='Cached stage outputs')
+    parser.add_argument('--no-cache', action='store_true', help='Run every stage')
+    parser.add_argument('--refresh', choices=STAGES, help='Run this stage and the ones after it')
+    args = parser.parse_args()
+
+    run_local(args.directory, args.workdir, args.cache_dir, args.conf, args.backend, args.fused,
+              not args.no_cache, args.refresh)
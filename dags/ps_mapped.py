@@ -0,0 +1,128 @@
+import os
+
+from ps_aggregate import HourlyRollup
+from ps_config import get_flag, get_setting
+from ps_extract import dataset_prefixes
+from ps_formats import file_extension, file_format_of
+from ps_metrics import merge_summaries
+from ps_run import RunContext
+from ps_stage_load import processed_uploader
+from ps_sv import schema_validation_options
+from ps_sv_transform import validate_and_process_file
+from ps_transform_dq import upload_processed_files
+from ps_upload import S3Uploader, get_s3_client
+
+bucket_landing_name = 'playstudios-landing-data'
+bucket_error_name = 'playstudios-error-data'
+bucket_processed_name = 'playstudios-processed-data'
+
+# Run manifest stages written by the mapped transform
+output_stages = ('processed', 'rollup', 'schema_errors', 'dq_errors')
+
+
+def list_transform_units(**kwargs):
+    """
+    Lists the landing objects of the run, one mapped ps_transform_file instance each: a sheet, or a partition
+    object with partitioned_layout.
+
+    Returns:
+    List[dict]: The op_kwargs of each instance, its dataset, unit number and landing key.
+    """
+    run = RunContext(kwargs)
+    units = []
+    for dataset in ('leh', 'purchases'):
+        keys = [key for entry in run.manifest.files('raw', dataset) for key in entry.get('keys', [])]
+        units.extend({'dataset': dataset, 'unit': unit, 'key': key} for unit, key in enumerate(keys))
+    print(f"{len(units)} landing objects to validate and transform")
+    return units
+
+
+def transform_file(dataset, unit, key, **kwargs):
+    """
+    Validates and transforms one landing object and uploads its outputs, as a mapped task instance.
+
+    The input is downloaded from the landing bucket, so any worker can run it, and every output is named after
+    the unit. Instances don't write the run manifest, gather_transform_outputs does, so each one can fail and
+    retry on its own.
+
+    Returns:
+    dict: The dataset, per manifest stage the entries of the uploaded objects, and the metrics summary of the
+    instance (sent by gather_transform_outputs).
+    """
+    run = RunContext(kwargs)
+    # Unique per unit, process_* and the validators name their outputs after it
+    unit_timestamp = f'{run.manifest.job_timestamp}_{unit:04d}'
+    file_format = file_format_of(key)
+    raw_path = f'raw_{dataset}_{unit_timestamp}.{file_extension(file_format)}'
+    with run.metrics.step('download', dataset=dataset, key=key) as step:
+        get_s3_client().download_file(bucket_landing_name, key, raw_path)
+        step.count('bytes_read', os.path.getsize(raw_path))
+
+    chunk_size = get_setting(kwargs, "transform_chunk_size")
+    chunk_size = int(chunk_size) if chunk_size else None
+    if chunk_size and os.path.getsize(raw_path) < int(get_setting(kwargs, "transform_chunk_min_bytes", 0)):
+        chunk_size = None
+    rollup = HourlyRollup(dataset) if get_flag(kwargs, "emit_rollups") else None
+    partitioned_layout = get_flag(kwargs, "partitioned_layout")
+
+    with run.metrics.step('validate_transform', dataset=dataset, key=key) as step:
+        sv_error_path, processed_path, errors_path = validate_and_process_file(raw_path, dataset, unit_timestamp,
+                                                                               chunk_size, rollup,
+                                                                               schema_validation_options(kwargs))
+        step.count('schema_errors', int(sv_error_path is not None))
+    local_files = [raw_path, sv_error_path, processed_path, errors_path]
+
+    futures = {stage: [] for stage in output_stages}
+    with run.metrics.step('upload', dataset=dataset, key=key) as step, S3Uploader() as uploader, \
+            processed_uploader(run, uploader) as processed:
+        if processed_path:
+            futures['processed'] = upload_processed_files(processed, bucket_processed_name, dataset, [processed_path],
+                                                          partitioned_layout, chunk_size)
+        if rollup is not None:
+            rollup_path = rollup.write(unit_timestamp, file_format)
+            local_files.append(rollup_path)
+            futures['rollup'] = upload_processed_files(processed, bucket_processed_name, dataset, [rollup_path],
+                                                       partitioned_layout)
+        for stage, error_path in (('schema_errors', sv_error_path), ('dq_errors', errors_path)):
+            if error_path:
+                futures[stage] = [uploader.upload_file(error_path, bucket_error_name,
+                                                       f'{dataset_prefixes[dataset]}/{error_path}')]
+
+        outputs = {}
+        for stage, stage_futures in futures.items():
+            stage_uploader = processed if stage in ('processed', 'rollup') else uploader
+            outputs[stage] = stage_uploader.describe(stage_uploader.wait(stage_futures))
+        step.count('bytes_written', sum(entry['bytes'] for entries in outputs.values() for entry in entries))
+
+    # Workers are shared by many instances, leave nothing behind
+    for path in local_files:
+        if path and os.path.exists(path):
+            os.remove(path)
+    return {'dataset': dataset, 'outputs': outputs, 'metrics': run.metrics.summary()}
+
+
+def gather_transform_outputs(**kwargs):
+    """
+    Reduce step of the mapped transform: records the outputs of every ps_transform_file instance in the run
+    manifest, where the load finds them, and sends their metrics as one ps_transform_file summary.
+    """
+    run = RunContext(kwargs)
+    files = {stage: {'leh': [], 'purchases': []} for stage in output_stages}
+    # No instances when the run has no new data, the mapped task is skipped
+    results = kwargs['ti'].xcom_pull(task_ids='ps_transform_file') or []
+    for result in results:
+        for stage, entries in result['outputs'].items():
+            files[stage][result['dataset']].extend(entries)
+
+    # Sent once for all instances, so they don't overwrite each other's push or textfile
+    instance_metrics = merge_summaries(result.get('metrics') for result in results)
+    if instance_metrics:
+        if 'json' in run.metrics.sinks:
+            run.manifest.metrics[instance_metrics['task']] = instance_metrics
+        run.metrics.emit(instance_metrics)
+
+    for stage, datasets in files.items():
+        for dataset, entries in datasets.items():
+            run.manifest.set_files(stage, dataset, entries)
+        print(stage, {dataset: len(entries) for dataset, entries in datasets.items()})
+    run.finish()
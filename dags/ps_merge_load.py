@@ -0,0 +1,159 @@
+from ps_summary import HOURLY_DAILY_SUMMARY_TABLE, hourly_daily_summary_query
+
+# The merge load copies each run into *_BATCH tables and upserts them into staging on these keys
+BATCH_SUFFIX = '_BATCH'
+# (USER_ID, day) of staging rows a MERGE is about to update, the summary refresh recomputes them too: the update
+# can move a row to another user or day (a corrected purchase), whose summary rows would keep counting it
+REPLACED_USER_DAYS = 'REPLACED_USER_DAYS'
+
+staging_tables = {
+    'LOYALTY_EARNED_HOURLY': {
+        'columns': """
+            DATE TIMESTAMP,
+            USER_ID VARCHAR(20),
+            COUNTRY CHAR(2),
+            TOTAL_LP_EARNED INT""",
+        'key': ['DATE', 'USER_ID'],
+        'values': ['COUNTRY', 'TOTAL_LP_EARNED'],
+    },
+    'PURCHASES': {
+        'columns': """
+            DATE TIMESTAMP,
+            USER_ID VARCHAR(20),
+            REVENUE DECIMAL(10, 2),
+            TRANSACTION_ID VARCHAR(36)""",
+        'key': ['TRANSACTION_ID'],
+        'values': ['DATE', 'USER_ID', 'REVENUE'],
+    },
+}
+
+
+def merge_staging_tables_command(full_refresh=False):
+    """
+    Creates the staging tables of the merge load and empties the batch tables.
+
+    Staging rows carry LOADED_AT, the time they were last inserted or updated, which the summary refresh compares
+    with its watermark. full_refresh recreates the staging tables.
+    """
+    create_table = 'CREATE OR REPLACE TABLE' if full_refresh else 'CREATE TABLE IF NOT EXISTS'
+    commands = ['CREATE SCHEMA IF NOT EXISTS STAGING;', 'USE SCHEMA STAGING;', f"""
+         -- Kept across runs until a summary refresh consumed it, like the rows above the watermark
+         {create_table} {REPLACED_USER_DAYS} (
+            USER_ID VARCHAR(20),
+            DATE_DAILY DATE
+         );"""]
+    for table, definition in staging_tables.items():
+        commands.append(f"""
+         {create_table} {table} ({definition['columns']},
+            LOADED_AT TIMESTAMP_LTZ
+         );
+         -- Tables created by a rebuild load have no LOADED_AT yet
+         ALTER TABLE {table} ADD COLUMN IF NOT EXISTS LOADED_AT TIMESTAMP_LTZ;
+
+         CREATE OR REPLACE TRANSIENT TABLE {table}{BATCH_SUFFIX} ({definition['columns']}
+         );""")
+    return '\n'.join(commands)
+
+
+def merge_batch_command(table):
+    """
+    Upserts the batch table into its staging table. A key that appears several times in the batch is merged once.
+
+    The (USER_ID, day) of the staging rows about to be updated are recorded in REPLACED_USER_DAYS first, their
+    LOADED_AT only tells the summary refresh about the new values.
+    """
+    definition = staging_tables[table]
+    key = definition['key']
+    columns = key + definition['values']
+    on = ' AND '.join(f't.{column} = s.{column}' for column in key)
+    update = ', '.join(f'{column} = s.{column}' for column in definition['values'])
+    batch = f"""(
+            SELECT * FROM {table}{BATCH_SUFFIX}
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY {', '.join(key)} ORDER BY {', '.join(definition['values'])}) = 1
+         ) s"""
+    return f"""
+         INSERT INTO {REPLACED_USER_DAYS} (USER_ID, DATE_DAILY)
+         SELECT DISTINCT t.USER_ID, DATE(t.DATE)
+         FROM {table} t
+         JOIN {batch}
+         ON {on};
+
+         MERGE INTO {table} t
+         USING {batch}
+         ON {on}
+         WHEN MATCHED THEN UPDATE SET {update}, LOADED_AT = CURRENT_TIMESTAMP()
+         WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}, LOADED_AT)
+            VALUES ({', '.join(f's.{column}' for column in columns)}, CURRENT_TIMESTAMP());
+    """
+
+
+def merge_batches_command():
+    return 'USE SCHEMA STAGING;\n' + '\n'.join(merge_batch_command(table) for table in staging_tables)
+
+
+def refresh_summary_command(full_refresh=False):
+    """
+    Recomputes the Hourly_Daily_Summary rows of the (user, day) pairs touched since the last refresh.
+
+    A daily total depends on every hour of the user's day, so whole user-days are deleted and recomputed. The
+    watermark table stores the highest staging LOADED_AT already summarized; only staging rows above it are
+    considered, plus the user-days MERGEs moved rows out of (REPLACED_USER_DAYS). The watermark is advanced and
+    those user-days cleared in the same transaction as the summary rows. full_refresh recreates the summary
+    and the watermark, so every user-day is recomputed.
+    """
+    create_table = 'CREATE OR REPLACE TABLE' if full_refresh else 'CREATE TABLE IF NOT EXISTS'
+    epoch = "'1970-01-01'::TIMESTAMP_LTZ"
+    source_filter = """WHERE EXISTS (
+            SELECT 1 FROM Affected_User_Days a WHERE a.user_Id = src.USER_ID AND a.date_daily = DATE(src.date)
+        )"""
+    return f"""
+            CREATE SCHEMA IF NOT EXISTS PROD;
+
+            USE SCHEMA PROD;
+
+            {HOURLY_DAILY_SUMMARY_TABLE.format(create_table=create_table)}
+
+            {create_table} Hourly_Daily_Summary_Watermark (
+                loaded_at TIMESTAMP_LTZ
+            );
+
+            -- Staging rows loaded after the last refresh, up to what is in staging right now
+            CREATE OR REPLACE TEMPORARY TABLE Summary_Refresh_Window AS
+            SELECT
+                COALESCE((SELECT MAX(loaded_at) FROM Hourly_Daily_Summary_Watermark), {epoch}) AS low,
+                GREATEST(
+                    COALESCE((SELECT MAX(LOADED_AT) FROM PS_STAGING_DB.STAGING.LOYALTY_EARNED_HOURLY), {epoch}),
+                    COALESCE((SELECT MAX(LOADED_AT) FROM PS_STAGING_DB.STAGING.PURCHASES), {epoch})
+                ) AS high;
+
+            CREATE OR REPLACE TEMPORARY TABLE Affected_User_Days AS
+            SELECT s.USER_ID AS user_Id, DATE(s.DATE) AS date_daily
+            FROM PS_STAGING_DB.STAGING.LOYALTY_EARNED_HOURLY s, Summary_Refresh_Window w
+            WHERE s.LOADED_AT > w.low AND s.LOADED_AT <= w.high
+            UNION
+            SELECT s.USER_ID, DATE(s.DATE)
+            FROM PS_STAGING_DB.STAGING.PURCHASES s, Summary_Refresh_Window w
+            WHERE s.LOADED_AT > w.low AND s.LOADED_AT <= w.high
+            UNION
+            -- Where updated rows were before the MERGE
+            SELECT USER_ID, DATE_DAILY
+            FROM PS_STAGING_DB.STAGING.{REPLACED_USER_DAYS};
+
+            BEGIN;
+
+            DELETE FROM Hourly_Daily_Summary h
+            USING Affected_User_Days a
+            WHERE h.user_Id = a.user_Id AND DATE(h.app_date) = a.date_daily;
+
+            INSERT INTO Hourly_Daily_Summary( {hourly_daily_summary_query(source_filter)} );
+
+            DELETE FROM Hourly_Daily_Summary_Watermark;
+
+            INSERT INTO Hourly_Daily_Summary_Watermark SELECT high FROM Summary_Refresh_Window;
+
+            DELETE FROM PS_STAGING_DB.STAGING.{REPLACED_USER_DAYS} r
+            USING Affected_User_Days a
+            WHERE r.USER_ID = a.user_Id AND r.DATE_DAILY = a.date_daily;
+
+            COMMIT;
+    """
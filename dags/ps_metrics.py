@@ -0,0 +1,326 @@
+import contextvars
+import os
+import resource
+import socket
+import sys
+import time
+import urllib.request
+
+from ps_config import get_setting
+
+# Prefix of the StatsD and OpenMetrics metric names
+METRIC_PREFIX = 'ps_etl'
+METRIC_SINKS = ('json', 'statsd', 'openmetrics')
+# Labels that identify one file, left out of the totals sent to StatsD / OpenMetrics to bound their cardinality
+FILE_LABELS = ('file', 'key')
+
+
+def proc_status_bytes(field):
+    """
+    Returns a memory field of /proc/self/status (VmRSS, VmHWM) in bytes, None outside Linux.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS of the process (VmHWM) to its current RSS, Linux only.
+
+    Returns:
+    bool: Whether it was reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def maxrss_bytes(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def cpu_seconds():
+    """
+    User and system CPU seconds of the process and of its finished child processes (e.g. the extract pool).
+    """
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+class NullStep:
+    """
+    Step of disabled metrics, every call is a no-op.
+    """
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def count(self, counter, value=1):
+        pass
+
+
+NULL_STEP = NullStep()
+_current_step = contextvars.ContextVar('ps_metrics_step', default=NULL_STEP)
+
+
+def current_step():
+    """
+    Returns the innermost step being measured in this thread, NULL_STEP when there is none or metrics are off.
+    """
+    return _current_step.get()
+
+
+class Step:
+    """
+    One measured step of a task: wall and CPU seconds, peak RSS while it ran and named counters (rows_in,
+    rows_out, rows_rejected_<rule>, bytes_read, bytes_written...). Steps nest, the peak RSS of an outer step
+    includes its inner steps.
+    """
+    enabled = True
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.counters = {}
+        self.peak_rss = 0
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def __enter__(self):
+        parent = _current_step.get()
+        if parent.enabled:
+            # The peak reset below would lose the parent's peak so far
+            parent.peak_rss = max(parent.peak_rss, proc_status_bytes('VmHWM') or 0)
+        self.parent = parent
+        self.peak_reset = reset_peak_rss()
+        self.token = _current_step.set(self)
+        self.cpu_start = cpu_seconds()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        _current_step.reset(self.token)
+        peak = proc_status_bytes('VmHWM') if self.peak_reset else maxrss_bytes()
+        self.peak_rss = max(self.peak_rss, peak or 0)
+        if self.parent.enabled:
+            self.parent.peak_rss = max(self.parent.peak_rss, self.peak_rss)
+        self.metrics.record(self.name, self.labels, {
+            'seconds': seconds,
+            'cpu_seconds': cpu_seconds() - self.cpu_start,
+            'peak_rss_bytes': self.peak_rss,
+        }, self.counters, exc_type is not None)
+        return False
+
+
+def measure_call(fn, *args):
+    """
+    Calls fn(*args) and measures it, for work done in another process (e.g. the extract pool) where the steps of
+    the task can't be recorded. Metrics.record records the measurement back in the task.
+
+    Returns:
+    Tuple[object, dict]: The result, and the seconds, cpu_seconds and peak_rss_bytes of the call.
+    """
+    peak_reset = reset_peak_rss()
+    cpu_start = cpu_seconds()
+    start = time.perf_counter()
+    result = fn(*args)
+    measurement = {
+        'seconds': time.perf_counter() - start,
+        'cpu_seconds': cpu_seconds() - cpu_start,
+        'peak_rss_bytes': (proc_status_bytes('VmHWM') if peak_reset else maxrss_bytes()) or 0,
+    }
+    return result, measurement
+
+
+class NullMetrics:
+    """
+    Metrics of a task run without any sink: steps cost a method call and nothing is recorded.
+    """
+    enabled = False
+    sinks = ()
+
+    def step(self, name, **labels):
+        return NULL_STEP
+
+    def record(self, name, labels, measurement, counters=None, failed=False):
+        pass
+
+    def summary(self):
+        return None
+
+    def emit(self, summary=None):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def step_totals(records):
+    """
+    Sums the records of the same step and labels (file labels left out): seconds, CPU seconds and counters are
+    added up, peak RSS is the largest.
+
+    Returns:
+    List[dict]: One entry per step and labels.
+    """
+    totals = {}
+    for record in records:
+        labels = {name: value for name, value in record['labels'].items() if name not in FILE_LABELS}
+        total = totals.setdefault((record['step'], tuple(sorted(labels.items()))), {
+            'step': record['step'], 'labels': labels, 'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+            'peak_rss_bytes': 0, 'counters': {}})
+        total['count'] += 1
+        total['seconds'] = round(total['seconds'] + record['seconds'], 4)
+        total['cpu_seconds'] = round(total['cpu_seconds'] + record['cpu_seconds'], 4)
+        total['peak_rss_bytes'] = max(total['peak_rss_bytes'], record['peak_rss_bytes'] or 0)
+        for counter, value in record['counters'].items():
+            total['counters'][counter] = total['counters'].get(counter, 0) + value
+    return list(totals.values())
+
+
+def merge_summaries(summaries):
+    """
+    Merges the metrics summaries of several runs of a task, e.g. the instances of a mapped task.
+    """
+    summaries = [summary for summary in summaries if summary]
+    if not summaries:
+        return None
+    records = [record for summary in summaries for record in summary['records']]
+    return {'task': summaries[0]['task'], 'records': records, 'totals': step_totals(records)}
+
+
+class Metrics:
+    """
+    Records the steps of one task run and sends them to its sinks:
+        json         the run summary, stored in the run manifest under `metrics` (see RunContext.finish)
+        statsd       per step totals over UDP, e.g. ps_etl.ps_transform.transform.leh.seconds:812|ms
+        openmetrics  per step totals in the text exposition format, pushed to a Pushgateway or written for a
+                     node_exporter textfile collector
+
+        with metrics.step('transform', dataset='leh', file=file) as step:
+            step.count('rows_in', len(df))
+    """
+    enabled = True
+
+    def __init__(self, task, sinks, kwargs=None):
+        self.task = task
+        self.sinks = sinks
+        self.kwargs = kwargs or {}
+        self.records = []
+
+    def step(self, name, **labels):
+        return Step(self, name, labels)
+
+    def record(self, name, labels, measurement, counters=None, failed=False):
+        """
+        Records a step measured elsewhere (see measure_call).
+        """
+        self.records.append({
+            'step': name,
+            'labels': labels,
+            'seconds': round(measurement['seconds'], 4),
+            'cpu_seconds': round(measurement['cpu_seconds'], 4),
+            'peak_rss_bytes': measurement['peak_rss_bytes'],
+            'counters': counters or {},
+            'failed': failed,
+        })
+
+    def summary(self):
+        return {'task': self.task, 'records': self.records, 'totals': step_totals(self.records)}
+
+    def emit(self, summary=None):
+        """
+        Sends the totals of a summary, this task's by default, to the StatsD and OpenMetrics sinks. A metrics
+        backend being down never fails the task.
+        """
+        summary = summary or self.summary()
+        for sink, send in (('statsd', self.send_statsd), ('openmetrics', self.send_openmetrics)):
+            if sink in self.sinks:
+                try:
+                    send(summary['task'], summary['totals'])
+                except OSError as e:
+                    print(f"Metrics were not sent to {sink}: {e}")
+
+    def statsd_lines(self, task, totals):
+        prefix = get_setting(self.kwargs, "statsd_prefix", METRIC_PREFIX)
+        lines = []
+        for total in totals:
+            name = '.'.join([prefix, task, total['step'], *map(str, total['labels'].values())])
+            lines.append(f"{name}.seconds:{round(total['seconds'] * 1000)}|ms")
+            lines.append(f"{name}.cpu_seconds:{round(total['cpu_seconds'] * 1000)}|ms")
+            lines.append(f"{name}.peak_rss_bytes:{total['peak_rss_bytes']}|g")
+            lines.extend(f"{name}.{counter}:{value}|c" for counter, value in total['counters'].items())
+        return lines
+
+    def send_statsd(self, task, totals):
+        address = (get_setting(self.kwargs, "statsd_host", "localhost"),
+                   int(get_setting(self.kwargs, "statsd_port", 8125)))
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            # One datagram per metric stays under any MTU
+            for line in self.statsd_lines(task, totals):
+                sock.sendto(line.encode(), address)
+
+    def openmetrics_text(self, task, totals):
+        samples = {}
+        for total in totals:
+            labels = dict(task=task, step=total['step'], **total['labels'])
+            label_text = ','.join(f'{name}="{value}"' for name, value in labels.items())
+            values = dict(step_seconds=total['seconds'], step_cpu_seconds=total['cpu_seconds'],
+                          step_peak_rss_bytes=total['peak_rss_bytes'], **total['counters'])
+            for metric, value in values.items():
+                samples.setdefault(f'{METRIC_PREFIX}_{metric}', []).append(f'{{{label_text}}} {value}')
+
+        lines = []
+        for metric, metric_samples in samples.items():
+            lines.append(f'# TYPE {metric} gauge')
+            lines.extend(f'{metric}{sample}' for sample in metric_samples)
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def send_openmetrics(self, task, totals):
+        text = self.openmetrics_text(task, totals).encode()
+        pushgateway_url = get_setting(self.kwargs, "pushgateway_url")
+        if pushgateway_url:
+            # The Pushgateway keeps the last push of each job and task
+            request = urllib.request.Request(f'{pushgateway_url.rstrip("/")}/metrics/job/{METRIC_PREFIX}/task/'
+                                             f'{task}', data=text, method='PUT',
+                                             headers={'Content-Type': 'text/plain; version=0.0.4'})
+            urllib.request.urlopen(request, timeout=10).close()
+        else:
+            directory = get_setting(self.kwargs, "metrics_textfile_dir", ".")
+            path = os.path.join(directory, f'{METRIC_PREFIX}_{task}.prom')
+            # Written aside and renamed, the collector never reads a partial file
+            with open(path + '.tmp', 'wb') as f:
+                f.write(text)
+            os.replace(path + '.tmp', path)
+
+
+def task_metrics(kwargs, task):
+    """
+    Returns the Metrics of a task run, or NULL_METRICS when the `metrics` setting names no sink.
+
+    `metrics` is a comma separated list of METRIC_SINKS, e.g. "json,statsd".
+    """
+    sinks = [sink.strip() for sink in (get_setting(kwargs, "metrics") or '').split(',') if sink.strip()]
+    unknown = set(sinks) - set(METRIC_SINKS)
+    if unknown:
+        raise ValueError(f"Unknown metrics sinks {sorted(unknown)}, expected some of {METRIC_SINKS}.")
+    return Metrics(task, sinks, kwargs) if sinks else NULL_METRICS
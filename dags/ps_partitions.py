@@ -0,0 +1,207 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import deque
+from datetime import date
+
+import pandas as pd
+
+from ps_formats import chunk_writer, file_extension, read_frame_chunks
+
+# Hive's partition value for rows without a parseable date
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# Objects are written under Hive-style partitions of their event date and hour:
+# <prefix>/date=YYYY-MM-DD/hour=HH/<name>_NNNN.<ext>
+PARTITION_PATTERN = re.compile(
+    rf'(?:^|/)date=(\d{{4}}-\d{{2}}-\d{{2}}|{DEFAULT_PARTITION})/hour=(\d{{2}}|{DEFAULT_PARTITION})/')
+# Upper bound on the rows of each partition object, larger partitions are split into several objects
+MAX_PARTITION_ROWS = int(os.environ.get("max_partition_rows", 1000000))
+# Partition uploads queued at once by a PartitionedUploader
+MAX_PARTITION_UPLOADS_IN_FLIGHT = int(os.environ.get("max_partition_uploads_in_flight", 16))
+
+
+def partition_path(prefix, day, hour):
+    return f'{prefix}/date={day}/hour={hour}'
+
+
+def partition_of(key):
+    """
+    Returns the (date, hour) partition values of a key or path, or None for keys outside the partitioned layout.
+    """
+    match = PARTITION_PATTERN.search(key)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def partition_frames(df, max_rows=MAX_PARTITION_ROWS):
+    """
+    Splits a frame by the event date and hour of its `date` column.
+
+    Yields:
+    Tuple[str, str, DataFrame]: The date and hour partition values and at most `max_rows` rows of the partition.
+    """
+    hours = pd.to_datetime(df['date'], errors='coerce').dt.floor('h')
+    for hour, frame in df.groupby(hours, sort=True, dropna=False):
+        if pd.isna(hour):
+            day, hour = DEFAULT_PARTITION, DEFAULT_PARTITION
+        else:
+            day, hour = hour.strftime('%Y-%m-%d'), hour.strftime('%H')
+        for start in range(0, len(frame), max_rows):
+            yield day, hour, frame.iloc[start:start + max_rows]
+
+
+def in_date_range(key, start_date=None, end_date=None):
+    """
+    Tells whether a partitioned key falls between two event dates (inclusive, 'YYYY-MM-DD', None for open ends).
+
+    Keys outside the partitioned layout can't be pruned and are always in range.
+    """
+    partition = partition_of(key)
+    if partition is None:
+        return True
+    day = partition[0]
+    if day == DEFAULT_PARTITION:
+        # Rows without a date belong to no range, they're only read when no range is requested
+        return start_date is None and end_date is None
+    return (start_date is None or day >= str(start_date)) and (end_date is None or day <= str(end_date))
+
+
+def prune_keys(keys, start_date=None, end_date=None):
+    """
+    Keeps the keys (or paths) of the partitions between `start_date` and `end_date`, see in_date_range.
+    """
+    return [key for key in keys if in_date_range(key, start_date, end_date)]
+
+
+def local_partition_files(root, start_date=None, end_date=None):
+    """
+    Lists the files of a local partitioned directory (e.g. an `aws s3 sync` of a dataset prefix), only the date=
+    directories in range are walked.
+    """
+    files = []
+    for entry in sorted(os.listdir(root)):
+        path = os.path.join(root, entry)
+        if entry.startswith('date=') and os.path.isdir(path):
+            if not in_date_range(f'{entry}/hour=00/', start_date, end_date):
+                continue
+            for directory, _, names in sorted(os.walk(path)):
+                files.extend(os.path.join(directory, name) for name in sorted(names))
+        elif os.path.isfile(path):
+            files.append(path)
+    return files
+
+
+def parse_date(value):
+    """
+    Validates a 'YYYY-MM-DD' range bound, None and '' mean an open end.
+    """
+    return date.fromisoformat(value).isoformat() if value else None
+
+
+class PartitionedUploader:
+    """
+    Uploads frames to a dataset prefix split into date=/hour= partitions, through an S3Uploader.
+
+    Objects are named `<name>_NNNN` with a counter per partition, so the frames of several files or chunks of a run
+    never overwrite each other, and hold at most `max_rows` rows. At most `max_in_flight` uploads are queued, the
+    caller waits for the oldest one beyond that, so parsing can't run ahead of the uploads with frames piling up
+    in memory.
+    """
+
+    def __init__(self, uploader, bucket_name, prefix, name, file_format, max_rows=MAX_PARTITION_ROWS,
+                 max_in_flight=MAX_PARTITION_UPLOADS_IN_FLIGHT):
+        self.uploader = uploader
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.name = name
+        self.extension = file_extension(file_format)
+        self.max_rows = max_rows
+        self.max_in_flight = max_in_flight
+        self.counters = {}
+        self.in_flight = deque()
+
+    def next_key(self, day, hour):
+        number = self.counters.get((day, hour), 0)
+        self.counters[(day, hour)] = number + 1
+        return f'{partition_path(self.prefix, day, hour)}/{self.name}_{number:04d}.{self.extension}'
+
+    def _submit(self, upload, *args):
+        while len(self.in_flight) >= self.max_in_flight:
+            self.in_flight.popleft().result()
+        future = upload(*args)
+        self.in_flight.append(future)
+        return future
+
+    def upload_frame(self, df):
+        """
+        Returns:
+        List[Future]: Futures of the uploaded keys.
+        """
+        return [self._submit(self.uploader.upload_frame, frame, self.bucket_name, self.next_key(day, hour))
+                for day, hour, frame in partition_frames(df, self.max_rows)]
+
+    def upload_file(self, path, chunk_size=MAX_PARTITION_ROWS):
+        """
+        Reads a local file `chunk_size` rows at a time and appends the rows of each partition to a local file of
+        its own, uploaded once it holds `max_rows` rows or the whole file is read. A partition gets one object
+        however many chunks its rows are in, and only one chunk is in memory at a time.
+
+        Returns:
+        List[Future]: Futures of the uploaded keys.
+        """
+        directory = tempfile.mkdtemp(prefix='ps_partitions_')
+        parts = {}
+        futures = []
+
+        def finish(partition):
+            part = parts.pop(partition)
+            part['writer'].close()
+            futures.append(self._submit(self.uploader.upload_file, part['path'], self.bucket_name, part['key']))
+
+        try:
+            for chunk in read_frame_chunks(path, chunk_size):
+                for day, hour, frame in partition_frames(chunk, self.max_rows):
+                    while len(frame):
+                        if (day, hour) not in parts:
+                            key = self.next_key(day, hour)
+                            # Named like the object, so a stage PUT doesn't have to copy it
+                            part_path = os.path.join(directory, *key.split('/'))
+                            os.makedirs(os.path.dirname(part_path), exist_ok=True)
+                            parts[(day, hour)] = {'key': key, 'path': part_path, 'rows': 0,
+                                                  'writer': chunk_writer(part_path)}
+                        part = parts[(day, hour)]
+                        rows = frame.iloc[:self.max_rows - part['rows']]
+                        part['writer'].write(rows)
+                        part['rows'] += len(rows)
+                        frame = frame.iloc[len(rows):]
+                        if part['rows'] >= self.max_rows:
+                            finish((day, hour))
+            for partition in list(parts):
+                finish(partition)
+        finally:
+            for part in parts.values():
+                part['writer'].close()
+            remove_when_done(directory, futures)
+        return futures
+
+
+def remove_when_done(directory, futures):
+    """
+    Removes a directory of local files once their uploads are done, whether they succeeded or not.
+    """
+    if not futures:
+        shutil.rmtree(directory, ignore_errors=True)
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for future in futures:
+        future.add_done_callback(done)
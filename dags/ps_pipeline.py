@@ -0,0 +1,137 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+
+from ps_metrics import current_step
+
+# Batches held between two stages. A stage blocks while the queue to the next one is full (backpressure), so a run
+# holds a few batches per stage in memory whatever the file size
+PIPELINE_QUEUE_SIZE = int(os.environ.get("pipeline_queue_size", 2))
+# Rows per batch of a pipelined transform, when transform_chunk_size isn't set
+PIPELINE_CHUNK_ROWS = int(os.environ.get("pipeline_chunk_rows", 100000))
+# How often a blocked stage checks whether another stage failed
+_POLL_SECONDS = 0.1
+_END = object()
+
+
+class PipelineStage:
+    """
+    One stage of a pipeline. `fn` takes a batch and returns the batch for the next stage, or None to pass nothing
+    on. `flush`, if given, is called after the last batch and its result is passed on too (e.g. a file footer).
+    """
+
+    def __init__(self, name, fn, flush=None):
+        self.name = name
+        self.fn = fn
+        self.flush = flush
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def run_pipeline(source, stages, maxsize=PIPELINE_QUEUE_SIZE):
+    """
+    Runs a source of batches and the stages processing them concurrently, each in its own thread, connected by
+    queues of at most `maxsize` batches. While one batch is parsed the previous one is checked and the one before
+    it written, so the run takes about as long as its slowest stage instead of the sum of all of them.
+
+    The first stage to fail stops the others, and its error is raised once every thread is done. With metrics on,
+    the seconds each stage spent working are counted on the current step as <stage>_seconds.
+
+    Parameters:
+    source (iterable): The batches, iterated in a thread of its own as the 'read' stage.
+    stages (List[PipelineStage]): The stages, in order.
+
+    Returns:
+    List: What the last stage returned, None left out.
+    """
+    queues = [queue.Queue(maxsize) for _ in stages]
+    failed = threading.Event()
+    errors = []
+    results = []
+    busy = {'read': 0.0, **{stage.name: 0.0 for stage in stages}}
+
+    def put(batches, batch):
+        while not failed.is_set():
+            try:
+                batches.put(batch, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+        raise _Cancelled()
+
+    def get(batches):
+        while not failed.is_set():
+            try:
+                return batches.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                pass
+        raise _Cancelled()
+
+    def read():
+        batches = iter(source)
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = next(batches, _END)
+                busy['read'] += time.perf_counter() - start
+                put(queues[0], batch)
+                if batch is _END:
+                    return
+        finally:
+            # Closes the file of a generator left unfinished
+            getattr(batches, 'close', lambda: None)()
+
+    def work(index, stage):
+        output = queues[index + 1] if index + 1 < len(stages) else None
+
+        def call(fn, *args):
+            start = time.perf_counter()
+            batch = fn(*args)
+            busy[stage.name] += time.perf_counter() - start
+            if batch is None:
+                return
+            if output is None:
+                results.append(batch)
+            else:
+                put(output, batch)
+
+        while True:
+            batch = get(queues[index])
+            if batch is _END:
+                break
+            call(stage.fn, batch)
+        if stage.flush is not None:
+            call(stage.flush)
+        if output is not None:
+            put(output, _END)
+
+    def run(target, *args):
+        try:
+            target(*args)
+        except _Cancelled:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+
+    # Each thread gets a copy of the caller's context, so the stages count on the caller's metrics step
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(run, read), name='pipeline-read')]
+    threads.extend(threading.Thread(target=contextvars.copy_context().run, args=(run, work, index, stage),
+                                    name=f'pipeline-{stage.name}')
+                   for index, stage in enumerate(stages))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    step = current_step()
+    if step.enabled:
+        for name, seconds in busy.items():
+            step.count(f'{name}_seconds', round(seconds, 4))
+    return results
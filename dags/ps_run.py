@@ -0,0 +1,158 @@
+import json
+
+from ps_metrics import task_metrics
+from ps_upload import get_s3_hook
+
+# Run manifests live next to the extract manifests, one per run
+RUN_MANIFEST_BUCKET = 'playstudios-landing-data'
+
+_snowflake_hooks = {}
+
+
+def run_manifest_key(job_timestamp):
+    return f'manifests/run_manifest_{job_timestamp}.json'
+
+
+def get_snowflake_hook(database, snowflake_conn_id='snowflake_default'):
+    """
+    Returns the SnowflakeHook of a connection and database, created once per process.
+    """
+    if (snowflake_conn_id, database) not in _snowflake_hooks:
+        # Imported with the first hook, like the S3 provider in get_s3_hook
+        from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
+
+        _snowflake_hooks[(snowflake_conn_id, database)] = SnowflakeHook(snowflake_conn_id=snowflake_conn_id,
+                                                                        database=database)
+    return _snowflake_hooks[(snowflake_conn_id, database)]
+
+
+class RunManifest:
+    """
+    Inventory of the files of one run, stored as a single JSON object in S3 instead of growing XCom lists.
+
+    Files are recorded per stage and dataset (or table), each entry holds the local `path` and/or S3 `key` of the
+    file with its `bytes`, `sha256` and `rows` when known. Stages:
+        raw            extracted sheets, per dataset, with the `keys` of their landing objects
+        schema_errors  schema validation error files in the error bucket, per dataset
+        processed      processed objects in the processed bucket, per dataset
+        rollup         hourly rollup objects (emit_rollups), per dataset
+        dq_errors      DQ error files in the error bucket, per dataset
+        copy           COPY INTO results, per staging table
+    `metrics` holds the metrics summary of each task, with the json metrics sink (see ps_metrics).
+    """
+
+    def __init__(self, job_timestamp, incremental=False, incremental_run=False, stages=None, metrics=None):
+        self.job_timestamp = job_timestamp
+        self.incremental = incremental
+        self.incremental_run = incremental_run
+        self.stages = stages or {}
+        self.metrics = metrics or {}
+
+    def set_files(self, stage, dataset, entries):
+        # Replaces the entries, so a retried task doesn't record its files twice
+        self.stages.setdefault(stage, {})[dataset] = list(entries)
+
+    def files(self, stage, dataset):
+        return self.stages.get(stage, {}).get(dataset, [])
+
+    def paths(self, stage, dataset):
+        return [entry['path'] for entry in self.files(stage, dataset)]
+
+    def keys(self, stage, dataset):
+        return [entry['key'] for entry in self.files(stage, dataset)]
+
+    def total(self, stage, dataset, field):
+        """
+        Sums a numeric field (bytes, rows) over the entries of a stage, unknown values count as 0.
+        """
+        return sum(entry.get(field) or 0 for entry in self.files(stage, dataset))
+
+    def to_dict(self):
+        return {
+            'job_timestamp': self.job_timestamp,
+            'incremental': self.incremental,
+            'incremental_run': self.incremental_run,
+            'stages': self.stages,
+            'metrics': self.metrics,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['job_timestamp'], data.get('incremental', False), data.get('incremental_run', False),
+                   data.get('stages'), data.get('metrics'))
+
+    def save(self, s3_hook, bucket_name=RUN_MANIFEST_BUCKET):
+        """
+        Writes the manifest to S3.
+
+        Returns:
+        str: Its key.
+        """
+        key = run_manifest_key(self.job_timestamp)
+        s3_hook.load_string(string_data=json.dumps(self.to_dict(), indent=2, sort_keys=True), key=key,
+                            bucket_name=bucket_name, replace=True)
+        return key
+
+    @classmethod
+    def load(cls, s3_hook, key, bucket_name=RUN_MANIFEST_BUCKET):
+        return cls.from_dict(json.loads(s3_hook.read_key(key=key, bucket_name=bucket_name)))
+
+
+class RunContext:
+    """
+    What a task knows about its run: the run manifest, the hooks and the task's metrics.
+
+    The only XCom is the manifest key pushed by ps_extract. The manifest is read from S3 on first use, and the
+    hooks come from per-process caches, so tasks running in the same worker process share them.
+    """
+
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self._manifest = None
+        self._metrics = None
+
+    @property
+    def s3_hook(self):
+        return get_s3_hook()
+
+    def snowflake_hook(self, database):
+        return get_snowflake_hook(database)
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            key = self.kwargs['ti'].xcom_pull(task_ids='ps_extract', key='run_manifest')
+            self._manifest = RunManifest.load(self.s3_hook, key)
+        return self._manifest
+
+    @property
+    def metrics(self):
+        if self._metrics is None:
+            task_id = getattr(self.kwargs.get('ti'), 'task_id', None) or 'task'
+            self._metrics = task_metrics(self.kwargs, task_id)
+        return self._metrics
+
+    def start(self, manifest):
+        """
+        Saves the manifest of a new run and pushes its key, called by ps_extract.
+        """
+        self._manifest = manifest
+        self.kwargs['ti'].xcom_push(key='run_manifest', value=self.finish())
+
+    def save_manifest(self):
+        return self.manifest.save(self.s3_hook)
+
+    def finish(self, save=True):
+        """
+        Ends the task: records its metrics summary in the manifest (json sink), saves the manifest and sends the
+        metrics to the other sinks. With `save` off, the manifest is only saved for the json sink.
+
+        Returns:
+        str: The manifest key, None when it wasn't saved.
+        """
+        if 'json' in self.metrics.sinks:
+            self.manifest.metrics[self.metrics.task] = self.metrics.summary()
+            save = True
+        key = self.save_manifest() if save else None
+        self.metrics.emit()
+        return key
@@ -0,0 +1,296 @@
+import io
+import math
+import os
+import random
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+from ps_formats import file_format_of, read_frame_chunks
+
+# Rows parsed by the sampling schema validation: the first rows of a file plus a uniform sample of the rest
+SAMPLE_HEAD_ROWS = int(os.environ.get("schema_sample_head_rows", 1000))
+SAMPLE_ROWS = int(os.environ.get("schema_sample_rows", 10000))
+# Rows per chunk of the full streaming scan
+SCAN_CHUNK_SIZE = int(os.environ.get("schema_scan_chunk_size", 100000))
+
+
+def _random(rng):
+    # In (0, 1), so its log is finite
+    value = rng.random()
+    while value == 0.0:
+        value = rng.random()
+    return value
+
+
+def reservoir_sample_lines(f, k, rng=random, block_size=1024 * 1024):
+    """
+    Draws a uniform sample of `k` lines from the rest of a binary file in one pass (reservoir sampling with
+    geometric skips, Li's Algorithm L).
+
+    The file is read in fixed size blocks and only the blocks holding a sampled line are split into lines, the
+    others are just counted.
+
+    Returns:
+    Tuple[List[bytes], int]: The sampled lines without their line breaks, in file order, and the number of lines
+    read.
+    """
+    reservoir = []
+    lines = 0
+    next_line = 0
+    weight = 1.0
+
+    def take(index, line):
+        nonlocal next_line, weight
+        if index < k:
+            # The first k lines fill the reservoir
+            reservoir.append((index, line))
+            next_line = index + 1
+            if next_line < k:
+                return
+        else:
+            reservoir[rng.randrange(k)] = (index, line)
+        weight *= math.exp(math.log(_random(rng)) / k)
+        next_line = index + int(math.log(_random(rng)) / math.log(1 - weight)) + 1
+
+    carry = b''
+    for block in iter(lambda: f.read(block_size), b''):
+        block = carry + block
+        end = block.rfind(b'\n') + 1
+        carry = block[end:]
+        count = block.count(b'\n', 0, end)
+        if count and k and next_line < lines + count:
+            for offset, line in enumerate(block[:end - 1].split(b'\n')):
+                if lines + offset == next_line:
+                    take(lines + offset, line)
+        lines += count
+    if carry:
+        # Last line without a line break
+        if k and next_line == lines:
+            take(lines, carry)
+        lines += 1
+
+    return [line for _, line in sorted(reservoir)], lines
+
+
+class FileSample:
+    """
+    Rows sampled from an intermediate file: `head` holds its first rows and `tail` a sample of the others.
+
+    `frame` is both, parsed together so its dtypes are what a full read of those rows infers, and `rows` the row
+    count of the whole file. `exact_dtypes` tells whether the dtypes don't depend on the rows (Parquet).
+    """
+
+    def __init__(self, head, tail, frame, rows, exact_dtypes=False):
+        self.head = head
+        self.tail = tail
+        self.frame = frame
+        self.rows = rows
+        self.exact_dtypes = exact_dtypes
+
+    def stats(self):
+        return column_stats(self.frame, self.rows, 'sample')
+
+
+def sample_csv(path, head_rows=SAMPLE_HEAD_ROWS, sample_rows=SAMPLE_ROWS, rng=random):
+    with open(path, 'rb') as f:
+        header = f.readline().rstrip(b'\r\n')
+        head = []
+        for _ in range(head_rows):
+            line = f.readline()
+            if not line:
+                break
+            head.append(line.rstrip(b'\r\n'))
+        sample, rest = reservoir_sample_lines(f, sample_rows, rng)
+
+    def parse(lines):
+        return pd.read_csv(io.BytesIO(b'\n'.join([header] + lines) + b'\n'))
+
+    return FileSample(parse(head), parse(sample), parse(head + sample), len(head) + rest)
+
+
+def sample_parquet(path, head_rows=SAMPLE_HEAD_ROWS, sample_rows=SAMPLE_ROWS, rng=random):
+    """
+    The dtypes of a Parquet file come from its footer, the sample only feeds the column stats, so it is drawn from
+    whole row groups picked at random instead of row by row.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    empty = parquet_file.schema_arrow.empty_table().to_pandas()
+    batch = next(parquet_file.iter_batches(batch_size=head_rows), None) if head_rows else None
+    head = batch.to_pandas() if batch is not None else empty
+
+    starts = np.cumsum([0] + [parquet_file.metadata.row_group(group).num_rows
+                              for group in range(parquet_file.num_row_groups)])
+    groups = list(range(parquet_file.num_row_groups))
+    rng.shuffle(groups)
+    parts = []
+    gathered = 0
+    for group in groups:
+        if gathered >= sample_rows or starts[group + 1] <= len(head):
+            continue
+        part = parquet_file.read_row_group(group).to_pandas().iloc[max(len(head) - starts[group], 0):]
+        parts.append(part)
+        gathered += len(part)
+    tail = pd.concat(parts, ignore_index=True) if parts else empty
+    if len(tail) > sample_rows:
+        tail = tail.sample(n=sample_rows, random_state=rng.randrange(2 ** 32)).sort_index()
+
+    frame = pd.concat([head, tail], ignore_index=True) if len(tail) else head
+    return FileSample(head, tail, frame, parquet_file.metadata.num_rows, exact_dtypes=True)
+
+
+def sample_file(path, head_rows=SAMPLE_HEAD_ROWS, sample_rows=SAMPLE_ROWS, seed=None):
+    """
+    Reads the header, the first `head_rows` rows and a uniform sample of `sample_rows` other rows of an
+    intermediate file. Only the sampled rows are parsed.
+
+    Returns:
+    FileSample: The sampled rows.
+    """
+    rng = random.Random(seed)
+    if file_format_of(path) == 'parquet':
+        return sample_parquet(path, head_rows, sample_rows, rng)
+    return sample_csv(path, head_rows, sample_rows, rng)
+
+
+def estimate_distinct(values, total_rows):
+    """
+    Estimates the distinct values among `total_rows` values from a uniform sample of them, with the Duj1 estimator
+    of Haas et al. (the one of PostgreSQL's ANALYZE): n * d / (n - f1 + f1 * n / N), for d distinct values in the
+    sample of which f1 are seen once.
+    """
+    counts = values.value_counts()
+    sampled = len(values)
+    if sampled == 0 or sampled >= total_rows:
+        return len(counts)
+    singletons = int((counts == 1).sum())
+    estimate = sampled * len(counts) / (sampled - singletons + singletons * sampled / total_rows)
+    return int(round(min(estimate, total_rows)))
+
+
+def _bounds(values):
+    try:
+        return values.min(), values.max()
+    except TypeError:
+        # Mixed types, compare them as text
+        values = values.astype(str)
+        return values.min(), values.max()
+
+
+def column_stats(df, total_rows, validation):
+    """
+    Per column stats of sampled rows: dtype, null rate, min / max and estimated distinct values among the
+    `total_rows` rows of the file.
+
+    Returns:
+    dict: The stats of each column.
+    """
+    stats = {}
+    for column in df.columns:
+        values = df[column].dropna()
+        minimum, maximum = _bounds(values) if len(values) else (None, None)
+        non_null_rows = total_rows * len(values) / len(df) if len(df) else 0
+        stats[column] = {
+            'validation': validation,
+            'rows_checked': len(df),
+            'dtype': str(df[column].dtype),
+            'null_rate': round(1 - len(values) / len(df), 4) if len(df) else None,
+            'min': minimum,
+            'max': maximum,
+            'distinct_estimate': estimate_distinct(values, non_null_rows),
+        }
+    return stats
+
+
+def promote_dtype(dtype, other):
+    """
+    Returns the dtype pandas infers for a column read whole when two of its chunks were inferred as `dtype` and
+    `other`: numbers widen, anything else mixed with other values is read as text.
+    """
+    if dtype is None or dtype == other:
+        return other
+    numbers = [is_numeric_dtype(value) and not is_bool_dtype(value) for value in (dtype, other)]
+    if all(numbers):
+        return np.result_type(dtype, other)
+    # The text dtype of the chunks, the other one is only numbers or booleans
+    return other if numbers[0] else dtype
+
+
+class SchemaScan:
+    """
+    Full streaming scan of an intermediate file for the schema validation: infers the dtypes of the whole file
+    chunk by chunk, counts nulls and tracks min / max exactly, and keeps a uniform sample of `sample_rows` rows
+    (the rows with the smallest random keys) to estimate distinct values.
+    """
+
+    def __init__(self, sample_rows=SAMPLE_ROWS, seed=None):
+        self.sample_rows = sample_rows
+        self.rng = np.random.default_rng(seed)
+        self.rows = 0
+        self.columns = None
+        self.dtypes = {}
+        self.nulls = {}
+        self.bounds = {}
+        self.sample = None
+        self.keys = np.empty(0)
+
+    def add(self, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+            # Seeded with the header, so a file without data rows still has a (empty) sample
+            self.sample = df.iloc[:0]
+        self.rows += len(df)
+        for column in df.columns:
+            self.dtypes[column] = promote_dtype(self.dtypes.get(column), df[column].dtype)
+            values = df[column].dropna()
+            self.nulls[column] = self.nulls.get(column, 0) + len(df) - len(values)
+            if len(values):
+                bounds = _bounds(values)
+                if column in self.bounds:
+                    bounds = _bounds(pd.Series([*self.bounds[column], *bounds], dtype=object))
+                self.bounds[column] = bounds
+
+        keys = self.rng.random(len(df))
+        if len(self.keys) >= self.sample_rows:
+            # Only rows with a smaller key than the sample's largest can make it in
+            candidates = keys < self.keys.max()
+            df, keys = df[candidates], keys[candidates]
+        if len(df):
+            sample = pd.concat([self.sample, df], ignore_index=True) if len(self.sample) else df
+            keys = np.concatenate([self.keys, keys])
+            if len(keys) > self.sample_rows:
+                kept = np.argpartition(keys, self.sample_rows)[:self.sample_rows]
+                sample, keys = sample.iloc[kept], keys[kept]
+            self.sample, self.keys = sample, keys
+
+    @classmethod
+    def of_file(cls, path, chunk_size=SCAN_CHUNK_SIZE, sample_rows=SAMPLE_ROWS):
+        scan = cls(sample_rows)
+        for chunk in read_frame_chunks(path, chunk_size):
+            scan.add(chunk)
+        if scan.columns is None:
+            # No data rows, only the header
+            scan.add(pd.read_csv(path, nrows=0) if file_format_of(path) == 'csv' else pd.read_parquet(path))
+        return scan
+
+    def frame(self):
+        """
+        An empty DataFrame with the columns and dtypes of the whole file, for the schema checks.
+        """
+        return pd.DataFrame({column: pd.Series(dtype=self.dtypes[column]) for column in self.columns})
+
+    def stats(self):
+        stats = column_stats(self.sample, self.rows, 'full')
+        for column in self.columns:
+            minimum, maximum = self.bounds.get(column, (None, None))
+            stats[column].update({
+                'rows_checked': self.rows,
+                'dtype': str(self.dtypes[column]),
+                'null_rate': round(self.nulls[column] / self.rows, 4) if self.rows else None,
+                'min': minimum,
+                'max': maximum,
+            })
+        return stats
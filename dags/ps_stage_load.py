@@ -0,0 +1,179 @@
+import itertools
+import os
+import posixpath
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+from ps_bulk_load import SnowflakeConnectionPool, file_format_names, run_copy
+from ps_config import get_setting
+from ps_formats import describe_file, file_format_of
+
+# Internal stage the 'stage' load mode PUTs the processed data to, instead of the processed bucket. The load copies
+# from it without an external stage, storage integration or AWS keys
+INTERNAL_STAGE = 'PS_STAGING_DB.STAGING.PS_LOAD_STAGE'
+# Concurrent PUTs per task, each on its own pooled connection
+STAGE_MAX_WORKERS = int(os.environ.get("stage_max_workers", 4))
+# Threads the Snowflake client uploads the chunks of one PUT file with
+PUT_PARALLEL = int(os.environ.get("snowflake_put_parallel", 4))
+
+
+def internal_stage_command():
+    """
+    Creates the internal stage and the Parquet file format of the 'stage' load mode, if they don't exist yet.
+    """
+    return f"""
+        CREATE SCHEMA IF NOT EXISTS PS_STAGING_DB.STAGING;
+
+        CREATE FILE FORMAT IF NOT EXISTS {file_format_names['csv']}
+        TYPE = CSV SKIP_HEADER = 1;
+
+        CREATE FILE FORMAT IF NOT EXISTS {file_format_names['parquet']}
+        TYPE = PARQUET;
+
+        CREATE STAGE IF NOT EXISTS {INTERNAL_STAGE};
+    """
+
+
+def put_command(path, location, stage=INTERNAL_STAGE, parallel=PUT_PARALLEL):
+    """
+    Builds the PUT of a local file to a folder of a stage. Parquet is already compressed (Snappy), CSV is gzipped
+    by the client, which adds .gz to the staged name.
+    """
+    auto_compress = 'TRUE' if file_format_of(path) == 'csv' else 'FALSE'
+    return (f"PUT 'file://{os.path.abspath(path)}' '@{stage}/{location}' "
+            f"PARALLEL = {parallel} AUTO_COMPRESS = {auto_compress} OVERWRITE = TRUE")
+
+
+def remove_staged_command(location, stage=INTERNAL_STAGE):
+    """
+    Removes a run's folder from the stage once its load succeeded. The COPY doesn't purge, a retried load
+    recreates the staging tables and copies the files again.
+    """
+    return f"REMOVE @{stage}/{location}/"
+
+
+class StageUploader:
+    """
+    Uploads the processed data of a run to a Snowflake internal stage instead of the processed bucket.
+
+    Same interface as S3Uploader, so the transform tasks hand it to the same upload code: upload_file,
+    upload_frame and upload_stream return futures of the staged keys, wait() and describe() work on them. The
+    bucket is ignored, keys are staged under `location` (the run's folder of the stage). DataFrames are staged
+    as Parquet. PUTs run concurrently on pooled connections.
+    """
+
+    def __init__(self, snowflake_hook, location, stage=INTERNAL_STAGE, max_workers=STAGE_MAX_WORKERS,
+                 parallel=PUT_PARALLEL):
+        self.location = location
+        self.stage = stage
+        self.parallel = parallel
+        self.pool = SnowflakeConnectionPool(snowflake_hook)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # PUT keeps the local file name, files are copied or written here under the name of their key
+        self.workdir = tempfile.mkdtemp(prefix='ps_stage_')
+        self.counter = itertools.count()
+        self.futures = []
+        self.uploaded = {}
+
+    def _submit(self, fn, *args):
+        future = self.executor.submit(fn, *args)
+        self.futures.append(future)
+        return future
+
+    def _local_path(self, key):
+        directory = os.path.join(self.workdir, str(next(self.counter)))
+        os.makedirs(directory)
+        return os.path.join(directory, posixpath.basename(key))
+
+    def _put(self, path, key, rows=None):
+        entry = describe_file(path)
+        folder = posixpath.join(self.location, posixpath.dirname(key))
+        results = run_copy(self.pool, put_command(path, folder, self.stage, self.parallel))
+        if not results:
+            raise RuntimeError(f"PUT of {path} to @{self.stage}/{folder} returned no result")
+        for result in results:
+            if result['status'] not in ('UPLOADED', 'SKIPPED'):
+                raise RuntimeError(f"PUT of {path} to @{self.stage}/{folder} failed: {result.get('message')}")
+            staged_key = posixpath.join(folder, result['target'])
+        self.uploaded[staged_key] = {'key': staged_key, 'bytes': entry['bytes'], 'sha256': entry['sha256'],
+                                     'rows': entry['rows'] if rows is None else rows}
+        return staged_key
+
+    def _put_temporary(self, path, key, rows=None):
+        try:
+            return self._put(path, key, rows)
+        finally:
+            os.remove(path)
+
+    def _upload_file(self, filename, key):
+        if os.path.basename(filename) == posixpath.basename(key):
+            return self._put(filename, key)
+        path = self._local_path(key)
+        shutil.copyfile(filename, path)
+        return self._put_temporary(path, key)
+
+    def _upload_frame(self, df, key):
+        # Columnar and compressed whatever the intermediate format
+        key = posixpath.splitext(key)[0] + '.parquet'
+        path = self._local_path(key)
+        df.to_parquet(path, index=False, compression='snappy', coerce_timestamps='us',
+                      allow_truncated_timestamps=True)
+        return self._put_temporary(path, key, len(df))
+
+    def upload_file(self, filename, bucket_name, key):
+        return self._submit(self._upload_file, filename, key)
+
+    def upload_frame(self, df, bucket_name, key):
+        return self._submit(self._upload_frame, df, key)
+
+    @contextmanager
+    def upload_stream(self, bucket_name, key):
+        """
+        Like S3Uploader.upload_stream, the stream is a local file PUT when the block ends.
+        """
+        path = self._local_path(key)
+        stream = open(path, 'wb')
+        try:
+            yield stream
+        except BaseException:
+            stream.close()
+            os.remove(path)
+            raise
+        stream.close()
+        stream.future = self._submit(self._put_temporary, path, key, getattr(stream, 'rows', None))
+
+    def wait(self, futures=None):
+        futures = self.futures if futures is None else futures
+        return [future.result() for future in futures]
+
+    def describe(self, keys):
+        return [self.uploaded[key] for key in keys]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.close()
+
+
+def processed_uploader(run, uploader):
+    """
+    Returns what the transform tasks upload the processed data with, as a context manager: a StageUploader to the
+    run's folder of the internal stage with load_mode 'stage', else `uploader`, the task's S3Uploader.
+    """
+    if get_setting(run.kwargs, "load_mode", "per_file") != 'stage':
+        return nullcontext(uploader)
+    snowflake_hook = run.snowflake_hook('PS_STAGING_DB')
+    snowflake_hook.run(internal_stage_command())
+    return StageUploader(snowflake_hook, run.manifest.job_timestamp)
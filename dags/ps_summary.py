@@ -0,0 +1,188 @@
+# Hourly_Daily_Summary is built from the staging tables: loyalty rows per (hour, user) joined with the purchases of
+# the same hour, plus the user's revenue for the whole day
+
+HOURLY_DAILY_SUMMARY_TABLE = """
+    {create_table} Hourly_Daily_Summary (
+        app_date TIMESTAMP,
+        user_Id VARCHAR(255),
+        country VARCHAR(255),
+        user_total_lp_earned INT,
+        user_total_revenue DECIMAL(10,2),
+        user_total_purchases INT,
+        user_avg_revenue_per_purchase DECIMAL(10,2),
+        total_daily_revenue DECIMAL(10,2)
+    );
+"""
+
+HOURLY_DAILY_SUMMARY_QUERY = """
+    WITH PurchasesHourly AS (
+        SELECT
+            DATE_TRUNC('hour', date) AS date_hourly,
+            USER_ID,
+            REVENUE,
+            transaction_id
+        FROM
+            PS_STAGING_DB.STAGING.PURCHASES src
+        {source_filter}
+    ),
+    LoyaltyHourly AS (
+        SELECT
+            date,
+            user_Id,
+            country,
+            total_lp_earned
+        FROM
+            PS_STAGING_DB.STAGING.LOYALTY_EARNED_HOURLY src
+        {source_filter}
+    ),
+    MergedData AS (
+        SELECT
+            l.date AS app_date,
+            l.user_Id,
+            l.country,
+            l.total_lp_earned,
+            p.revenue,
+            p.transaction_id
+        FROM
+            LoyaltyHourly l
+        LEFT JOIN
+            PurchasesHourly p ON l.user_Id = p.user_Id AND l.date = p.date_hourly
+    ),
+    HourlySummary AS (
+        SELECT
+            app_date,
+            user_Id,
+            country,
+            SUM(total_lp_earned) AS user_total_lp_earned,
+            SUM(COALESCE(revenue, 0)) AS user_total_revenue,
+            COUNT(transaction_id) AS user_total_purchases,
+            CASE WHEN COUNT(transaction_id) > 0
+                 THEN ROUND(SUM(COALESCE(revenue, 0)) / COUNT(transaction_id), 2)
+                 ELSE 0 END AS user_avg_revenue_per_purchase
+        FROM
+            MergedData
+        GROUP BY
+            app_date, user_Id, country
+    ),
+    DailyRevenue AS (
+        SELECT
+            user_Id,
+            DATE(app_date) AS date_daily,
+            SUM(COALESCE(revenue, 0)) AS total_daily_revenue
+        FROM
+            MergedData
+        GROUP BY
+            user_Id, DATE(app_date)
+    )
+    SELECT
+        h.app_date,
+        h.user_Id,
+        h.country,
+        h.user_total_lp_earned,
+        h.user_total_revenue,
+        h.user_total_purchases,
+        h.user_avg_revenue_per_purchase,
+        d.total_daily_revenue
+    FROM
+        HourlySummary h
+    LEFT JOIN
+        DailyRevenue d ON h.user_Id = d.user_Id AND DATE(h.app_date) = d.date_daily
+"""
+
+
+def hourly_daily_summary_query(source_filter=''):
+    """
+    Returns the Hourly_Daily_Summary SELECT.
+
+    `source_filter` is a WHERE clause applied to both staging tables (aliased `src`), e.g. to restrict the query to
+    some users and days. Every output row only depends on the rows of its own user and day, so a filter on
+    (USER_ID, DATE(date)) gives exactly the summary rows of those user-days.
+    """
+    return HOURLY_DAILY_SUMMARY_QUERY.format(source_filter=source_filter)
+
+
+# Hourly rollups written by the transform step (emit_rollups), one row per key and file, summed again here since
+# several files or runs can carry the same key
+HOURLY_ROLLUP_TABLES = """
+    {create_table} LOYALTY_HOURLY_ROLLUP (
+        DATE TIMESTAMP,
+        USER_ID VARCHAR(20),
+        COUNTRY CHAR(2),
+        TOTAL_LP_EARNED NUMBER(38, 0),
+        LOYALTY_ROWS INT
+    );
+
+    {create_table} PURCHASES_HOURLY_ROLLUP (
+        DATE TIMESTAMP,
+        USER_ID VARCHAR(20),
+        REVENUE DECIMAL(18, 2),
+        PURCHASES INT
+    );
+"""
+
+# Same result as HOURLY_DAILY_SUMMARY_QUERY. MergedData repeats each loyalty row once per purchase of its hour, so
+# LP is multiplied by the purchase count and revenue and purchases by the loyalty row count
+HOURLY_DAILY_SUMMARY_ROLLUP_QUERY = """
+    WITH LoyaltyHourly AS (
+        SELECT
+            date,
+            user_Id,
+            country,
+            SUM(total_lp_earned) AS total_lp_earned,
+            SUM(loyalty_rows) AS loyalty_rows
+        FROM
+            PS_STAGING_DB.STAGING.LOYALTY_HOURLY_ROLLUP
+        GROUP BY
+            date, user_Id, country
+    ),
+    PurchasesHourly AS (
+        SELECT
+            date AS date_hourly,
+            user_Id,
+            SUM(revenue) AS revenue,
+            SUM(purchases) AS purchases
+        FROM
+            PS_STAGING_DB.STAGING.PURCHASES_HOURLY_ROLLUP
+        GROUP BY
+            date, user_Id
+    ),
+    HourlySummary AS (
+        SELECT
+            l.date AS app_date,
+            l.user_Id,
+            l.country,
+            l.total_lp_earned * GREATEST(COALESCE(p.purchases, 0), 1) AS user_total_lp_earned,
+            COALESCE(p.revenue, 0) * l.loyalty_rows AS user_total_revenue,
+            COALESCE(p.purchases, 0) * l.loyalty_rows AS user_total_purchases,
+            CASE WHEN COALESCE(p.purchases, 0) > 0
+                 THEN ROUND(p.revenue / p.purchases, 2)
+                 ELSE 0 END AS user_avg_revenue_per_purchase
+        FROM
+            LoyaltyHourly l
+        LEFT JOIN
+            PurchasesHourly p ON l.user_Id = p.user_Id AND l.date = p.date_hourly
+    ),
+    DailyRevenue AS (
+        SELECT
+            user_Id,
+            DATE(app_date) AS date_daily,
+            SUM(user_total_revenue) AS total_daily_revenue
+        FROM
+            HourlySummary
+        GROUP BY
+            user_Id, DATE(app_date)
+    )
+    SELECT
+        h.app_date,
+        h.user_Id,
+        h.country,
+        h.user_total_lp_earned,
+        h.user_total_revenue,
+        h.user_total_purchases,
+        h.user_avg_revenue_per_purchase,
+        d.total_daily_revenue
+    FROM
+        HourlySummary h
+    LEFT JOIN
+        DailyRevenue d ON h.user_Id = d.user_Id AND DATE(h.app_date) = d.date_daily
+"""
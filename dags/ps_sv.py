@@ -1,7 +1,23 @@
 import pandas as pd
-from airflow.providers.amazon.aws.hooks.s3 import S3Hook
 from pandas.api.types import is_string_dtype, is_numeric_dtype, is_datetime64_any_dtype
 
+from ps_config import get_flag, get_setting
+from ps_run import RunContext
+from ps_sampling import SAMPLE_HEAD_ROWS, SAMPLE_ROWS, SchemaScan, sample_file
+from ps_upload import S3Uploader
+
+
+def write_schema_errors(errors, error_log_path, column_stats=None):
+    """
+    Writes the schema errors of a file to a CSV, one row per error with its column and, when given, the stats of
+    that column (see ps_sampling.column_stats).
+    """
+    report = pd.DataFrame(errors, columns=['column', 'error'])[['error', 'column']]
+    if column_stats:
+        report = report.join(pd.DataFrame.from_dict(column_stats, orient='index'), on='column')
+    report.to_csv(error_log_path, index=False)
+
+
 leh_schema = {
     'date': is_datetime64_any_dtype,
     'userId': is_string_dtype,
@@ -11,24 +27,25 @@ leh_schema = {
 
 
 # Function to validate the dataset
-def validate_dataset_leh(dataset, schema, job_timestamp):
+def validate_dataset_leh(dataset, schema, job_timestamp, column_stats=None):
     errors = []
     # Check for column count
     if len(dataset.columns) != len(schema):
-        errors.append(f"Column count mismatch. Expected {len(schema)}, found {len(dataset.columns)}.")
+        errors.append((None, f"Column count mismatch. Expected {len(schema)}, found {len(dataset.columns)}."))
 
     # Check for column names and types
     for column, check_function in schema.items():
         if column not in dataset.columns:
-            errors.append(f"Missing expected column: {column}")
+            errors.append((column, f"Missing expected column: {column}"))
         else:
             if not check_function(dataset[column]):
-                errors.append(f"Column '{column}' has incorrect data type. Expected {check_function.__name__}.")
+                errors.append((column,
+                               f"Column '{column}' has incorrect data type. Expected {check_function.__name__}."))
 
     # If there are errors, write them to a CSV file
     if errors:
         error_log_path = f'error_sv_leh_{job_timestamp}.csv'
-        pd.DataFrame({'error': errors}).to_csv(error_log_path, index=False)
+        write_schema_errors(errors, error_log_path, column_stats)
         print(f"Errors found. Details are written to {error_log_path}.")
         return error_log_path
     else:
@@ -45,23 +62,24 @@ purchases_schema = {
 
 
 # Function to validate the dataset
-def validate_dataset_purchases(dataset, schema, job_timestamp):
+def validate_dataset_purchases(dataset, schema, job_timestamp, column_stats=None):
     errors = []
     # Check for column count
     if len(dataset.columns) != len(schema):
-        errors.append(f"Column count mismatch. Expected {len(schema)}, found {len(dataset.columns)}.")
+        errors.append((None, f"Column count mismatch. Expected {len(schema)}, found {len(dataset.columns)}."))
 
     # Check for column names and types
     for column, check_function in schema.items():
         if column not in dataset.columns:
-            errors.append(f"Missing expected column: {column}")
+            errors.append((column, f"Missing expected column: {column}"))
         else:
             if not check_function(dataset[column]):
-                errors.append(f"Column '{column}' has incorrect data type. Expected {check_function.__name__}.")
+                errors.append((column,
+                               f"Column '{column}' has incorrect data type. Expected {check_function.__name__}."))
 
     if errors:
         error_log_path = f'error_sv_purchases_{job_timestamp}.csv'
-        pd.DataFrame({'error': errors}).to_csv(error_log_path, index=False)
+        write_schema_errors(errors, error_log_path, column_stats)
         print(f"Errors found. Details are written to {error_log_path}.")
         return error_log_path
     else:
@@ -69,40 +87,109 @@ def validate_dataset_purchases(dataset, schema, job_timestamp):
         return None
 
 
+def ambiguous_sample(sample, schema):
+    """
+    Lists why the dtypes of a CSV sample may not be those of the whole file: a schema column without any value in
+    the sample, or whose check passes on the first rows and fails on the sampled ones (or the other way round).
+    """
+    if sample.exact_dtypes:
+        return []
+    reasons = []
+    for column, check_function in schema.items():
+        if column not in sample.frame.columns:
+            continue
+        if sample.frame[column].isna().all():
+            reasons.append(f"column '{column}' is empty in the sample")
+        elif len(sample.head) and len(sample.tail) and \
+                check_function(sample.head[column]) != check_function(sample.tail[column]):
+            reasons.append(f"the first and sampled rows disagree on column '{column}'")
+    return reasons
+
+
+def validate_file(file, dataset, job_timestamp, sampling=False, strict=False, head_rows=SAMPLE_HEAD_ROWS,
+                  sample_rows=SAMPLE_ROWS):
+    """
+    Validates the schema of a raw file without loading it whole.
+
+    With `sampling` the dtypes are inferred from the header, the first `head_rows` rows and a uniform sample of
+    `sample_rows` other rows. A type error that only appears outside the sample goes unnoticed, so the file is
+    scanned in full when the sample is ambiguous (see ambiguous_sample) or `strict` is set. The error report holds
+    the stats of the rows checked.
+
+    Parameters:
+    file (str): Path to the raw extract file (CSV or Parquet).
+    dataset (str): 'leh' or 'purchases'.
+
+    Returns:
+    str: Path to the schema error CSV, or None.
+    """
+    schema = leh_schema if dataset == 'leh' else purchases_schema
+    validate = validate_dataset_leh if dataset == 'leh' else validate_dataset_purchases
+    if sampling and not strict:
+        try:
+            sample = sample_file(file, head_rows, sample_rows)
+            reasons = ambiguous_sample(sample, schema)
+        except pd.errors.ParserError as e:
+            # e.g. a quoted field spanning lines, the sampled lines don't parse on their own
+            reasons = [f"the sampled rows don't parse: {e}"]
+        if not reasons:
+            return validate(sample.frame, schema, job_timestamp, sample.stats())
+        print(f"Scanning all of {file}, {'; '.join(reasons)}.")
+
+    scan = SchemaScan.of_file(file)
+    return validate(scan.frame(), schema, job_timestamp, scan.stats())
+
+
+def schema_validation_options(kwargs):
+    """
+    The validate_file options of a run: files are scanned in chunks, or only sampled with schema_sampling.
+    schema_validation_strict always scans them, e.g. to override an environment-wide schema_sampling for one run.
+    """
+    return {
+        'sampling': get_flag(kwargs, "schema_sampling"),
+        'strict': get_flag(kwargs, "schema_validation_strict"),
+        'head_rows': int(get_setting(kwargs, "schema_sample_head_rows", SAMPLE_HEAD_ROWS)),
+        'sample_rows': int(get_setting(kwargs, "schema_sample_rows", SAMPLE_ROWS)),
+    }
+
+
 def data_schema_validation(**kwargs):
-    s3_hook = S3Hook(aws_conn_id='aws_default')
     bucket_name = 'playstudios-error-data'
     error_files_leh = []
     error_files_purchases = []
 
-    # Get Files from context
-    list_raw_purchases = kwargs['ti'].xcom_pull(task_ids='ps_extract', key='list_raw_purchases')
-    list_raw_leh = kwargs['ti'].xcom_pull(task_ids='ps_extract', key='list_raw_leh')
-    job_timestamp = kwargs['ti'].xcom_pull(task_ids='ps_extract', key='job_timestamp')
+    # Get Files from the run manifest
+    run = RunContext(kwargs)
+    list_raw_purchases = run.manifest.paths('raw', 'purchases')
+    list_raw_leh = run.manifest.paths('raw', 'leh')
+    job_timestamp = run.manifest.job_timestamp
+
+    options = schema_validation_options(kwargs)
 
-    for file in list_raw_leh:
-        df_loyalty_earned_hourly = pd.read_csv(file)
+    # Error files are named per raw file, a dataset may have several in one run
+    for part, file in enumerate(list_raw_leh):
         # Validate the loyalty earned hourly data
-        leh_error_log_path = validate_dataset_leh(df_loyalty_earned_hourly, leh_schema, job_timestamp)
+        with run.metrics.step('schema_validation', dataset='leh', file=file) as step:
+            leh_error_log_path = validate_file(file, 'leh', f'{job_timestamp}_{part:04d}', **options)
+            step.count('schema_errors', int(leh_error_log_path is not None))
         if leh_error_log_path:
             error_files_leh.append(leh_error_log_path)
 
-    for file in list_raw_purchases:
-
-        df_purchases = pd.read_csv(file)
+    for part, file in enumerate(list_raw_purchases):
         # Validate the purchases data
-        purchases_error_log_path = validate_dataset_purchases(df_purchases, purchases_schema, job_timestamp)
+        with run.metrics.step('schema_validation', dataset='purchases', file=file) as step:
+            purchases_error_log_path = validate_file(file, 'purchases', f'{job_timestamp}_{part:04d}', **options)
+            step.count('schema_errors', int(purchases_error_log_path is not None))
         if purchases_error_log_path:
             error_files_purchases.append(purchases_error_log_path)
 
-    if error_files_leh:
-        for error_file in error_files_leh:
-            leh_key = f'Loyalty_Earned_Hourly_Data_Set/{error_file}'
-
-            s3_hook.load_file(filename=error_file, key=leh_key, bucket_name=bucket_name, replace=True)
+    with run.metrics.step('upload'), S3Uploader() as uploader:
+        error_keys_leh = [uploader.upload_file(error_file, bucket_name, f'Loyalty_Earned_Hourly_Data_Set/{error_file}')
+                          for error_file in error_files_leh]
 
-    if error_files_purchases:
-        for error_file in error_files_purchases:
-            purchases_key = f'Purchases_Data_Set/{error_file}'
+        error_keys_purchases = [uploader.upload_file(error_file, bucket_name, f'Purchases_Data_Set/{error_file}')
+                                for error_file in error_files_purchases]
 
-            s3_hook.load_file(filename=error_file, key=purchases_key, bucket_name=bucket_name, replace=True)
+    run.manifest.set_files('schema_errors', 'leh', uploader.describe(uploader.wait(error_keys_leh)))
+    run.manifest.set_files('schema_errors', 'purchases', uploader.describe(uploader.wait(error_keys_purchases)))
+    run.finish()
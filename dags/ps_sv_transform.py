@@ -0,0 +1,122 @@
+from ps_aggregate import HourlyRollup
+from ps_config import get_flag, get_setting
+from ps_extract import dataset_prefixes
+from ps_formats import file_format_of, read_frame
+from ps_run import RunContext
+from ps_stage_load import processed_uploader
+from ps_sv import (leh_schema, purchases_schema, schema_validation_options, validate_dataset_leh,
+                   validate_dataset_purchases, validate_file)
+from ps_transform_dq import (process_file_chunked, process_loyalty_earned_hourly, process_purchases,
+                             upload_processed_files)
+from ps_upload import S3Uploader
+
+
+def validate_and_process_file(file, dataset, job_timestamp, chunk_size=None, rollup=None,
+                              validation_options=None):
+    """
+    Runs the schema validation and the DQ rules of one raw file on a single parsed DataFrame.
+
+    The schema checks run first, they only look at the columns, while the DQ rules drop rows from the frame.
+    With `chunk_size` the file is processed in chunks, and its schema is checked like ps_schema_validation does
+    (validate_file, a full scan or a sample), so both DAGs give the same verdict whatever chunk a bad type is in.
+
+    Parameters:
+    file (str): Path to the raw extract file (CSV or Parquet).
+    dataset (str): 'leh' or 'purchases'.
+    chunk_size (int): Rows per chunk, None to load the whole file.
+    rollup (HourlyRollup): Accumulates the hourly rollup of the processed records, if given.
+    validation_options (dict): validate_file options of a chunked file, see schema_validation_options.
+
+    Returns:
+    Tuple[str, str, str]: Paths to the schema error CSV (or None), the processed data file and the DQ errors CSV
+    (or None).
+    """
+    if chunk_size:
+        sv_error_path = validate_file(file, dataset, job_timestamp, **(validation_options or {}))
+        processed_path, errors_path = process_file_chunked(file, dataset, job_timestamp, chunk_size, rollup)
+        return sv_error_path, processed_path, errors_path
+
+    df = read_frame(file)
+    if dataset == 'leh':
+        sv_error_path = validate_dataset_leh(df, leh_schema, job_timestamp)
+        processed_path, errors_path = process_loyalty_earned_hourly(df, job_timestamp, file_format_of(file), rollup)
+    else:
+        sv_error_path = validate_dataset_purchases(df, purchases_schema, job_timestamp)
+        processed_path, errors_path = process_purchases(df, job_timestamp, file_format_of(file), rollup)
+    return sv_error_path, processed_path, errors_path
+
+
+def validate_and_transform_data(**kwargs):
+    """
+    Fused replacement for data_schema_validation followed by transform_data: every raw file is parsed once.
+
+    Uploads the same error and processed files as the two tasks and records them in the run manifest the same
+    way, so the load step works unchanged.
+    """
+    bucket_error_name = 'playstudios-error-data'
+    bucket_processed_name = 'playstudios-processed-data'
+
+    # Get Files from the run manifest
+    run = RunContext(kwargs)
+    list_raw = {dataset: run.manifest.files('raw', dataset) for dataset in ('leh', 'purchases')}
+    job_timestamp = run.manifest.job_timestamp
+    chunk_size = get_setting(kwargs, "transform_chunk_size")
+    chunk_size = int(chunk_size) if chunk_size else None
+    chunk_min_bytes = int(get_setting(kwargs, "transform_chunk_min_bytes", 0))
+    emit_rollups = get_flag(kwargs, "emit_rollups")
+    partitioned_layout = get_flag(kwargs, "partitioned_layout")
+    validation_options = schema_validation_options(kwargs)
+
+    processed_files_s3 = {'leh': [], 'purchases': []}
+    rollup_files_s3 = {'leh': [], 'purchases': []}
+    error_files_s3 = {stage: {'leh': [], 'purchases': []} for stage in ('schema_errors', 'dq_errors')}
+    # Uploads run concurrently on one client, leaving the block waits for them. With load_mode 'stage' the processed
+    # data is PUT to Snowflake instead
+    with S3Uploader() as uploader, processed_uploader(run, uploader) as processed:
+        for dataset, entries in list_raw.items():
+            files = [entry['path'] for entry in entries]
+            error_files = {'schema_errors': [], 'dq_errors': []}
+            processed_files = []
+            rollup = HourlyRollup(dataset) if emit_rollups else None
+            for part, entry in enumerate(entries):
+                file_chunk_size = chunk_size if entry['bytes'] >= chunk_min_bytes else None
+                with run.metrics.step('validate_transform', dataset=dataset, file=entry['path']) as step:
+                    step.count('bytes_read', entry['bytes'])
+                    # Local outputs are named per raw file, a dataset may have several in one run
+                    sv_error_path, processed_path, errors_path = validate_and_process_file(
+                        entry['path'], dataset, f'{job_timestamp}_{part:04d}', file_chunk_size, rollup,
+                        validation_options)
+                    step.count('schema_errors', int(sv_error_path is not None))
+                for stage, error_path in (('schema_errors', sv_error_path), ('dq_errors', errors_path)):
+                    if error_path:
+                        error_files[stage].append(error_path)
+                if processed_path:
+                    processed_files.append(processed_path)
+
+            # Uploaded while the next dataset is processed
+            processed_files_s3[dataset].extend(upload_processed_files(processed, bucket_processed_name, dataset,
+                                                                      processed_files, partitioned_layout, chunk_size))
+
+            for stage, stage_files in error_files.items():
+                error_files_s3[stage][dataset] = [
+                    uploader.upload_file(file, bucket_error_name, f'{dataset_prefixes[dataset]}/{file}')
+                    for file in stage_files]
+
+            if rollup is not None and files:
+                rollup_path = rollup.write(job_timestamp, file_format_of(files[0]))
+                rollup_files_s3[dataset].extend(upload_processed_files(processed, bucket_processed_name, dataset,
+                                                                       [rollup_path], partitioned_layout))
+
+        # Times the uploads still running once every file is processed
+        with run.metrics.step('upload_wait') as step:
+            for dataset in list_raw:
+                stage_keys = {'processed': (processed, processed_files_s3[dataset])}
+                for stage, futures in error_files_s3.items():
+                    stage_keys[stage] = (uploader, futures[dataset])
+                if emit_rollups:
+                    stage_keys['rollup'] = (processed, rollup_files_s3[dataset])
+                for stage, (stage_uploader, futures) in stage_keys.items():
+                    stage_entries = stage_uploader.describe(stage_uploader.wait(futures))
+                    run.manifest.set_files(stage, dataset, stage_entries)
+                    step.count('bytes_written', sum(stage_entry['bytes'] for stage_entry in stage_entries))
+    run.finish()
@@ -1,53 +1,276 @@
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from airflow.providers.amazon.aws.hooks.s3 import S3Hook
 
+from ps_aggregate import HourlyRollup
+from ps_config import get_flag, get_setting
+from ps_extract import dataset_prefixes
+from ps_formats import (ChunkSerializer, chunk_writer, file_extension, file_format_of, read_frame, read_frame_chunks,
+                        write_frame)
+from ps_metrics import current_step
+from ps_partitions import MAX_PARTITION_ROWS, PartitionedUploader
+from ps_pipeline import PIPELINE_CHUNK_ROWS, PipelineStage, run_pipeline
+from ps_run import RunContext
+from ps_stage_load import processed_uploader
+from ps_upload import S3Uploader
+
+
+# userId is two letters, two digits and three letters, e.g. "ab12cde"
+USER_ID_PATTERN = r'^[A-Za-z]{2}\d{2}[A-Za-z]{3}$'
+USER_ID_LETTER_POSITIONS = [0, 1, 4, 5, 6]
+USER_ID_DIGIT_POSITIONS = [2, 3]
+VALID_COUNTRIES = ['US', 'CA']
+
+# Low cardinality columns kept as categoricals from read time on, so every distinct value is stored and checked once
+categorical_columns = {
+    'leh': ['userId', 'country'],
+    'purchases': ['userId'],
+}
+
+
+def intern_columns(df, columns):
+    """
+    Converts `columns` to categoricals, columns that already are categorical are left as they are.
+    """
+    converted = {column: df[column].astype('category') for column in columns
+                 if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype)}
+    return df.assign(**converted) if converted else df
 
-def process_loyalty_earned_hourly(df, job_timestamp):
+
+def valid_user_id_values(values):
     """
-    Processes the Loyalty Earned Hourly data.
+    Checks distinct userId values against USER_ID_PATTERN with fixed-width byte comparisons instead of a regex.
 
-    Parameters:
-    df (DataFrame): The input DataFrame containing the loyalty data.
+    Values of 7 ASCII characters are packed into a (n, 7) uint8 array, letters and digits are checked per column.
 
     Returns:
-    Tuple[str, str]: Paths to the processed data CSV file and errors CSV file.
+    ndarray: bool per value.
     """
-    processed_file_path = Path(f'processed_leh_{job_timestamp}.csv')
-    errors_file_path = Path(f'errors_dq_leh_{job_timestamp}.csv')
+    valid = np.zeros(len(values), dtype=bool)
+    candidates = np.fromiter((isinstance(value, str) and len(value) == 7 and value.isascii() for value in values),
+                             dtype=bool, count=len(values))
+    if not candidates.any():
+        return valid
 
-    try:
-        # Separate records with missing values
-        errors_df_list = [df[df.isnull().any(axis=1)].copy()]
-        df.dropna(inplace=True)
+    chars = np.array(values[candidates].tolist(), dtype='S7').view(np.uint8).reshape(-1, 7)
+    # ASCII letters differ from their upper case form in bit 0x20 only
+    lower = chars[:, USER_ID_LETTER_POSITIONS] | 0x20
+    digits = chars[:, USER_ID_DIGIT_POSITIONS]
+    valid[candidates] = (((lower >= ord('a')) & (lower <= ord('z'))).all(axis=1)
+                         & ((digits >= ord('0')) & (digits <= ord('9'))).all(axis=1))
+    return valid
+
+
+# Each rule gets the raw frame and the frame with typed columns and returns a boolean mask of the failing rows.
+# Missing values are reported by the nulls rule only.
+
+def invalid_nulls(df, normalized):
+    return df.isnull().any(axis=1)
+
+
+def invalid_user_ids(df, normalized):
+    user_ids = normalized['userId']
+    if not isinstance(user_ids.dtype, pd.CategoricalDtype):
+        user_ids = user_ids.astype('category')
+    # Validate each distinct userId once and map the result back through the codes, code -1 (missing) maps to
+    # the trailing True
+    valid = np.append(valid_user_id_values(user_ids.cat.categories.to_numpy(dtype=object)), True)
+    return pd.Series(~valid[user_ids.cat.codes.to_numpy()], index=user_ids.index)
+
+
+def invalid_countries(df, normalized):
+    return ~normalized['country'].isin(VALID_COUNTRIES) & normalized['country'].notna()
+
+
+def invalid_lp_earned(df, normalized):
+    return normalized['total_lp_earned'] < 0
+
+
+def invalid_revenue(df, normalized):
+    # Revenue that is missing once 'PriceInUSD=' is stripped was not numeric
+    revenue = normalized['revenue']
+    return (revenue.isnull() | (revenue <= 0)) & df['revenue'].notna()
+
+
+def duplicate_records(df, normalized):
+    # Identical rows pass or fail the other rules together, so the first copy is kept only if it is valid
+    return normalized.duplicated(keep='first')
+
+
+# DQ rules per dataset, in the order they are reported. The bit of a rule in the reason bitmask is its position
+# in the list.
+leh_rules = [
+    ('nulls', invalid_nulls),
+    ('user_id', invalid_user_ids),
+    ('country', invalid_countries),
+    ('negative_lp', invalid_lp_earned),
+]
+
+purchases_rules = [
+    ('nulls', invalid_nulls),
+    ('user_id', invalid_user_ids),
+    ('revenue', invalid_revenue),
+    ('duplicate', duplicate_records),
+]
+
+
+def evaluate_rules(df, normalized, rules):
+    """
+    Evaluates every rule on the whole frame and combines the masks into one reason bitmask per row.
+
+    Returns:
+    ndarray: uint32 bitmask, bit i is set when rule i failed for the row and 0 means the row is valid.
+    """
+    reasons = np.zeros(len(df), dtype=np.uint32)
+    for bit, (_, rule) in enumerate(rules):
+        reasons |= rule(df, normalized).to_numpy(dtype=bool).astype(np.uint32) << np.uint32(bit)
+    return reasons
 
-        # Check for userId format
-        user_id_pattern = r'^[A-Za-z]{2}\d{2}[A-Za-z]{3}$'
-        invalid_user_ids = ~df['userId'].str.match(user_id_pattern)
-        errors_df_list.append(df[invalid_user_ids].copy())
-        df = df[~invalid_user_ids]
 
-        # Validate country codes
-        invalid_countries = ~df['country'].isin(['US', 'CA'])
-        errors_df_list.append(df[invalid_countries].copy())
-        df = df[~invalid_countries]
+def describe_reasons(reasons, rules):
+    """
+    Turns reason bitmasks into the '|' separated names of the failed rules, e.g. 'user_id|country'.
+    """
+    names = {code: '|'.join(name for bit, (name, _) in enumerate(rules) if code & (1 << bit))
+             for code in np.unique(reasons)}
+    return pd.Series(reasons).map(names).to_numpy()
 
-        # Convert total_lp_earned to numeric and check for negative values
-        df['total_lp_earned'] = pd.to_numeric(df['total_lp_earned'], errors='coerce')
-        invalid_lp_earned = df['total_lp_earned'] < 0
-        errors_df_list.append(df[invalid_lp_earned].copy())
-        df = df[~invalid_lp_earned]
 
-        # Save the records that passed all checks
-        df.to_csv(processed_file_path, index=False)
-        if errors_df_list:
-            # Combine all error records and save
-            errors_df = pd.concat(errors_df_list, ignore_index=True)
-            errors_df.to_csv(errors_file_path, index=False, mode='a', header=not Path(errors_file_path).exists())
+def split_by_rules(df, normalized, rules):
+    """
+    Splits a frame into valid and error rows in a single pass.
 
-            return str(processed_file_path), str(errors_file_path)
+    The rules run on `normalized` (typed columns), valid rows are taken from it and error rows from the raw `df`,
+    with a 'dq_failed_rules' column naming every rule the row failed.
 
+    Returns:
+    Tuple[DataFrame, DataFrame]: The valid rows and the error rows.
+    """
+    reasons = evaluate_rules(df, normalized, rules)
+    failed = reasons != 0
+    errors_df = df[failed].assign(dq_failed_rules=describe_reasons(reasons[failed], rules))
+
+    step = current_step()
+    if step.enabled:
+        step.count('rows_in', len(df))
+        step.count('rows_out', len(df) - len(errors_df))
+        step.count('rows_rejected', len(errors_df))
+        # A row failing several rules counts once per rule
+        for bit, (name, _) in enumerate(rules):
+            step.count(f'rows_rejected_{name}', int(np.count_nonzero(reasons & np.uint32(1 << bit))))
+    return normalized[~failed], errors_df
+
+
+class SeenRowHashes:
+    """
+    Compact set of 64-bit row hashes, used to find duplicates across the chunks of a file.
+
+    Hashes are kept in sorted numpy runs (8 bytes per row) that are merged when a run grows past the previous one,
+    so lookups stay logarithmic and inserts amortized O(n log n) without holding the rows themselves.
+    """
+
+    def __init__(self):
+        self.runs = []
+
+    def contains(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, hashes), len(run) - 1)
+            found |= run[positions] == hashes
+        return found
+
+    def add(self, hashes):
+        run = np.unique(hashes)
+        while self.runs and len(self.runs[-1]) <= len(run):
+            run = np.union1d(self.runs.pop(), run)
+        self.runs.append(run)
+
+
+def duplicate_records_across_chunks(seen_hashes):
+    """
+    Returns a duplicates rule for chunked processing: a row is a duplicate if an identical row appeared earlier in
+    the chunk or in any earlier chunk of the file.
+    """
+    def duplicate_records(df, normalized):
+        hashes = pd.util.hash_pandas_object(normalized, index=False).to_numpy()
+        duplicated = pd.Series(hashes).duplicated(keep='first').to_numpy() | seen_hashes.contains(hashes)
+        seen_hashes.add(hashes)
+        return pd.Series(duplicated, index=normalized.index)
+
+    return duplicate_records
+
+
+def write_dq_errors(errors_df, errors_file_path):
+    # Chunked processing writes the errors of each chunk to the same file, so they are appended to
+    errors_df.to_csv(errors_file_path, index=False, mode='a', header=not errors_file_path.exists())
+
+
+def clean_loyalty_earned_hourly(df, rules=leh_rules):
+    """
+    Applies the Loyalty Earned Hourly DQ rules to a frame or chunk.
+
+    Returns:
+    Tuple[DataFrame, DataFrame]: The records that passed all checks and the failing ones.
+    """
+    df = intern_columns(df, categorical_columns['leh'])
+    # Convert total_lp_earned to numeric, the input frame is left untouched
+    normalized = df.assign(total_lp_earned=pd.to_numeric(df['total_lp_earned'], errors='coerce'))
+
+    # Nulls, userId format, country codes and negative LP in one pass
+    return split_by_rules(df, normalized, rules)
+
+
+def clean_purchases(df, file_format='csv', rules=purchases_rules):
+    """
+    Applies the Purchases DQ rules to a frame or chunk.
+
+    Returns:
+    Tuple[DataFrame, DataFrame]: The records that passed all checks and the failing ones.
+    """
+    df = intern_columns(df, categorical_columns['purchases'])
+    # Extract and convert the revenue field to numeric, the input frame is left untouched
+    normalized = df.assign(
+        date=pd.to_datetime(df['date']),
+        # Always float, so row hashes match across chunks whatever dtype a chunk was inferred with
+        # As text first, a chunk may be inferred as numbers or as all NaN
+        revenue=pd.to_numeric(df['revenue'].astype(str).str.replace('PriceInUSD=', '', regex=False),
+                              errors='coerce').astype('float64'),
+    )
+
+    # Nulls, userId format, non-positive revenue and duplicates in one pass
+    df, errors_df = split_by_rules(df, normalized, rules)
+
+    # Ensure the dates are in the correct format like Loyalty Earned Hourly, Parquet keeps them as timestamps
+    if file_format == 'csv':
+        df = df.assign(date=df['date'].dt.strftime('%Y-%m-%d %H:%M:%S'))
+    return df, errors_df
+
+
+def process_loyalty_earned_hourly(df, job_timestamp, file_format='csv', rollup=None):
+    """
+    Processes the Loyalty Earned Hourly data.
+
+    Parameters:
+    df (DataFrame): The input DataFrame containing the loyalty data.
+    file_format (str): Format of the processed data file, 'csv' or 'parquet'.
+    rollup (HourlyRollup): Accumulates the hourly rollup of the processed records, if given.
+
+    Returns:
+    Tuple[str, str]: Paths to the processed data file and errors CSV file.
+    """
+    processed_file_path = Path(f'processed_leh_{job_timestamp}.{file_extension(file_format)}')
+    errors_file_path = Path(f'errors_dq_leh_{job_timestamp}.csv')
+
+    try:
+        df, errors_df = clean_loyalty_earned_hourly(df)
+        if rollup is not None:
+            rollup.add(df)
+
+        # Save the records that passed all checks and the failing ones
+        write_frame(df, processed_file_path)
+        write_dq_errors(errors_df, errors_file_path)
+        return str(processed_file_path), str(errors_file_path)
 
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -57,50 +280,29 @@ def process_loyalty_earned_hourly(df, job_timestamp):
     return str(processed_file_path), None
 
 
-def process_purchases(df, job_timestamp):
+def process_purchases(df, job_timestamp, file_format='csv', rollup=None):
     """
     Processes the Purchases data.
 
     Parameters:
     df (DataFrame): The input DataFrame containing the purchases data.
+    file_format (str): Format of the processed data file, 'csv' or 'parquet'.
+    rollup (HourlyRollup): Accumulates the hourly rollup of the processed records, if given.
 
     Returns:
-    Tuple[str, str]: Paths to the processed data CSV file and errors CSV file.
+    Tuple[str, str]: Paths to the processed data file and errors CSV file.
     """
-    processed_file_path = Path(f'processed_purchases_{job_timestamp}.csv')
+    processed_file_path = Path(f'processed_purchases_{job_timestamp}.{file_extension(file_format)}')
     errors_file_path = Path(f'errors_dq_purchases_{job_timestamp}.csv')
     try:
-        # Separate records with missing values
-        errors_df_list = [df[df.isnull().any(axis=1)].copy()]
-        df.dropna(inplace=True)
-
-        # Ensure the dates are in the correct format like Loyalty Earned Hourly
-        df['date'] = pd.to_datetime(df['date']).dt.strftime('%Y-%m-%d %H:%M:%S')
-
-        # Check for userId format
-        user_id_pattern = r'^[A-Za-z]{2}\d{2}[A-Za-z]{3}$'
-        invalid_user_ids = ~df['userId'].str.match(user_id_pattern)
-        errors_df_list.append(df[invalid_user_ids].copy())
-        df = df[~invalid_user_ids]
-
-        # Extract and convert the revenue field to numeric
-        df['revenue'] = df['revenue'].str.replace('PriceInUSD=', '', regex=False)
-        df['revenue'] = pd.to_numeric(df['revenue'], errors='coerce')
-        # Append non-numeric and non-positive revenue records to errors
-        errors_df_list.append(df[(df['revenue'].isnull()) | (df['revenue'] <= 0)].copy())
-        # Keep only rows with positive revenue
-        df = df[df['revenue'] > 0]
-
-        # Check for duplicate records and remove them
-        df = df.drop_duplicates(keep='first')
-
-        # Save the records that passed all checks
-        df.to_csv(processed_file_path, index=False)
-        if errors_df_list:
-            # Combine all error records and save
-            errors_df = pd.concat(errors_df_list, ignore_index=True)
-            errors_df.to_csv(errors_file_path, index=False, mode='a', header=not errors_file_path.exists())
-            return str(processed_file_path), str(errors_file_path)
+        df, errors_df = clean_purchases(df, file_format)
+        if rollup is not None:
+            rollup.add(df)
+
+        # Save the records that passed all checks and the failing ones
+        write_frame(df, processed_file_path)
+        write_dq_errors(errors_df, errors_file_path)
+        return str(processed_file_path), str(errors_file_path)
     except Exception as e:
         print(f"An error occurred: {e}")
         # Handle the error or re-raise the exception
@@ -109,109 +311,299 @@ def process_purchases(df, job_timestamp):
     return str(processed_file_path), None
 
 
-def transform_data(**kwargs):
+def process_file_chunked(file, dataset, job_timestamp, chunk_size, rollup=None):
     """
-    Processes the raw data.
+    Processes a raw file in chunks of `chunk_size` rows, for files larger than the worker's memory.
+
+    Processed and error records are appended chunk by chunk, so memory is bounded by the chunk size. Duplicate
+    purchases are found across chunks through the hashes of the rows seen so far. Errors are raised, the chunks
+    already written would otherwise be loaded as the whole file.
 
     Parameters:
-    df_loyalty_earned_hourly (DataFrame): The input DataFrame containing the loyalty data.
-    df_purchases (DataFrame): The input DataFrame containing the purchases data.
+    file (str): Path to the raw extract file (CSV or Parquet).
+    dataset (str): 'leh' or 'purchases'.
+    rollup (HourlyRollup): Accumulates the hourly rollup of the processed records, if given.
 
     Returns:
-    Tuple[str, str]: Paths to the processed data CSV file and errors CSV file.
+    Tuple[str, str]: Paths to the processed data file and errors CSV file.
     """
+    file_format = file_format_of(file)
+    processed_file_path = Path(f'processed_{dataset}_{job_timestamp}.{file_extension(file_format)}')
+    errors_file_path = Path(f'errors_dq_{dataset}_{job_timestamp}.csv')
+    rules = leh_rules
+    if dataset == 'purchases':
+        rules = [(name, duplicate_records_across_chunks(SeenRowHashes()) if name == 'duplicate' else rule)
+                 for name, rule in purchases_rules]
+
+    writer = chunk_writer(processed_file_path)
+    try:
+        df = None
+        rows_written = 0
+        for chunk in read_frame_chunks(file, chunk_size, categorical_columns[dataset]):
+            if dataset == 'leh':
+                df, errors_df = clean_loyalty_earned_hourly(chunk, rules)
+            else:
+                df, errors_df = clean_purchases(chunk, file_format, rules)
+
+            # Skip empty chunks so the first written chunk fixes the column types
+            if len(df):
+                writer.write(df)
+                rows_written += len(df)
+                if rollup is not None:
+                    rollup.add(df)
+            write_dq_errors(errors_df, errors_file_path)
+
+        # Nothing passed, still write the header
+        if not rows_written:
+            if df is None:
+                # A file without data rows yields no chunk, read its header
+                df, errors_df = (clean_loyalty_earned_hourly(read_frame(file), rules) if dataset == 'leh'
+                                 else clean_purchases(read_frame(file), file_format, rules))
+                write_dq_errors(errors_df, errors_file_path)
+            writer.write(df)
+        return str(processed_file_path), str(errors_file_path)
+    finally:
+        writer.close()
+
+
+def process_file_pipelined(file, dataset, job_timestamp, chunk_size, target, rollup=None):
+    """
+    Processes a raw file in chunks of `chunk_size` rows like process_file_chunked, but reading, the DQ rules,
+    serialization and writing run as concurrent pipeline stages (see ps_pipeline.run_pipeline): a chunk is parsed
+    while the previous one is checked and the one before it written, so a slow parse or upload no longer adds up
+    with the rest. Like process_file_chunked an error is raised, so a partial upload gets aborted.
 
-    s3_hook = S3Hook(aws_conn_id='aws_default')
-    bucket_error_name = 'playstudios-error-data'
-    bucket_processed_name = 'playstudios-processed-data'
-    error_files_leh = []
-    error_files_purchases = []
-
-    processed_files_leh = []
-    processed_files_purchases = []
-
-    processed_files_s3_leh = []
-    processed_files_s3_purchases = []
-
-    # Get Files from context
-    list_raw_purchases = kwargs['ti'].xcom_pull(task_ids='ps_extract', key='list_raw_purchases')
-    list_raw_leh = kwargs['ti'].xcom_pull(task_ids='ps_extract', key='list_raw_leh')
-    job_timestamp = kwargs['ti'].xcom_pull(task_ids='ps_extract', key='job_timestamp')
-
-    print('list_raw_leh', list_raw_leh)
-    print('list_raw_purchases', list_raw_purchases)
-    print('job_timestamp', job_timestamp)
-
-    for file in list_raw_leh:
-        df_loyalty_earned_hourly = pd.read_csv(file)
-        # Process the loyalty data
-        processed_loyalty_earned_hourly_path, errors_loyalty_earned_hourly_path = process_loyalty_earned_hourly(
-            df_loyalty_earned_hourly, job_timestamp)
-
-        if errors_loyalty_earned_hourly_path:
-            error_files_leh.append(errors_loyalty_earned_hourly_path)
-
-        if processed_loyalty_earned_hourly_path:
-            processed_files_leh.append(processed_loyalty_earned_hourly_path)
-
-    for file in list_raw_purchases:
-        df_purchases = pd.read_csv(file)
-        # Process the purchases data
-        processed_purchases_path, errors_purchases_path = process_purchases(df_purchases, job_timestamp)
+    Parameters:
+    file (str): Path to the raw extract file (CSV or Parquet).
+    dataset (str): 'leh' or 'purchases'.
+    target (file object): Binary file the processed records are written to, a local file or the stream of an
+        S3Uploader.upload_stream.
+    rollup (HourlyRollup): Accumulates the hourly rollup of the processed records, if given.
 
-        if errors_purchases_path:
-            error_files_purchases.append(errors_purchases_path)
+    Returns:
+    Tuple[int, str]: The processed row count and the path of the errors CSV file.
+    """
+    file_format = file_format_of(file)
+    errors_file_path = Path(f'errors_dq_{dataset}_{job_timestamp}.csv')
+    rules = leh_rules
+    if dataset == 'purchases':
+        rules = [(name, duplicate_records_across_chunks(SeenRowHashes()) if name == 'duplicate' else rule)
+                 for name, rule in purchases_rules]
+    serializer = ChunkSerializer(file_format)
+    rows_written = 0
+    last_df = None
+
+    def clean(chunk):
+        if dataset == 'leh':
+            return clean_loyalty_earned_hourly(chunk, rules)
+        return clean_purchases(chunk, file_format, rules)
+
+    def check(chunk):
+        df, errors_df = clean(chunk)
+        if rollup is not None and len(df):
+            rollup.add(df)
+        return df, errors_df
+
+    def serialize(frames):
+        nonlocal rows_written, last_df
+        df, errors_df = frames
+        write_dq_errors(errors_df, errors_file_path)
+        last_df = df
+        # Skip empty chunks so the first written chunk fixes the column types
+        if not len(df):
+            return None
+        rows_written += len(df)
+        return serializer.write(df)
+
+    def close():
+        header = b''
+        if not rows_written:
+            # Nothing passed, still write the header, read from the file when it yielded no chunk
+            df = last_df
+            if df is None:
+                df, errors_df = clean(read_frame(file))
+                write_dq_errors(errors_df, errors_file_path)
+            header = serializer.write(df)
+        return header + serializer.close()
+
+    run_pipeline(read_frame_chunks(file, chunk_size, categorical_columns[dataset]), [
+        PipelineStage('dq', check),
+        PipelineStage('serialize', serialize, close),
+        PipelineStage('write', target.write),
+    ])
+    return rows_written, str(errors_file_path)
+
+
+def process_to_s3(df, dataset, job_timestamp, file_format, upload, rollup=None):
+    """
+    Processes one raw DataFrame like process_loyalty_earned_hourly / process_purchases, but streams the
+    processed records straight to S3 instead of writing a local file. Error records are appended locally as usual.
 
-        if processed_purchases_path:
-            processed_files_purchases.append(processed_purchases_path)
+    `upload` takes the processed DataFrame and returns the futures of its uploads, e.g. one object per raw file
+    or PartitionedUploader.upload_frame.
 
-    # Upload the processed files to S3
-    for file in processed_files_leh:
-        leh_key = f'Loyalty_Earned_Hourly_Data_Set/{file}'
+    Like process_file_pipelined, errors are raised: nothing of the file is on local disk, the task has to fail and be
+    retried rather than succeed without its processed rows.
 
-        s3_hook.load_file(
-            filename=file,
-            key=leh_key,
-            bucket_name=bucket_processed_name,
-            replace=True
-        )
+    Returns:
+    Tuple[List[Future], str]: Futures of the processed data keys and the path of the errors CSV file.
+    """
+    errors_file_path = Path(f'errors_dq_{dataset}_{job_timestamp}.csv')
+    if dataset == 'leh':
+        df, errors_df = clean_loyalty_earned_hourly(df)
+    else:
+        df, errors_df = clean_purchases(df, file_format)
+    if rollup is not None:
+        rollup.add(df)
 
-        processed_files_s3_leh.append(leh_key)
+    write_dq_errors(errors_df, errors_file_path)
+    return upload(df), str(errors_file_path)
 
-    for file in processed_files_purchases:
-        purchases_key = f'Purchases_Data_Set/{file}'
 
-        s3_hook.load_file(
-            filename=file,
-            key=purchases_key,
-            bucket_name=bucket_processed_name,
-            replace=True
-        )
+def upload_processed_files(uploader, bucket_name, dataset, files, partitioned_layout=False, chunk_size=None):
+    """
+    Uploads local processed (or rollup) files under the dataset prefix of the processed bucket, one object per
+    file, or split into date=/hour= partitions of at most MAX_PARTITION_ROWS rows with `partitioned_layout`.
 
-        processed_files_s3_purchases.append(purchases_key)
+    Returns:
+    List[Future]: Futures of the uploaded keys.
+    """
+    futures = []
+    for file in files:
+        if partitioned_layout:
+            partitioned = PartitionedUploader(uploader, bucket_name, dataset_prefixes[dataset], Path(file).stem,
+                                              file_format_of(file))
+            futures.extend(partitioned.upload_file(file, chunk_size or MAX_PARTITION_ROWS))
+        else:
+            futures.append(uploader.upload_file(file, bucket_name, f'{dataset_prefixes[dataset]}/{file}'))
+    return futures
 
 
-    # Upload the error files to S3
-    for file in error_files_leh:
-        leh_key = f'Loyalty_Earned_Hourly_Data_Set/{file}'
+def transform_data(**kwargs):
+    """
+    Processes the raw data.
 
-        s3_hook.load_file(
-            filename=file,
-            key=leh_key,
-            bucket_name=bucket_error_name,
-            replace=True
-        )
+    Parameters:
+    df_loyalty_earned_hourly (DataFrame): The input DataFrame containing the loyalty data.
+    df_purchases (DataFrame): The input DataFrame containing the purchases data.
 
-    for file in error_files_purchases:
-        purchases_key = f'Purchases_Data_Set/{file}'
+    Returns:
+    Tuple[str, str]: Paths to the processed data CSV file and errors CSV file.
+    """
 
-        s3_hook.load_file(
-            filename=file,
-            key=purchases_key,
-            bucket_name=bucket_error_name,
-            replace=True
-        )
+    bucket_error_name = 'playstudios-error-data'
+    bucket_processed_name = 'playstudios-processed-data'
 
-    kwargs['ti'].xcom_push(key='processed_files_s3_leh', value=processed_files_s3_leh)
-    kwargs['ti'].xcom_push(key='processed_files_s3_purchases', value=processed_files_s3_purchases)
+    # Get Files from the run manifest
+    run = RunContext(kwargs)
+    list_raw = {dataset: run.manifest.files('raw', dataset) for dataset in ('leh', 'purchases')}
+    job_timestamp = run.manifest.job_timestamp
+
+    # Set to stream each raw file through the DQ rules in chunks of this many rows instead of loading it whole
+    chunk_size = get_setting(kwargs, "transform_chunk_size")
+    # Files smaller than this many bytes are still loaded whole when chunking, planned from the manifest sizes
+    chunk_min_bytes = int(get_setting(kwargs, "transform_chunk_min_bytes", 0))
+    # Upload processed DataFrames straight to S3 instead of writing local files first
+    stream_uploads = get_flag(kwargs, "stream_uploads")
+    # Also write per-(hour, user) rollups of the processed records, the load can build the summary from them
+    emit_rollups = get_flag(kwargs, "emit_rollups")
+    # Write processed files and rollups under date=/hour= partitions of the event date
+    partitioned_layout = get_flag(kwargs, "partitioned_layout")
+    # Stream each raw file through concurrent read, DQ, serialize and write stages, in chunks of transform_chunk_size
+    # (or pipeline_chunk_rows) rows. With stream_uploads the write stage uploads to S3
+    pipelined = get_flag(kwargs, "pipelined_transform")
+
+    for dataset, entries in list_raw.items():
+        print(f"list_raw_{dataset}: {len(entries)} files, {run.manifest.total('raw', dataset, 'rows')} rows, "
+              f"{run.manifest.total('raw', dataset, 'bytes')} bytes")
+    print('job_timestamp', job_timestamp)
 
+    processed_files_s3 = {}
+    rollup_files_s3 = {}
+    error_files_s3 = {}
+    # Uploads run concurrently on one client, streamed DataFrames upload while the next files are processed. With
+    # load_mode 'stage' the processed data is PUT to Snowflake instead
+    with S3Uploader() as uploader, processed_uploader(run, uploader) as processed:
+        for dataset, entries in list_raw.items():
+            files = [entry['path'] for entry in entries]
+            error_files = []
+            processed_files = []
+            processed_futures = []
+            rollup = HourlyRollup(dataset) if emit_rollups else None
+            for part, entry in enumerate(entries):
+                file = entry['path']
+                file_format = file_format_of(file)
+                # Local outputs are named per raw file, a dataset may have several in one run
+                file_timestamp = f'{job_timestamp}_{part:04d}'
+                # Rows in, out and rejected per rule are counted by split_by_rules
+                with run.metrics.step('transform', dataset=dataset, file=file) as step:
+                    step.count('bytes_read', entry['bytes'])
+                    if pipelined:
+                        pipeline_chunk_size = int(chunk_size) if chunk_size else PIPELINE_CHUNK_ROWS
+                        name = f'processed_{dataset}_{file_timestamp}.{file_extension(file_format)}'
+                        if stream_uploads and not partitioned_layout:
+                            key = f'{dataset_prefixes[dataset]}/{name}'
+                            with processed.upload_stream(bucket_processed_name, key) as stream:
+                                stream.rows, errors_path = process_file_pipelined(file, dataset, file_timestamp,
+                                                                                  pipeline_chunk_size, stream, rollup)
+                            processed_futures.append(stream.future)
+                            processed_path = None
+                        else:
+                            # Partitions are split from the local file once it is written
+                            with open(name, 'wb') as target:
+                                _, errors_path = process_file_pipelined(file, dataset, file_timestamp,
+                                                                        pipeline_chunk_size, target, rollup)
+                            processed_path = name
+                    elif chunk_size and entry['bytes'] >= chunk_min_bytes:
+                        processed_path, errors_path = process_file_chunked(file, dataset, file_timestamp,
+                                                                           int(chunk_size), rollup)
+                    elif stream_uploads:
+                        # One key (or one key per partition) per raw file, nothing is staged on local disk
+                        name = f'processed_{dataset}_{file_timestamp}'
+                        if partitioned_layout:
+                            upload = PartitionedUploader(processed, bucket_processed_name, dataset_prefixes[dataset],
+                                                         name, file_format).upload_frame
+                        else:
+                            key = f'{dataset_prefixes[dataset]}/{name}.{file_format}'
+                            upload = lambda frame, key=key: [processed.upload_frame(frame, bucket_processed_name, key)]
+                        df = read_frame(file, categorical_columns[dataset])
+                        futures, errors_path = process_to_s3(df, dataset, file_timestamp, file_format, upload, rollup)
+                        processed_futures.extend(futures)
+                        processed_path = None
+                    else:
+                        # Process the data, the processed file keeps the intermediate format chosen at extract
+                        df = read_frame(file, categorical_columns[dataset])
+                        process = process_loyalty_earned_hourly if dataset == 'leh' else process_purchases
+                        processed_path, errors_path = process(df, file_timestamp, file_format, rollup)
+
+                if errors_path:
+                    error_files.append(errors_path)
+                if processed_path:
+                    processed_files.append(processed_path)
+
+            # Upload the processed files and the error files to S3
+            processed_futures.extend(upload_processed_files(processed, bucket_processed_name, dataset, processed_files,
+                                                            partitioned_layout, chunk_size and int(chunk_size)))
+            error_files_s3[dataset] = [
+                uploader.upload_file(file, bucket_error_name, f'{dataset_prefixes[dataset]}/{file}')
+                for file in error_files]
+            if rollup is not None and files:
+                rollup_path = rollup.write(job_timestamp, file_format_of(files[0]))
+                rollup_files_s3[dataset] = upload_processed_files(processed, bucket_processed_name, dataset,
+                                                                  [rollup_path], partitioned_layout)
+
+            processed_files_s3[dataset] = processed_futures
+
+        # The load finds the processed files in the run manifest. The step times the uploads still running once
+        # every file is processed
+        with run.metrics.step('upload_wait') as step:
+            for dataset in list_raw:
+                stage_keys = {'processed': (processed, processed_files_s3[dataset]),
+                              'dq_errors': (uploader, error_files_s3[dataset])}
+                if emit_rollups:
+                    stage_keys['rollup'] = (processed, rollup_files_s3.get(dataset, []))
+                for stage, (stage_uploader, futures) in stage_keys.items():
+                    stage_entries = stage_uploader.describe(stage_uploader.wait(futures))
+                    run.manifest.set_files(stage, dataset, stage_entries)
+                    step.count('bytes_written', sum(stage_entry['bytes'] for stage_entry in stage_entries))
+    run.finish()
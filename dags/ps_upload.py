@@ -0,0 +1,221 @@
+import hashlib
+import io
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from ps_formats import describe_file, file_format_of
+
+# Concurrent uploads per task, S3 is network bound so this can be above the worker's core count
+S3_UPLOAD_MAX_WORKERS = int(os.environ.get("s3_upload_max_workers", 8))
+# Size of each multipart upload part, S3 requires at least 5 MiB for every part but the last
+S3_PART_SIZE = int(os.environ.get("s3_part_size", 8 * 1024 * 1024))
+# Rows serialized at a time when a DataFrame is streamed to S3 as CSV
+CSV_UPLOAD_CHUNK_ROWS = 100000
+
+_s3_hooks = {}
+_s3_clients = {}
+
+
+def get_s3_hook(aws_conn_id='aws_default'):
+    """
+    Returns the S3Hook of a connection, created once per process.
+    """
+    if aws_conn_id not in _s3_hooks:
+        # Imported with the first hook, the provider is slow to import and local runs don't need it
+        from airflow.providers.amazon.aws.hooks.s3 import S3Hook
+
+        _s3_hooks[aws_conn_id] = S3Hook(aws_conn_id=aws_conn_id)
+    return _s3_hooks[aws_conn_id]
+
+
+def get_s3_client(aws_conn_id='aws_default'):
+    """
+    Returns the boto3 S3 client of a connection, created once per process and shared by every upload.
+
+    boto3 clients are thread safe, so the upload threads all use the same one.
+    """
+    if aws_conn_id not in _s3_clients:
+        _s3_clients[aws_conn_id] = get_s3_hook(aws_conn_id).get_conn()
+    return _s3_clients[aws_conn_id]
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    Write-only file object that streams into an S3 object through a multipart upload.
+
+    At most one part is buffered in memory. Objects smaller than a part are sent with a single put_object.
+    """
+
+    def __init__(self, client, bucket_name, key, part_size=S3_PART_SIZE):
+        super().__init__()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        # Row count of the object, for the run manifest, set by whoever writes it
+        self.rows = None
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.digest = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        data = bytes(data)
+        self.digest.update(data)
+        self.buffer.extend(data)
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=body)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        """
+        Drops the parts uploaded so far, nothing is left behind in the bucket.
+        """
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        super().close()
+
+
+def upload_frame(df, bucket_name, key, client=None):
+    """
+    Serializes a DataFrame straight into an S3 object, without a local file.
+
+    The format follows the key's extension. CSV is written CSV_UPLOAD_CHUNK_ROWS rows at a time.
+
+    Returns:
+    dict: The key, size, sha256 and row count of the object.
+    """
+    writer = MultipartUploadWriter(client or get_s3_client(), bucket_name, key)
+    try:
+        if file_format_of(key) == 'parquet':
+            df.to_parquet(writer, index=False, compression='snappy', coerce_timestamps='us',
+                          allow_truncated_timestamps=True)
+        else:
+            for start in range(0, max(len(df), 1), CSV_UPLOAD_CHUNK_ROWS):
+                chunk = df.iloc[start:start + CSV_UPLOAD_CHUNK_ROWS]
+                writer.write(chunk.to_csv(index=False, header=start == 0).encode('utf-8'))
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return {'key': key, 'bytes': writer.tell(), 'sha256': writer.digest.hexdigest(), 'rows': len(df)}
+
+
+class S3Uploader:
+    """
+    Uploads local files and DataFrames concurrently from a thread pool, over one shared client.
+
+    upload_file / upload_frame return a future of the key. wait() returns the keys of the given futures
+    (every upload so far by default) in submission order, and raises the first upload error. describe() returns
+    the size, sha256 and row count of uploaded keys, for the run manifest.
+
+        with S3Uploader() as uploader:
+            futures = [uploader.upload_file(file, bucket_name, key) for file, key in files]
+            keys = uploader.wait(futures)
+    """
+
+    def __init__(self, client=None, max_workers=S3_UPLOAD_MAX_WORKERS):
+        self.client = client or get_s3_client()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.uploaded = {}
+
+    def _submit(self, fn, *args):
+        future = self.executor.submit(fn, *args)
+        self.futures.append(future)
+        return future
+
+    def _upload_file(self, filename, bucket_name, key):
+        # Described in the upload thread, hashing overlaps with the caller's work
+        entry = describe_file(filename)
+        # upload_file switches to a multipart upload for large files on its own
+        self.client.upload_file(Filename=filename, Bucket=bucket_name, Key=key)
+        self.uploaded[key] = {'key': key, 'bytes': entry['bytes'], 'sha256': entry['sha256'], 'rows': entry['rows']}
+        return key
+
+    def _upload_frame(self, df, bucket_name, key):
+        self.uploaded[key] = upload_frame(df, bucket_name, key, self.client)
+        return key
+
+    def upload_file(self, filename, bucket_name, key):
+        return self._submit(self._upload_file, filename, bucket_name, key)
+
+    def upload_frame(self, df, bucket_name, key):
+        return self._submit(self._upload_frame, df, bucket_name, key)
+
+    @contextmanager
+    def upload_stream(self, bucket_name, key):
+        """
+        Yields a MultipartUploadWriter written to from the calling thread, e.g. by the write stage of a pipeline,
+        which sets its `rows`. The object is completed and recorded like the other uploads when the block ends, its
+        future is then the writer's `future`, or aborted if the block failed.
+
+            with uploader.upload_stream(bucket_name, key) as stream:
+                stream.rows = write_rows(stream)
+            futures.append(stream.future)
+        """
+        writer = MultipartUploadWriter(self.client, bucket_name, key)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        self.uploaded[key] = {'key': key, 'bytes': writer.tell(), 'sha256': writer.digest.hexdigest(),
+                              'rows': writer.rows}
+        writer.future = Future()
+        writer.future.set_result(key)
+        self.futures.append(writer.future)
+
+    def wait(self, futures=None):
+        futures = self.futures if futures is None else futures
+        return [future.result() for future in futures]
+
+    def describe(self, keys):
+        return [self.uploaded[key] for key in keys]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Surface upload errors unless the block already failed
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.close()